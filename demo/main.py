@@ -31,6 +31,7 @@ from google.appengine.api import memcache
 from mapreduce import base_handler
 
 from lakshmi import pipelines
+from lakshmi import urls
 from lakshmi.datum import CrawlDbDatum
 from lakshmi.datum import LinkDbDatum
 from lakshmi.datum import ContentDbDatum
@@ -114,6 +115,7 @@ class FetchStart(webapp.RequestHandler):
     if email is None:
       return
 
+    url = pipelines.canonical_cache.resolve(urls.canonicalize(url) or url)
     data = CrawlDbDatum(
           parent =ndb.Key(CrawlDbDatum, url),
           url=url,
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches local to the process."""
+
+import heapq
+
+class LRUCache(object):
+  """Least recently used cache, that is local to the process.
+
+  The hit is a dict lookup and the update of its use, and the least
+  recently used quarter of entries is evicted at once when it is full,
+  so that the cost of eviction is amortized over the puts.
+  """
+
+  def __init__(self, max_size):
+    """Initializes a LRUCache class.
+
+    Args:
+      max_size: maximum count of entries.
+    """
+    self._max_size = max_size
+    #Dict of key to the list of value and the tick of last use.
+    self._entries = {}
+    self._tick = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    """Get the value of key, or default if it is not cached."""
+    entry = self._entries.get(key)
+    if entry is None:
+      return default
+    self._tick += 1
+    entry[1] = self._tick
+    return entry[0]
+
+  def put(self, key, value):
+    """Store the value of key, evicts the least recently used if full."""
+    if key not in self._entries and len(self._entries) >= self._max_size:
+      self._evict()
+    self._tick += 1
+    self._entries[key] = [value, self._tick]
+
+  def _evict(self):
+    """Evict the least recently used quarter of entries."""
+    count = max(1, self._max_size // 4)
+    oldest = heapq.nsmallest(count, self._entries.iteritems(),
+                             key=lambda item: item[1][1])
+    for key, entry in oldest:
+      del self._entries[key]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Canonical urls of aliases.
+
+The same page is often served by many urls, and the page declares
+its canonical url by rel=canonical link or meta refresh. The alias is
+stored to datastore, and cached in memcache, so later runs and other
+shards fetch the canonical url instead of the alias.
+Only the canonical url on the same host as the page is trusted, so that
+a page can not redirect the crawl of its url to other hosts.
+"""
+
+import re
+import urlparse
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from lakshmi import cache
+from lakshmi import urls
+from lakshmi.datum import CanonicalDbDatum
+
+#Namespace of memcache for canonical urls.
+MEMCACHE_NAMESPACE = "lakshmi_canonicals"
+#Expiration seconds of memcache entries.
+MEMCACHE_EXPIRATION = 24 * 60 * 60
+#Maximum count of aliases followed to the canonical url.
+MAX_ALIASES = 5
+#Maximum number of urls in local cache.
+MAX_LOCAL_CACHE_SIZE = 10000
+#Maximum count of urls looked up by a batch call of memcache and datastore.
+MAX_BATCH_SIZE = 1000
+#Value of cache entry of the url, that is not an alias.
+_NOT_ALIAS = ""
+
+#The tags are read from the head of page only.
+_HEAD_END_RE = re.compile(r"</head\s*>|<body[\s>]", re.I)
+_TAG_RE = re.compile(r"<(link|meta)(\s[^>]*)>", re.I)
+_ATTRIBUTE_RE = re.compile(
+    r"([a-zA-Z_:][-a-zA-Z0-9_:.]*)\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s\"'>]+))")
+_REFRESH_RE = re.compile(
+    r"^\s*([0-9]+)(?:\.[0-9]*)?\s*[;,]?\s*(?:url\s*=\s*)?[\"']?([^\"']*)", re.I)
+
+def _parse_attributes(attributes):
+  """Parse the attributes of tag to dict, whose names are lower case."""
+  result = {}
+  for match in _ATTRIBUTE_RE.finditer(attributes):
+    name, double_quoted, single_quoted, unquoted = match.groups()
+    value = double_quoted
+    if value is None:
+      value = single_quoted if single_quoted is not None else unquoted
+    result.setdefault(name.lower(), value.strip())
+  return result
+
+def _get_refresh_url(content):
+  """Get the url of meta refresh, or None if it is not immediate."""
+  match = _REFRESH_RE.match(content)
+  if match is None or int(match.group(1)) != 0:
+    return None
+  return match.group(2).strip() or None
+
+def _get_same_host_url(url, base_url):
+  """Canonicalize the url, or returns None if it is on other host."""
+  canonical_url = urls.canonicalize(url, base_url)
+  if (canonical_url is None or urlparse.urlsplit(canonical_url).hostname !=
+      urlparse.urlsplit(base_url).hostname):
+    return None
+  return canonical_url
+
+def extract_canonical_url(content, base_url):
+  """Extract the canonical url declared by the page.
+
+  The url of <link rel="canonical"> is used, or the url of immediate
+  <meta http-equiv="refresh"> if the page has no canonical link.
+  The url on other host than base_url is ignored.
+
+  Args:
+    content: the content of page.
+    base_url: the url of page, that resolves the relative url.
+
+  Returns:
+    the canonicalized url, or None if the page declares no url
+    on the same host.
+  """
+  head_end = _HEAD_END_RE.search(content)
+  end = head_end.start() if head_end else len(content)
+  refresh_url = None
+  for match in _TAG_RE.finditer(content, 0, end):
+    tag = match.group(1).lower()
+    attributes = _parse_attributes(match.group(2))
+    if tag == "link":
+      rels = attributes.get("rel", "").lower().split()
+      if "canonical" in rels and attributes.get("href"):
+        return _get_same_host_url(attributes["href"], base_url)
+    elif (refresh_url is None and
+          attributes.get("http-equiv", "").lower() == "refresh"):
+      refresh_url = _get_refresh_url(attributes.get("content", ""))
+  if refresh_url is not None:
+    return _get_same_host_url(refresh_url, base_url)
+  return None
+
+class CanonicalCache(object):
+  """Cache of canonical urls backed by memcache and datastore."""
+
+  def __init__(self, max_size=MAX_LOCAL_CACHE_SIZE):
+    self._canonicals = cache.LRUCache(max_size)
+
+  def get(self, url):
+    """Get the canonical url of alias, or None if url is not an alias."""
+    canonical_url = self._canonicals.get(url)
+    if canonical_url is None:
+      canonical_url = memcache.get(url, namespace=MEMCACHE_NAMESPACE)
+      if canonical_url is None:
+        entity = CanonicalDbDatum.get_by_id(url)
+        canonical_url = _NOT_ALIAS
+        if entity is not None:
+          canonical_url = entity.canonical_url
+        memcache.set(url, canonical_url, time=MEMCACHE_EXPIRATION,
+                     namespace=MEMCACHE_NAMESPACE)
+      #Unknown url is also cached in local, to not look up it again.
+      self._canonicals.put(url, canonical_url)
+    return canonical_url or None
+
+  def prefetch(self, fetch_urls):
+    """Look up the urls that are not cached in local by batches
+    of MAX_BATCH_SIZE urls.
+
+    The urls that are not aliases are also cached, so that get() of
+    them does not look up memcache and datastore one by one.
+
+    Args:
+      fetch_urls: list of urls.
+    """
+    missing = [url for url in fetch_urls if self._canonicals.get(url) is None]
+    for i in xrange(0, len(missing), MAX_BATCH_SIZE):
+      self._prefetch_batch(missing[i:i + MAX_BATCH_SIZE])
+
+  def _prefetch_batch(self, missing):
+    """Look up the urls, that are not cached in local."""
+    canonical_urls = memcache.get_multi(missing, namespace=MEMCACHE_NAMESPACE)
+    unknown = [url for url in missing if url not in canonical_urls]
+    if unknown:
+      entities = ndb.get_multi([ndb.Key(CanonicalDbDatum, url) for url in unknown])
+      stored = {}
+      for url, entity in zip(unknown, entities):
+        stored[url] = entity.canonical_url if entity is not None else _NOT_ALIAS
+      memcache.set_multi(stored, time=MEMCACHE_EXPIRATION,
+                         namespace=MEMCACHE_NAMESPACE)
+      canonical_urls.update(stored)
+    for url, canonical_url in canonical_urls.iteritems():
+      self._canonicals.put(url, canonical_url)
+
+  def put(self, url, canonical_url):
+    """Store the canonical url of alias.
+
+    Returns:
+      False if it is not stored, because the canonical url is
+      an alias of url.
+    """
+    if url == canonical_url or self.resolve(canonical_url) == url:
+      return False
+    if self._canonicals.get(url) != canonical_url:
+      self._canonicals.put(url, canonical_url)
+      memcache.set(url, canonical_url, time=MEMCACHE_EXPIRATION,
+                   namespace=MEMCACHE_NAMESPACE)
+      CanonicalDbDatum(id=url, canonical_url=canonical_url).put()
+    return True
+
+  def resolve(self, url):
+    """Follow the aliases of url.
+
+    Returns:
+      the canonical url, that is url if it is not an alias.
+    """
+    seen = set([url])
+    for _ in xrange(MAX_ALIASES):
+      canonical_url = self.get(url)
+      if canonical_url is None or canonical_url in seen:
+        break
+      seen.add(canonical_url)
+      url = canonical_url
+    return url
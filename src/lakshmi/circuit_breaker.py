@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-host circuit breaker of fetches.
+
+The consecutive connection errors of a host are counted in memcache,
+so that they are shared by all shards of the fetch jobs. When the count
+reaches the threshold, the circuit of the host is open and the urls of
+the host are not fetched until the cooldown is expired. Then one shard
+fetches a url as the probe (half-open), and the circuit is closed if
+the probe succeeds, or opened again if it fails.
+"""
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+#Namespace of memcache for circuit breaker.
+MEMCACHE_NAMESPACE = "lakshmi_circuit_breaker"
+#Prefix of memcache key of count of consecutive failures.
+FAILURES_KEY_PREFIX = "failures:"
+#Prefix of memcache key of the time until the circuit is open.
+OPEN_KEY_PREFIX = "open:"
+#Prefix of memcache key of the probe of half-open circuit.
+PROBE_KEY_PREFIX = "probe:"
+#Number of consecutive failures to open the circuit.
+DEFAULT_FAILURE_THRESHOLD = 5
+#Seconds the circuit is kept open.
+DEFAULT_COOLDOWN = 60
+#Expiration seconds of memcache entries of open circuit.
+MEMCACHE_EXPIRATION = 60 * 60
+
+class HostCircuitBreaker(object):
+  """Circuit breaker keyed by host, that is shared via memcache."""
+
+  def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+               cooldown=DEFAULT_COOLDOWN, probe_timeout=None):
+    """Initializes a HostCircuitBreaker class.
+
+    Args:
+      failure_threshold: number of consecutive failures to open the circuit.
+      cooldown: seconds the circuit is kept open.
+      probe_timeout: seconds to wait the result of probe, before other
+        shard takes over the probe. cooldown is used if it is None.
+    """
+    self._failure_threshold = failure_threshold
+    self._cooldown = cooldown
+    self._probe_timeout = probe_timeout or cooldown
+    #Hosts that had failures seen by this instance, the failures of
+    #other hosts are not reset by success.
+    self._failing_hosts = set()
+    self._time = time.time
+
+  def allow(self, host):
+    """Returns True if the url of host can be fetched.
+
+    While the circuit is open, returns False. After the cooldown,
+    returns True only for the shard that takes the probe.
+    """
+    values = memcache.get_multi([FAILURES_KEY_PREFIX + host, OPEN_KEY_PREFIX + host],
+                                namespace=MEMCACHE_NAMESPACE)
+    if values.get(FAILURES_KEY_PREFIX + host):
+      self._failing_hosts.add(host)
+    open_until = values.get(OPEN_KEY_PREFIX + host)
+    if open_until is None:
+      return True
+    if self._time() < open_until:
+      return False
+    #Half-open, only one shard probes the host.
+    return memcache.add(PROBE_KEY_PREFIX + host, 1, time=self._probe_timeout,
+                        namespace=MEMCACHE_NAMESPACE)
+
+  def record_success(self, host):
+    """Record the success of fetch, the circuit of host is closed."""
+    if host not in self._failing_hosts:
+      return
+    self._failing_hosts.discard(host)
+    memcache.delete_multi([FAILURES_KEY_PREFIX + host, OPEN_KEY_PREFIX + host,
+                           PROBE_KEY_PREFIX + host],
+                          namespace=MEMCACHE_NAMESPACE)
+
+  def record_failure(self, host):
+    """Record the connection error or timeout of host.
+
+    Returns:
+      True if the circuit of host is opened by this failure.
+    """
+    self._failing_hosts.add(host)
+    failures = memcache.incr(FAILURES_KEY_PREFIX + host, initial_value=0,
+                             namespace=MEMCACHE_NAMESPACE)
+    if failures is None or failures < self._failure_threshold:
+      return False
+    logging.info("Circuit of %s is open after %d failures" % (host, failures))
+    memcache.set(OPEN_KEY_PREFIX + host, self._time() + self._cooldown,
+                 time=MEMCACHE_EXPIRATION, namespace=MEMCACHE_NAMESPACE)
+    memcache.delete(PROBE_KEY_PREFIX + host, namespace=MEMCACHE_NAMESPACE)
+    return True
@@ -33,13 +33,30 @@ FP_RESOURCE_PATH = "resource"
 FOLLOW_ALL = "follow_all"
 FOLLOW_NONE = "follow_none"
 
+# fetch_engine, that sends the requests of fetches
+FETCH_ENGINE_URLFETCH = "urlfetch"
+FETCH_ENGINE_POOLED = "pooled"
+
 # minimum response rate
 NO_MIN_RESPONSE_RATE = 0
 
+# crawl has no deadline
+NO_CRAWL_END_TIME = 0
+
 # default setting for content size
 DEFAULT_MAX_CONTENT_SIZE = 64 * 1024
 # default setting for crawl delay  
 DEFAULT_CRAWL_DELAY = 3000
+# default setting for max attempts of fetch of a url.
+DEFAULT_MAX_FETCH_ATTEMPTS = 3
+# base delay before retry of failed fetch, that is doubled by each attempt.
+RETRY_BASE_DELAY = 60 * 1000
+# maximum delay before retry of failed fetch.
+MAX_RETRY_DELAY = 24 * 60 * 60 * 1000
+# default time to live of cached robots.txt.
+DEFAULT_ROBOTS_CACHE_TTL = 24 * 60 * 60 * 1000
+# time to live of cached robots.txt, that could not be fetched.
+ROBOTS_FAILURE_TTL = 60 * 60 * 1000
 # default setting for max urls per set.
 DEFAULT_MAX_URLS_PER_SET = 256
 # default setting for urls per skipped set.
@@ -151,6 +168,10 @@ class FetcherPolicyInfo(validation.Validated):
                                 FOLLOW_NONE,
                                 default=FOLLOW_ALL),
     "request_timeout": r".+",
+    "max_fetch_attempts": validation.Optional(r"[0-9]+"),
+    "robots_cache_ttl": validation.Optional(r"[0-9]+"),
+    "fetch_engine": validation.Optional(validation.Options(FETCH_ENGINE_URLFETCH,
+                                                           FETCH_ENGINE_POOLED)),
   }
  
 class FetcherPolicyYaml(validation.Validated):
@@ -164,13 +185,16 @@ class FetcherPolicyYaml(validation.Validated):
     web_address: http://test.domain.com
     min_response_rate: 0
     max_content_size: 65536
-    crawl_end_time: 15000
+    crawl_end_time: 0
     crawl_delay: 0
     max_redirects: 20
     accept_language: en-us,en-gb,en;q=0.7,*;q=0.3
     valid_mime_types: None
     redirect_mode: follow
     request_timeout: 20000
+    max_fetch_attempts: 3
+    robots_cache_ttl: 86400000
+    fetch_engine: urlfetch
 
   Where
     fetcher_policy: The fetcher policy root.
@@ -179,7 +203,9 @@ class FetcherPolicyYaml(validation.Validated):
     web_address: web_address of fetcher.
     min_response_rate: rate of http response.
     max_content_size: maximum size of content.
-    crawl_end_time: crawl duration you know exactly when the crawl will end.
+    crawl_end_time: crawl duration you know exactly when the crawl will end,
+        in milliseconds from start of FetcherPipeline.
+        NO_CRAWL_END_TIME(0) means the crawl has no deadline.
     crawl_delay: crawl delay time of fetch.
     max_redirects: maximum count of redirects.
     accept_language: restricts the set of natural languages
@@ -191,6 +217,17 @@ class FetcherPolicyYaml(validation.Validated):
         FOLLOW_TEMP: Temp redirects are automatically followed, but not pemanent.
         FOLLOW_NONE: No redirects are followed.
     request_timeout: timeout fetch job.
+    max_fetch_attempts: maximum count of fetch of a url, that failed by
+        transient error. DEFAULT_MAX_FETCH_ATTEMPTS if it is not set.
+    robots_cache_ttl: maximum time to live of cached robots.txt in milliseconds,
+        that is shortened by cache headers of response.
+        DEFAULT_ROBOTS_CACHE_TTL if it is not set.
+    fetch_engine
+      properties:
+        FETCH_ENGINE_URLFETCH: Requests are sent by urlfetch of App Engine,
+            that is the default.
+        FETCH_ENGINE_POOLED: Requests are sent on non-blocking sockets
+            with persistent connections, for running outside App Engine.
   """
 
   ATTRIBUTES = {
@@ -230,6 +267,12 @@ class FetcherPolicyYaml(validation.Validated):
       "redirect_mode": fetcher_policy.redirect_mode,
       "request_timeout": fetcher_policy.request_timeout,
     }
+    if fetcher_policy.max_fetch_attempts is not None:
+      out["max_fetch_attempts"] = fetcher_policy.max_fetch_attempts
+    if fetcher_policy.robots_cache_ttl is not None:
+      out["robots_cache_ttl"] = fetcher_policy.robots_cache_ttl
+    if fetcher_policy.fetch_engine is not None:
+      out["fetch_engine"] = fetcher_policy.fetch_engine
     max_content_sizes = fetcher_policy_yaml.fetcher_policy.max_content_size
     if max_content_sizes:
       max_content_size_list = []
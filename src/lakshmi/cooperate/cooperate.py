@@ -52,15 +52,14 @@ def clean_html(html):
   cleaned = re.sub(r"  ", " ", cleaned)
   return cleaned.strip()
 
+_TITLE_RE = re.compile(r"<title>(.*?)</title>", re.I | re.S)
+
 def _extract_title(html):
-  html_lowered = html.lower();
-  begin = html_lowered.find('<title>')
-  end = html_lowered.find('</title>')
-  if begin == -1 or end == -1:
+  match = _TITLE_RE.search(html)
+  if match is None:
     return "No Title"
   else:
-    # Find in the original html
-    return html[begin+len('<title>'):end].strip()
+    return match.group(1).strip()
 
 def _to_csv_map(entity_type):
   """Map function of parse contents and 
@@ -16,6 +16,8 @@
 
 from google.appengine.ext import ndb
 
+from lakshmi import urls
+
 class CrawlDbDatum(ndb.Model):
   """Holds accumulated state of crawl execution.
   CrawlDbDatum is stored in datastore.
@@ -25,9 +27,14 @@ class CrawlDbDatum(ndb.Model):
 
   Properties:
     url: the url for fetch
+    extract_domain_url: the domain url of url, that is set when
+      the entity is put
     last_fetched: last time of fetch
     last_updated: last time of update
     last_status: the status of last fetch
+    fetch_attempts: count of failed fetch by transient error
+    next_fetch_time: the url is not fetched until this time,
+      that is backoff of retry after transient error
   """
   #reason of indexed=False is saving the datastore write operation.
   url = ndb.StringProperty()
@@ -39,14 +46,36 @@ class CrawlDbDatum(ndb.Model):
                              auto_now_add=True,
                              indexed=False)
   last_status = ndb.IntegerProperty()
+  fetch_attempts = ndb.IntegerProperty(default=0, indexed=False)
+  next_fetch_time = ndb.DateTimeProperty(indexed=False)
   
   @classmethod
   def kind(cls):
     return "CrawlDbDatum"
 
+  def _pre_put_hook(self):
+    """Set extract_domain_url of url, if it is not set."""
+    if self.extract_domain_url is None and self.url:
+      self.extract_domain_url = urls.get_domain(self.url)
+
   @classmethod
   @ndb.transactional
   def insert_or_fail(cls, id_or_keyname, **kwds):
+    """Insert the entity, or returns None if it exists.
+
+    The url is canonicalized, and also id_or_keyname and the id of
+    parent if they are the url.
+    """
+    url = kwds.get("url")
+    if url:
+      canonical_url = urls.canonicalize(url) or url
+      if id_or_keyname == url:
+        id_or_keyname = canonical_url
+      parent = kwds.get("parent")
+      if parent is not None and parent.id() == url:
+        kwds["parent"] = ndb.Key(parent.kind(), canonical_url,
+                                 parent=parent.parent())
+      kwds["url"] = canonical_url
     entity = cls.get_by_id(id=id_or_keyname, parent=kwds.get('parent'))
     if entity is None:
       entity = cls(id=id_or_keyname, **kwds)
@@ -65,20 +94,27 @@ class FetchedDbDatum(ndb.Model):
     url: base url.
     fetched_url: the fetched url.
     fetch_time: the time of fetch.
-    fetched_content: the html content of page.
+    fetched_content: the html content of page, that is decoded by charset.
+    charset: the charset of fetched content.
     content_type: the content type.
     content_size: the content size.
     response_rate: the response rate.
     http_headers: the responsed HTTP header.
+    fingerprint: the fingerprint of fetched content.
+    duplicate_of: the key of CrawlDbDatum whose FetchedDbDatum holds
+      the same content, fetched_content is not stored if it is set.
   """
   url = ndb.StringProperty(indexed=False)
   fetched_url = ndb.StringProperty(indexed=False)
   fetch_time = ndb.FloatProperty(indexed=False)
   fetched_content = ndb.TextProperty(indexed=False)
+  charset = ndb.StringProperty(indexed=False)
   content_type = ndb.StringProperty(indexed=False)
   content_size = ndb.IntegerProperty(indexed=False)
   response_rate = ndb.IntegerProperty(indexed=False)
   http_headers = ndb.TextProperty(indexed=False)
+  fingerprint = ndb.StringProperty(indexed=False)
+  duplicate_of = ndb.KeyProperty(indexed=False)
 
   @classmethod
   def kind(cls):
@@ -89,20 +125,27 @@ class ContentDbDatum(ndb.Model):
   Hold the links of page.
   LinkDbDatum is stored in datastore,
   This entity's ancestor key is setting target page's url.
+  Entity's key name is the url of target of fetch.
   Fetched contents are Storing to blobstore.
 
   Properties:
     fetched_url: the url of fetched.
-    stored_url: the url content is stored.
+    stored_url: the url content is stored, that is None until
+      the content is fetched.
     content_type: content type.
     content_size: the size of content.
     http_headers: the http headers.
+    fetch_attempts: count of failed fetch by transient error
+    next_fetch_time: the content is not fetched until this time,
+      that is backoff of retry after transient error
   """
   fetched_url = ndb.StringProperty(indexed=False)
   stored_url = ndb.StringProperty(indexed=False)
   content_type = ndb.StringProperty(indexed=False)
   content_size = ndb.IntegerProperty(indexed=False)
   http_headers = ndb.TextProperty(indexed=False)
+  fetch_attempts = ndb.IntegerProperty(default=0, indexed=False)
+  next_fetch_time = ndb.DateTimeProperty(indexed=False)
 
   @classmethod
   def kind(cls):
@@ -123,3 +166,90 @@ class LinkDbDatum(ndb.Model):
   @classmethod
   def kind(cls):
     return "LinkDbDatum"
+
+class HostDbDatum(ndb.Model):
+  """Holds the politeness state of a host.
+  HostDbDatum is stored in datastore,
+  which entity is shared by all shards of fetch jobs.
+  Entity's key name is the host url, like http://www.example.com.
+
+  Properties:
+    next_fetch_time: the earliest time of next fetch to this host.
+    crawl_delay: the crawl delay in seconds specified by robots.txt.
+  """
+  next_fetch_time = ndb.FloatProperty(indexed=False)
+  crawl_delay = ndb.FloatProperty(indexed=False)
+
+  @classmethod
+  def kind(cls):
+    return "HostDbDatum"
+
+class RedirectDbDatum(ndb.Model):
+  """Holds the permanent redirect.
+  RedirectDbDatum is stored in datastore,
+  which entity is the redirect of 301 or 308 response.
+  Entity's key name is the redirected url.
+
+  Properties:
+    location: the url of redirect target.
+  """
+  location = ndb.StringProperty(indexed=False)
+
+  @classmethod
+  def kind(cls):
+    return "RedirectDbDatum"
+
+class FingerprintDbDatum(ndb.Model):
+  """Holds the owner of fetched content.
+  FingerprintDbDatum is stored in datastore,
+  which entity is the index of content fingerprint, that is used to
+  store identical content served by many urls only once.
+  Entity's key name is the fingerprint of content.
+
+  Properties:
+    crawl_db_key: the key of CrawlDbDatum whose FetchedDbDatum holds
+      the content.
+  """
+  crawl_db_key = ndb.KeyProperty(indexed=False)
+
+  @classmethod
+  def kind(cls):
+    return "FingerprintDbDatum"
+
+class RobotsDbDatum(ndb.Model):
+  """Holds the cached robots.txt of a host.
+  RobotsDbDatum is stored in datastore,
+  which entity is shared by crawl runs, so that robots.txt is
+  not fetched again until it is expired.
+  Entity's key name is the host url, like http://www.example.com.
+
+  Properties:
+    content: the content of robots.txt.
+    fetched_time: the time of fetch in seconds.
+    expires: the time of expiration in seconds.
+    failed: True if the robots.txt could not be fetched.
+  """
+  content = ndb.BlobProperty(indexed=False)
+  fetched_time = ndb.FloatProperty(indexed=False)
+  expires = ndb.FloatProperty(indexed=False)
+  failed = ndb.BooleanProperty(indexed=False)
+
+  @classmethod
+  def kind(cls):
+    return "RobotsDbDatum"
+
+class CanonicalDbDatum(ndb.Model):
+  """Holds the canonical url of an alias.
+  CanonicalDbDatum is stored in datastore,
+  which entity is declared by rel=canonical link or meta refresh
+  of fetched page, so that the alias is not fetched again.
+  Entity's key name is the alias url.
+
+  Properties:
+    canonical_url: the canonical url of alias.
+  """
+  canonical_url = ndb.StringProperty(indexed=False)
+
+  @classmethod
+  def kind(cls):
+    return "CanonicalDbDatum"
@@ -18,6 +18,9 @@ __all__ = [
     "BadYamlError",
     "MultipleDocumentsInFpYaml",
     "HttpFetchError",
+    "RetryableFetchError",
+    "DeferredFetchError",
+    "RedirectError",
     "AbortedFetchError",
     ]
 
@@ -31,7 +34,30 @@ class MultipleDocumentsInFpYaml(BadYamlError):
   """There's more than one document in fetch_policy.yaml file."""
   
 class HttpFetchError(Error):
-  """Raise when the HTTP Status is errored."""
+  """Raise when the HTTP Status is errored.
+
+  The error is permanent, the url should not be fetched again.
+  status_code is the HTTP status of response, or None.
+  """
+  def __init__(self, message, status_code=None):
+    Error.__init__(self, message)
+    self.status_code = status_code
+
+class RetryableFetchError(HttpFetchError):
+  """Raise when the fetch failed by transient error, that could be retried.
+
+  retry_after is the seconds of Retry-After header of response, or None.
+  """
+  def __init__(self, message, status_code=None, retry_after=None):
+    HttpFetchError.__init__(self, message, status_code)
+    self.retry_after = retry_after
+
+class DeferredFetchError(RetryableFetchError):
+  """Raise when the fetch is deferred before the request, like by crawl delay.
+
+  The url was not requested, so it should be fetched by next run
+  without counting a failed attempt.
+  """
 
 class RedirectError(Error):
   """Raise when the HTTP Status is errored."""
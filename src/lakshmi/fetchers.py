@@ -16,18 +16,39 @@
 
 import time
 import logging
+import codecs
+import collections
+import errno
+import heapq
+import email.utils
+import hashlib
 import httplib
-import StringIO
-import gzip
+import math
+import mimetypes
+import os
+import posixpath
+import random
 import re
+import select
+import socket
+import threading
+import urlparse
+import zlib
 
+try:
+  import ssl
+except ImportError:
+  ssl = None
+
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch
 from lakshmi import errors
 from lakshmi import configuration
+from lakshmi import urls
 
 
 DEFAULT_CHARSET = "utf-8,ISO-8859-1;q=0.7,*;q=0.7"
-DEFAULT_ACCEPT_ENCODING = "x-gzip, gzip"
+DEFAULT_ACCEPT_ENCODING = "x-gzip, gzip, deflate"
 DEFAULT_ACCEPT = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
 TEXT_MIME_TYPES = ("text/html",
                   "text/plain",
@@ -38,13 +59,343 @@ TEXT_MIME_TYPES = ("text/html",
 DEFAULT_BROWSER_VERSION = "Mozilla/5.0"
 CRAWLER_VERSION = "1.0"
 
+#Number of concurrent requests of get_many.
+DEFAULT_MAX_IN_FLIGHT = 10
+
+#Probe modes of SimpleHttpFetcher.
+#PROBE_NONE: never probe.
+#PROBE_NON_TEXT: probe urls whose extension suggests non-text content.
+#PROBE_ALL: probe urls except those whose extension suggests text content.
+PROBE_NONE = "none"
+PROBE_NON_TEXT = "non_text"
+PROBE_ALL = "all"
+#Maximum number of url patterns in probe cache.
+MAX_PROBE_CACHE_SIZE = 1000
+#Extensions of dynamic pages, that may serve any content type.
+DYNAMIC_EXTENSIONS = frozenset([".php", ".asp", ".aspx", ".jsp", ".cgi"])
+#Maximum number of urls in local redirect cache.
+MAX_REDIRECT_CACHE_SIZE = 10000
+#Maximum number of hosts, that statistics of response time are kept.
+MAX_HOST_STATS_SIZE = 10000
+#Number of recent response times per host, to calculate the timeout.
+HOST_LATENCY_SAMPLES = 50
+#Minimum number of response times to use the timeout of host.
+MIN_HOST_LATENCY_SAMPLES = 10
+#The timeout of host is this times the 95th percentile of response times.
+HOST_TIMEOUT_FACTOR = 3.0
+#Minimum timeout of host in seconds.
+MIN_HOST_TIMEOUT = 2.0
+#Initial limit of concurrent requests per host of get_many.
+INITIAL_HOST_CONCURRENCY = 2.0
+#Multiplier of the limit of concurrent requests per host by a failure.
+HOST_CONCURRENCY_DECREASE = 0.5
+#Weight of the latest read rate of exponential moving average.
+READ_RATE_WEIGHT = 0.2
+#Maximum number of idle connections per host of ConnectionPool.
+DEFAULT_MAX_IDLE_PER_HOST = 4
+#Size of chunk to read the response by PooledHttpFetcher.
+READ_CHUNK_SIZE = 16 * 1024
+#Maximum size of status line and headers of response of PooledHttpFetcher.
+MAX_HEADER_SIZE = 64 * 1024
+#Seconds to reuse the resolved address of host of ConnectionPool.
+ADDRESS_CACHE_TTL = 5 * 60
+#Maximum number of hosts, whose addresses are cached by ConnectionPool.
+MAX_ADDRESS_CACHE_SIZE = 10000
+#Default ports of the schemes fetched by PooledHttpFetcher.
+DEFAULT_HTTP_PORTS = {"http": 80, "https": 443}
+
+#zlib window bits for each of supported content-encoding.
+DECOMPRESS_WBITS = {
+  "gzip": 16 + zlib.MAX_WBITS,
+  "x-gzip": 16 + zlib.MAX_WBITS,
+  "deflate": zlib.MAX_WBITS,
+}
+
+#Charset of text content, used when no charset is declared.
+DEFAULT_CONTENT_CHARSET = "utf-8"
+#Charset used when the content is not valid in DEFAULT_CONTENT_CHARSET.
+FALLBACK_CHARSET = "windows-1252"
+#Number of bytes of content to sniff <meta> charset declaration.
+CHARSET_SNIFF_SIZE = 4096
+#Number of bytes of content to validate in DEFAULT_CONTENT_CHARSET.
+CHARSET_VALIDATE_SIZE = 64 * 1024
+
+#Byte order marks and the charset of each, longer mark is first.
+_BOMS = (
+  (codecs.BOM_UTF32_LE, "utf-32-le"),
+  (codecs.BOM_UTF32_BE, "utf-32-be"),
+  (codecs.BOM_UTF8, "utf-8"),
+  (codecs.BOM_UTF16_LE, "utf-16-le"),
+  (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+_CHARSET_PARAM_RE = re.compile(r"charset\s*=\s*[\"']?([-\w.:]+)", re.I)
+_META_CHARSET_RE = re.compile(r"<meta[^>]+charset\s*=\s*[\"']?([-\w.:]+)", re.I)
+
+#httplib does not define 308 Permanent Redirect.
+PERMANENT_REDIRECT = 308
+
 REDIRECT_STATUSES = frozenset([
   httplib.MOVED_PERMANENTLY,
   httplib.FOUND,
   httplib.SEE_OTHER,
   httplib.TEMPORARY_REDIRECT,
+  PERMANENT_REDIRECT,
+])
+
+#httplib does not define 429 Too Many Requests.
+TOO_MANY_REQUESTS = 429
+
+#HTTP statuses of transient errors, that could be retried later.
+RETRYABLE_STATUSES = frozenset([
+  httplib.REQUEST_TIMEOUT,
+  TOO_MANY_REQUESTS,
+  httplib.INTERNAL_SERVER_ERROR,
+  httplib.BAD_GATEWAY,
+  httplib.SERVICE_UNAVAILABLE,
+  httplib.GATEWAY_TIMEOUT,
+])
+
+PERMANENT_REDIRECT_STATUSES = frozenset([
+  httplib.MOVED_PERMANENTLY,
+  PERMANENT_REDIRECT,
 ])
 
+#Properties of FetchResult, that are accessible like a dict.
+_FETCH_RESULT_PROPERTIES = ("content", "text", "fingerprint")
+
+class FetchResult(object):
+  """The result of fetch.
+
+  Attributes:
+    url: the url for fetch.
+    fetched_url: the url of fetched, that is final url of redirects.
+    status_code: HTTP status code of response.
+    time: the time of fetch in seconds.
+    content: the content of response as str, that is copied at each
+      access if the content is truncated.
+    content_buffer: the content of response as buffer, the truncation
+      is a view over the received bytes without copy.
+    content_length: the length of content.
+    mime_type: the mime type of content.
+    read_rate: the response rate in bytes/sec.
+    headers: HTTP headers of response as it was received.
+    redirects: list of urls of followed redirects.
+    encoding: the charset of text content, None if content is not text.
+    text: the content decoded by encoding, that is decoded once at first access.
+    fingerprint: the fingerprint of content, that is computed at first access.
+  """
+  __slots__ = ("url", "fetched_url", "status_code", "time", "content_buffer",
+               "content_length", "mime_type", "read_rate", "headers",
+               "redirects", "encoding", "_text", "_fingerprint",
+               "_lowered_headers")
+
+  def __init__(self, url, fetched_url, status_code, headers):
+    self.url = url
+    self.fetched_url = fetched_url
+    self.status_code = status_code
+    self.headers = headers
+    self.time = 0
+    self.content_buffer = None
+    self.content_length = 0
+    self.mime_type = None
+    self.read_rate = 0
+    self.redirects = []
+    self.encoding = None
+    self._text = None
+    self._fingerprint = None
+    self._lowered_headers = None
+
+  @property
+  def content(self):
+    """The content as str, or None if there is no content."""
+    content = self.content_buffer
+    if content is None or isinstance(content, str):
+      return content
+    return str(content)
+
+  @property
+  def text(self):
+    """The content as unicode, or None if content is not text."""
+    if (self._text is None and self.encoding is not None and
+        self.content_buffer is not None):
+      self._text = decode_content(self.content_buffer, self.encoding)
+    return self._text
+
+  @property
+  def fingerprint(self):
+    """The fingerprint of content, or None if there is no content."""
+    if self._fingerprint is None and self.content_buffer is not None:
+      self._fingerprint = get_content_fingerprint(self.content_buffer)
+    return self._fingerprint
+
+  def get(self, key, default=None):
+    """Get the attribute by name like a dict of result."""
+    if key in _FETCH_RESULT_PROPERTIES:
+      return getattr(self, key)
+    if key.startswith("_") or key not in self.__slots__:
+      return default
+    return getattr(self, key)
+
+  def __getitem__(self, key):
+    if key in _FETCH_RESULT_PROPERTIES:
+      return getattr(self, key)
+    if key.startswith("_") or key not in self.__slots__:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def get_header(self, name, default=None):
+    """Get the value of header, name is case-insensitive.
+
+    The lowercase copy of headers is created at the first lookup that
+    does not match the received name as is.
+    """
+    value = self.headers.get(name)
+    if value is not None:
+      return value
+    if self._lowered_headers is None:
+      self._lowered_headers = dict((k.lower(), v) for k, v in self.headers.items())
+    return self._lowered_headers.get(name.lower(), default)
+
+class RedirectCache(object):
+  """Cache of permanent redirects, that is local to the fetcher.
+
+  Subclass can override get(), put() and prefetch() to share the
+  redirects across fetchers.
+  """
+
+  def __init__(self, max_size=MAX_REDIRECT_CACHE_SIZE):
+    self._max_size = max_size
+    self._redirects = {}
+
+  def get(self, url):
+    """Get the location of permanent redirect of url, or None."""
+    return self._redirects.get(url)
+
+  def prefetch(self, fetch_urls):
+    """Look up the redirects of urls by a batch, before they are fetched.
+
+    The local cache has nothing to look up.
+    """
+    pass
+
+  def put(self, url, location):
+    """Store the permanent redirect from url to location."""
+    if len(self._redirects) >= self._max_size:
+      self._redirects.clear()
+    self._redirects[url] = location
+
+  def resolve(self, url, max_redirects):
+    """Follow the cached redirects of url.
+
+    Args:
+      url: url for fetch.
+      max_redirects: maximum count of redirects.
+
+    Returns:
+      list of urls of cached redirects, that is empty if url is not
+      redirected.
+    """
+    chain = []
+    location = self.get(url)
+    while (location is not None and location != url and location not in chain
+           and len(chain) < max_redirects):
+      chain.append(location)
+      location = self.get(location)
+    return chain
+
+class HostStats(object):
+  """Running statistics of responses of a host.
+
+  The limit of concurrent requests is adjusted by additive increase
+  and multiplicative decrease: it grows by one per limit successes,
+  and is halved by a transient failure. The timeout is derived from
+  the 95th percentile of recent response times. The statistics are
+  updated under a lock, as a fetcher may be shared by threads.
+
+  Attributes:
+    limit: the limit of concurrent requests, at least 1.
+    in_flight: the number of outstanding requests.
+    read_rate: exponential moving average of read rate in bytes/sec.
+  """
+  __slots__ = ("limit", "in_flight", "read_rate", "_max_limit", "_latencies",
+               "_lock")
+
+  def __init__(self, max_limit):
+    self._max_limit = max_limit
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=HOST_LATENCY_SAMPLES)
+    self.limit = min(INITIAL_HOST_CONCURRENCY, max_limit)
+    self.in_flight = 0
+    self.read_rate = None
+
+  def can_start(self):
+    """Returns True if a request to the host can be started."""
+    return self.in_flight < int(self.limit)
+
+  def start(self):
+    """Record the start of a request to the host."""
+    with self._lock:
+      self.in_flight += 1
+
+  def finish(self):
+    """Record the end of a request to the host, whatever the outcome."""
+    with self._lock:
+      self.in_flight -= 1
+
+  def record_success(self, latency, size):
+    """Record the response time and size of successful fetch."""
+    read_rate = size / max(latency, 0.001)
+    with self._lock:
+      self._latencies.append(latency)
+      if self.read_rate is None:
+        self.read_rate = read_rate
+      else:
+        self.read_rate += READ_RATE_WEIGHT * (read_rate - self.read_rate)
+      self.limit = min(self._max_limit, self.limit + 1.0 / self.limit)
+
+  def record_failure(self):
+    """Record the transient failure, like timeout or 503."""
+    with self._lock:
+      self.limit = max(1.0, self.limit * HOST_CONCURRENCY_DECREASE)
+
+  def get_timeout(self, request_timeout):
+    """Get the timeout of request to the host.
+
+    Args:
+      request_timeout: the timeout of fetcher policy in seconds,
+        that is used until enough responses are recorded.
+
+    Returns:
+      the timeout in seconds, that is at most request_timeout.
+    """
+    with self._lock:
+      latencies = sorted(self._latencies)
+    if len(latencies) < MIN_HOST_LATENCY_SAMPLES:
+      return request_timeout
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return min(request_timeout, max(MIN_HOST_TIMEOUT, p95 * HOST_TIMEOUT_FACTOR))
+
+class _FetchState(object):
+  """Holds the state of fetch of a url across redirects.
+
+  probe is True while the rpc is the HEAD request of probe, and
+  probe_pattern is the url pattern of probe cache, or None if the
+  result of probe is not cached.
+  """
+  __slots__ = ("fetch_url", "current_url", "redirects",
+               "conditional_headers", "read_start_time", "rpc",
+               "probe", "probe_pattern")
+
+  def __init__(self, fetch_url, redirects, conditional_headers, read_start_time):
+    self.fetch_url = fetch_url
+    self.redirects = redirects
+    self.current_url = redirects[-1] if redirects else fetch_url
+    self.conditional_headers = conditional_headers
+    self.read_start_time = read_start_time
+    self.rpc = None
+    self.probe = False
+    self.probe_pattern = None
+
 class FetcherBase(object):
   """Abstract base class for fetchers"""
   
@@ -80,6 +431,146 @@ def _create_headers(fetcher_policy):
              "Accept-Encoding": DEFAULT_ACCEPT_ENCODING,
              "Accept": DEFAULT_ACCEPT}
   
+class CompiledFetcherPolicy(object):
+  """Fetcher policy compiled for fetches.
+
+  The values of FetcherPolicyInfo are converted once to the types
+  used by fetchers, and the instance is immutable, so that it can be
+  shared by all fetches of a shard.
+
+  Attributes:
+    agent_name: agent_name for fetcher job.
+    headers: dict of HTTP headers of request.
+    valid_mime_types: frozenset of valid mime types,
+      all mime types are valid if it is empty.
+    max_content_sizes: dict of mime type to max content size.
+    default_max_content_size: max content size of other mime types.
+    min_response_rate: minimum response rate in bytes/sec.
+    request_timeout: timeout of request in seconds.
+    crawl_delay: crawl delay in seconds.
+    crawl_end_time: crawl duration in seconds,
+      None if the crawl has no deadline.
+    max_redirects: maximum count of redirects.
+    redirect_mode: redirect mode of configuration.
+    follow_redirects: True if redirect_mode is FOLLOW_ALL.
+    max_fetch_attempts: maximum count of fetch of a url.
+    retry_base_delay: delay before first retry in seconds.
+    max_retry_delay: maximum delay before retry in seconds.
+    robots_cache_ttl: maximum time to live of cached robots.txt in seconds.
+    robots_failure_ttl: time to live of robots.txt failed to fetch in seconds.
+    fetch_engine: fetch engine of configuration, that is used by create_fetcher.
+  """
+  __slots__ = ("agent_name", "headers", "valid_mime_types",
+               "max_content_sizes", "default_max_content_size",
+               "min_response_rate", "request_timeout", "crawl_delay",
+               "crawl_end_time", "max_redirects", "redirect_mode",
+               "follow_redirects", "max_fetch_attempts", "retry_base_delay",
+               "max_retry_delay", "robots_cache_ttl", "robots_failure_ttl",
+               "fetch_engine")
+
+  def __init__(self, fetcher_policy):
+    """Initializes a CompiledFetcherPolicy class.
+
+    Args:
+      fetcher_policy: FetcherPolicyInfo of fetcher_policy.yaml.
+    """
+    max_content_sizes = {}
+    for content_size in fetcher_policy.max_content_size or []:
+      max_content_sizes[content_size.content_type] = int(content_size.size)
+    default_max_content_size = max_content_sizes.pop("default",
+        configuration.DEFAULT_MAX_CONTENT_SIZE)
+    valid_mime_types = frozenset(mime_type.strip().lower() for mime_type
+        in fetcher_policy.valid_mime_types.split(",") if mime_type.strip())
+    crawl_end_time = int(fetcher_policy.crawl_end_time)
+    if crawl_end_time == configuration.NO_CRAWL_END_TIME:
+      crawl_end_time = None
+    else:
+      crawl_end_time = crawl_end_time / 1000.0
+    values = {
+      "agent_name": fetcher_policy.agent_name,
+      "headers": _create_headers(fetcher_policy),
+      "valid_mime_types": valid_mime_types,
+      "max_content_sizes": max_content_sizes,
+      "default_max_content_size": default_max_content_size,
+      "min_response_rate": int(fetcher_policy.min_response_rate),
+      #request_timeout, crawl_delay and crawl_end_time of fetcher_policy.yaml
+      #are milliseconds.
+      "request_timeout": int(fetcher_policy.request_timeout) / 1000.0,
+      "crawl_delay": int(fetcher_policy.crawl_delay) / 1000.0,
+      "crawl_end_time": crawl_end_time,
+      "max_redirects": int(fetcher_policy.max_redirects),
+      "redirect_mode": fetcher_policy.redirect_mode,
+      "follow_redirects": fetcher_policy.redirect_mode == configuration.FOLLOW_ALL,
+      "max_fetch_attempts": int(fetcher_policy.max_fetch_attempts or
+                                configuration.DEFAULT_MAX_FETCH_ATTEMPTS),
+      "retry_base_delay": configuration.RETRY_BASE_DELAY / 1000.0,
+      "max_retry_delay": configuration.MAX_RETRY_DELAY / 1000.0,
+      "robots_cache_ttl": int(fetcher_policy.robots_cache_ttl or
+                              configuration.DEFAULT_ROBOTS_CACHE_TTL) / 1000.0,
+      "robots_failure_ttl": configuration.ROBOTS_FAILURE_TTL / 1000.0,
+      "fetch_engine": (fetcher_policy.fetch_engine or
+                       configuration.FETCH_ENGINE_URLFETCH),
+    }
+    for name, value in values.items():
+      object.__setattr__(self, name, value)
+
+  def __setattr__(self, name, value):
+    raise AttributeError("CompiledFetcherPolicy is immutable")
+
+  def get_max_content_size(self, mime_type):
+    """Get the max content-size of mime_type."""
+    return self.max_content_sizes.get(mime_type, self.default_max_content_size)
+
+  def is_valid_mime_type(self, mime_type):
+    """Check if mime_type is allowed, unknown mime type is allowed."""
+    return (not mime_type or not self.valid_mime_types
+            or mime_type in self.valid_mime_types)
+
+def compile_fetcher_policy(fetcher_policy):
+  """Compile FetcherPolicyInfo to CompiledFetcherPolicy.
+
+  Args:
+    fetcher_policy: FetcherPolicyInfo or CompiledFetcherPolicy.
+
+  Returns:
+    CompiledFetcherPolicy, fetcher_policy itself if it is compiled already.
+  """
+  if fetcher_policy is None or isinstance(fetcher_policy, CompiledFetcherPolicy):
+    return fetcher_policy
+  return CompiledFetcherPolicy(fetcher_policy)
+
+def create_conditional_headers(http_headers):
+  """Create headers of conditional request from previous response headers.
+
+  Args:
+    http_headers: dict of HTTP headers of previous response.
+
+  Returns:
+    dict of If-None-Match and If-Modified-Since headers,
+    that is empty if previous response has no validators.
+  """
+  headers = {}
+  if not http_headers:
+    return headers
+  lowered_headers = dict((k.lower(), v) for k, v in http_headers.items())
+  etag = lowered_headers.get("etag")
+  if etag:
+    headers["If-None-Match"] = etag
+  last_modified = lowered_headers.get("last-modified")
+  if last_modified:
+    headers["If-Modified-Since"] = last_modified
+  return headers
+
+def _find_header(headers, name):
+  """Find the value of header, name is case-insensitive."""
+  value = headers.get(name)
+  if value is None:
+    name = name.lower()
+    for k, v in headers.items():
+      if k.lower() == name:
+        return v
+  return value
+
 def _get_mime_type(content_type):
   """Parse mime type.
   
@@ -102,146 +593,1526 @@ def _get_mime_type(content_type):
   mime_type = "/".join(fields)
   return mime_type
   
-def _get_max_content_size(mime_type, fetcher_policy):
-  """Get the max content-size of mime_type from fetcher_policy """
-  content_sizes = fetcher_policy.max_content_size
-  size = _get_content_size(content_sizes, mime_type)
-  if not size:
-    size = _get_content_size(content_sizes, "default")
-  return int(size)
-
-def _get_content_size(configured_content_sizes, content_type):
-  """Get content size by content type. 
-    If not set contents size by content type 
-    returns default value at configuration.DEFAULT_MAX_CONTENT_SIZE """
-  size = 0
-  if len(configured_content_sizes)>0:
-    for content_size in configured_content_sizes:
-      if content_size.content_type == content_type:
-        size = content_size.size
-  if content_type == "default" and not size:
-    size = configuration.DEFAULT_MAX_CONTENT_SIZE
-    
-  return size
+def parse_retry_after(retry_after, now=None):
+  """Parse the value of Retry-After header.
 
-class SimpleHttpFetcher(FetcherBase):
-  """To fetch the web pages."""
+  Args:
+    retry_after: the value of Retry-After, that is seconds or HTTP-date.
+    now: the current time in seconds, time.time() is used if it is None.
+
+  Returns:
+    the seconds to wait, or None if retry_after is None or invalid.
+  """
+  if retry_after is None:
+    return None
+  retry_after = str(retry_after).strip()
+  if retry_after.isdigit():
+    return float(retry_after)
+  parsed_date = email.utils.parsedate_tz(retry_after)
+  if parsed_date is None:
+    return None
+  if now is None:
+    now = time.time()
+  return max(0.0, float(email.utils.mktime_tz(parsed_date) - now))
+
+def is_retryable_error(error):
+  """Returns True if the fetch failed by transient error.
+
+  The errors of HTTP status in RETRYABLE_STATUSES, and the errors of
+  network like DNS failure, refused connection and timeout are retryable.
+  """
+  return isinstance(error, (errors.RetryableFetchError,
+                            urlfetch.DownloadError,
+                            httplib.HTTPException,
+                            socket.error))
+
+def is_connection_error(error):
+  """Returns True if the fetch failed without response of the host,
+  like DNS failure, refused connection and timeout.
+  """
+  if isinstance(error, errors.DeferredFetchError):
+    #The host was not requested.
+    return False
+  if isinstance(error, errors.RetryableFetchError):
+    return error.status_code is None
+  return isinstance(error, (urlfetch.DownloadError,
+                            httplib.HTTPException,
+                            socket.error))
+
+def get_retry_delay(fetcher_policy, attempts, retry_after=None, random=random.random):
+  """Get the delay before next attempt of fetch.
+
+  The delay is exponential backoff with jitter, that is between
+  half and full of retry_base_delay * 2^(attempts-1), and is not shorter
+  than retry_after. The delay is at most max_retry_delay.
+
+  Args:
+    fetcher_policy: CompiledFetcherPolicy.
+    attempts: count of failed attempts.
+    retry_after: seconds of Retry-After header, or None.
+    random: function returns random float in [0.0, 1.0).
+
+  Returns:
+    the delay in seconds.
+  """
+  max_delay = fetcher_policy.max_retry_delay
+  delay = min(max_delay, fetcher_policy.retry_base_delay * (2 ** (attempts - 1)))
+  delay = delay / 2.0 + random() * delay / 2.0
+  if retry_after is not None:
+    delay = max(delay, min(retry_after, max_delay))
+  return delay
+
+def _lookup_charset(charset):
+  """Returns the normalized name of charset, or None if it is unknown."""
+  try:
+    return codecs.lookup(charset).name
+  except LookupError:
+    return None
+
+def detect_charset(content, content_type=None):
+  """Detect the charset of text content.
+
+  The charset is taken from, in order of priority, the charset parameter
+  of Content-Type, the byte order mark, and the <meta> declaration within
+  the first CHARSET_SNIFF_SIZE bytes of content.
+
+  Args:
+    content: the content of response as str or buffer.
+    content_type: the value of Content-Type header.
+
+  Returns:
+    the name of charset. If it is not declared, returns DEFAULT_CONTENT_CHARSET,
+    or FALLBACK_CHARSET if the first CHARSET_VALIDATE_SIZE bytes of content
+    are not valid in DEFAULT_CONTENT_CHARSET.
+  """
+  if content_type:
+    match = _CHARSET_PARAM_RE.search(content_type)
+    if match:
+      charset = _lookup_charset(match.group(1))
+      if charset:
+        return charset
+  for bom, charset in _BOMS:
+    if content[:len(bom)] == bom:
+      return charset
+  match = _META_CHARSET_RE.search(content[:CHARSET_SNIFF_SIZE])
+  if match:
+    charset = _lookup_charset(match.group(1))
+    if charset:
+      return charset
+  #The prefix may end in the middle of a character, as the content
+  #may be truncated, so the incomplete character at the end is allowed.
+  decoder = codecs.getincrementaldecoder(DEFAULT_CONTENT_CHARSET)()
+  try:
+    decoder.decode(content[:CHARSET_VALIDATE_SIZE], False)
+    return DEFAULT_CONTENT_CHARSET
+  except UnicodeDecodeError:
+    return FALLBACK_CHARSET
+
+def get_content_fingerprint(content):
+  """Get the fingerprint of content, that is same for identical bodies.
+
+  Args:
+    content: the content of response as str or buffer.
+
+  Returns:
+    the hex digest of content.
+  """
+  return hashlib.md5(content).hexdigest()
+
+def decode_content(content, charset):
+  """Decode content by charset, the byte order mark is removed.
+
+  Undecodable bytes, include the tail of multibyte sequence cut off
+  by truncation, are replaced with U+FFFD.
+  The content may be str or buffer, that is decoded without copy.
+  """
+  for bom, bom_charset in _BOMS:
+    if content[:len(bom)] == bom:
+      if _lookup_charset(bom_charset) == _lookup_charset(charset):
+        content = buffer(content, len(bom))
+      break
+  return unicode(content, charset, "replace")
+
+def _should_probe(fetch_url, probe_mode):
+  """Returns True if fetch_url should be probed by the probe mode."""
+  if probe_mode == PROBE_NONE:
+    return False
+  guessed_type = mimetypes.guess_type(urlparse.urlparse(fetch_url).path)[0]
+  if guessed_type is None:
+    return probe_mode == PROBE_ALL
+  return not (guessed_type in TEXT_MIME_TYPES or guessed_type.startswith("text/"))
+
+def _get_probe_pattern(fetch_url):
+  """Get the url pattern of probe cache.
+
+  The pattern consists of scheme, host, directory and extension of path,
+  the urls of same pattern are expected to serve same content type.
+  The urls without extension, or with extension of dynamic page, have
+  no pattern, because they may serve any content type.
+
+  Args:
+    fetch_url: url for fetch.
+
+  Returns:
+    the tuple of url pattern, or None if the probe of fetch_url
+    is not cached.
+  """
+  parsed_uri = urlparse.urlparse(fetch_url)
+  directory, file_name = posixpath.split(parsed_uri.path)
+  extension = posixpath.splitext(file_name)[1].lower()
+  if not extension or extension in DYNAMIC_EXTENSIONS:
+    return None
+  return (parsed_uri.scheme, parsed_uri.netloc.lower(), directory, extension)
+
+def _decompress(content, encoding, max_content_size):
+  """Decompress the content, stops at max_content_size bytes.
+
+  The decompressed data never exceeds max_content_size + 1 bytes,
+  even if the content is highly compressed.
+
+  Args:
+    content: compressed content of response.
+    encoding: content-encoding of response.
+    max_content_size: maximum size of decompressed content.
+
+  Returns:
+    the tuple of decompressed content and truncated flag,
+    the truncated content is a buffer over the decompressed data.
+  """
+  wbits = DECOMPRESS_WBITS[encoding]
+  try:
+    decompressed = zlib.decompressobj(wbits).decompress(content,
+                                                        max_content_size + 1)
+  except zlib.error:
+    if encoding != "deflate":
+      raise
+    #Some servers send raw deflate stream without zlib header.
+    decompressed = zlib.decompressobj(-zlib.MAX_WBITS).decompress(content,
+                                                                  max_content_size + 1)
+  if len(decompressed) > max_content_size:
+    return buffer(decompressed, 0, max_content_size), True
+  return decompressed, False
+
+class PolicyFetcherBase(FetcherBase):
+  """Base class for fetchers, that apply the fetcher policy.
+
+  Subclass sends the requests, and the responses are checked by
+  _next_location() and _handle_result(), so that all fetchers
+  follow redirects and check the content with the same policy.
+  """
+
+  def __init__(self, fetcher_policy=None, redirect_cache=None):
+    """Initializes a PolicyFetcherBase class.
 
-  def __init__(self, max_shards, fetcher_policy=None):
-    """Initializes a SimpleHttpFetcher class.
-  
     Args:
-      max_shards: number of shard for web crawl process.
-      fetcher_policy: definition of policy for fetches.
-    
-    Returns:
-      The result of fetches.
+      fetcher_policy: definition of policy for fetches,
+        FetcherPolicyInfo or CompiledFetcherPolicy.
+      redirect_cache: RedirectCache of permanent redirects, the cache
+        local to this fetcher is used if it is None.
     """
-    self._max_shards = max_shards
-    self._fetcher_policy = fetcher_policy
+    self._fetcher_policy = compile_fetcher_policy(fetcher_policy)
+    if redirect_cache is None:
+      redirect_cache = RedirectCache()
+    self._redirect_cache = redirect_cache
     self._time = time.time
+    self._sleep = time.sleep
+    #Incremented by abort(), the fetches started before are dropped.
+    self._abort_count = 0
+    #host to HostStats.
+    self._host_stats = {}
+    self._host_stats_lock = threading.Lock()
 
-  def get(self, fetch_url):
-    """To do HTTP GET request.
+  def abort(self):
+    """Abort the fetches in progress.
+
+    The outstanding requests of get_many() are dropped without waiting
+    for the responses. get() does not interrupt the request in progress,
+    but stops after the wait of the probe and before following redirects.
+    get() does not retry, the retry of a failed fetch is scheduled by
+    the caller. The fetches started after abort() are not affected.
+    """
+    self._abort_count += 1
+
+  def _check_aborted(self, abort_count, fetch_url):
+    """Raise AbortedFetchError if abort() was called since abort_count."""
+    if self._abort_count != abort_count:
+      raise errors.AbortedFetchError("%s Fetch is aborted" % fetch_url)
+
+  def get_host_stats(self, url, max_limit=DEFAULT_MAX_IN_FLIGHT):
+    """Get the HostStats of the host of url."""
+    host = urlparse.urlsplit(url).netloc.lower()
+    stats = self._host_stats.get(host)
+    if stats is None:
+      with self._host_stats_lock:
+        stats = self._host_stats.get(host)
+        if stats is None:
+          if len(self._host_stats) >= MAX_HOST_STATS_SIZE:
+            self._host_stats.clear()
+          stats = HostStats(max_limit)
+          self._host_stats[host] = stats
+    return stats
+
+  def _get_timeout(self, url):
+    """Get the timeout of request to url in seconds."""
+    return self.get_host_stats(url).get_timeout(self._fetcher_policy.request_timeout)
+
+  def _record_error(self, url, error):
+    """Record the failure of host, if the error is transient."""
+    if is_retryable_error(error):
+      self.get_host_stats(url).record_failure()
+
+  def _complete(self, state, result):
+    """Check the response by _handle_result, and record the statistics."""
+    try:
+      fetch_result = self._handle_result(state, result)
+    except Exception as e:
+      self._record_error(state.current_url, e)
+      raise
+    self.get_host_stats(state.current_url).record_success(
+        self._time() - state.read_start_time, len(result.content or ""))
+    return fetch_result
+
+  def _next_location(self, state, result):
+    """Get the location of redirect, and move state to the location.
 
     Args:
-      fetch_url: url for fetch.
-      
+      state: _FetchState of the fetch.
+      result: the response, that has status_code and headers.
+
     Returns:
-      Return results of HTTP GET request. 
-    
+      The absolute url of location, or None if the response
+      is not redirected.
+
     Raises:
-      HttpFetchError: if HTTP Status is errored.
-      AbortedFetchException: if Content-Type is not valid.
-      RedirectError: if redirect_mode is FOLLOW_NONE, and HTTP status is
-        redirected.
+      RedirectError: if redirect_mode is FOLLOW_NONE, the count of
+        redirects exceeds max_redirects, or Location is missing.
     """
-    self._read_start_time = self._time()
-    is_follow_redirects = self._fetcher_policy.redirect_mode == configuration.FOLLOW_ALL
-    result = urlfetch.fetch(url = fetch_url,
-                            headers = _create_headers(self._fetcher_policy),
-                            follow_redirects = is_follow_redirects,
-                            deadline=float(self._fetcher_policy.request_timeout))
-    headers = result.headers
-    #Convert to lowercase
-    for k, v in headers.items():
-      headers[k.lower()] = v
+    status_code = result.status_code
+    if status_code not in REDIRECT_STATUSES:
+      return None
+    if not self._fetcher_policy.follow_redirects:
+      raise errors.RedirectError("RedirectMode disallowed redirect: %s, %s" % (self._fetcher_policy.redirect_mode,
+                                  status_code))
+    location = _find_header(result.headers, "location")
+    if not location:
+      raise errors.RedirectError("%s Redirect without Location: %s" % (state.current_url,
+                                  status_code))
+    location = urlparse.urljoin(state.current_url, location)
+    if status_code in PERMANENT_REDIRECT_STATUSES:
+      self._redirect_cache.put(state.current_url, location)
+    if len(state.redirects) >= self._fetcher_policy.max_redirects:
+      raise errors.RedirectError("%s Too many redirects: %s" % (state.fetch_url,
+                                  state.redirects))
+    logging.debug("Redirected %s to %s" % (state.current_url, location))
+    state.redirects.append(location)
+    state.current_url = location
+    return location
 
+  def _handle_result(self, state, result):
+    """Check the response by fetcher policy.
+
+    Args:
+      state: _FetchState of the fetch.
+      result: the response, that has status_code, headers, content
+        and content_was_truncated like the response of urlfetch.
+
+    Returns:
+      Return results of HTTP GET request.
+      If the status is 304 Not Modified, the content is None.
+    """
+    fetch_url = state.fetch_url
+    read_start_time = state.read_start_time
     status_code = result.status_code
+    fetch_result = FetchResult(fetch_url, state.current_url, status_code, result.headers)
+    fetch_result.redirects = state.redirects
+    get_header = fetch_result.get_header
     logging.debug("status code: %d Content-Length: %s, Location: %s" % (status_code,
-                  headers.get("content-length", ""),
-                  headers.get("location", "")))
+                  get_header("content-length", ""),
+                  get_header("location", "")))
+
+    #Not modified since previous fetch, there is no content.
+    if status_code == httplib.NOT_MODIFIED:
+      fetch_result.mime_type = _get_mime_type(get_header("content-type"))
+      fetch_result.time = self._time() - read_start_time
+      return fetch_result
     
     #Fetch error was occurred.
-    #If redirect_mode is FOLLOW_NONE, and HTTP status is redirected raises RedirectError.
-    #If follow_redirects parameter set true, the service will follow the redirect.
-    if status_code < 200 and status_code >= 300:
-      raise errors.HttpFetchError("%s error fetching %s, %s" % (fetch_url,
-                                  status_code,
-                                  headers))
-    elif status_code in REDIRECT_STATUSES and not is_follow_redirects:
-      raise errors.RedirectError("RedirectMode disallowed redirect: %s, %s" % (self._fetcher_policy.redirect_mode,
-                                  status_code))
+    if status_code < 200 or status_code >= 300:
+      message = "%s error fetching %s, %s" % (fetch_url, status_code, result.headers)
+      if status_code in RETRYABLE_STATUSES:
+        raise errors.RetryableFetchError(message, status_code,
+            parse_retry_after(get_header("retry-after")))
+      raise errors.HttpFetchError(message, status_code)
       
-    fetched_url = result.final_url
-    if fetched_url is None:
-      fetched_url = fetch_url
     #Get the mime_type and Check if we should abort due to mime-type filtering.  
-    mime_type = _get_mime_type(headers.get("content-type"))
-    mime_types = (self._fetcher_policy.valid_mime_types).split(",")
-    if mime_types and len(mime_types):
-      if mime_type and mime_type not in mime_types:
-        raise errors.AbortedFetchError("%s Invalid mime-type: %s" % (fetch_url,
-                                            mime_type ))
+    mime_type = _get_mime_type(get_header("content-type"))
+    if not self._fetcher_policy.is_valid_mime_type(mime_type):
+      raise errors.AbortedFetchError("%s Invalid mime-type: %s" % (fetch_url,
+                                          mime_type ))
     
-    #encoding if accept gzip
-    content = result.content
-    encoding = headers.get("content-encoding")
-    if encoding == "gzip" or encoding == "x-gzip":
-      f = StringIO.StringIO(content)
-      c = gzip.GzipFile(fileobj=f)
-      content = c.read()
-
     #Figure out how much data we want to try to fetch.
-    max_content_size = _get_max_content_size(mime_type, self._fetcher_policy)
+    max_content_size = self._fetcher_policy.get_max_content_size(mime_type)
     target_length = max_content_size
     truncated = False
-    content_length = headers.get("content-length")
-    if content_length is not None:
+    content = result.content
+    content_length = get_header("content-length")
+    encoding = (get_header("content-encoding") or "").strip().lower()
+    if encoding in DECOMPRESS_WBITS:
+      #Content-Length is the compressed size, so use the decompressed size.
+      #The compressed content may also be cut off before it was received.
+      content, truncated = _decompress(content, encoding, max_content_size)
+      truncated = truncated or result.content_was_truncated
+      target_length = len(content)
+    elif content_length is not None:
       if int(content_length) > target_length or result.content_was_truncated:
         truncated = True
       else:
         target_length = int(content_length)
-    else:
-      content_length = "0"
+    elif result.content_was_truncated:
+      truncated = True
 
     #Assume read time is at least one millisecond
-    total_read_time = max(1, self._time() - self._read_start_time)
+    total_read_time = max(0.001, self._time() - read_start_time)
     #Abort if server response is slow.
-    min_response_rate = int(self._fetcher_policy.min_response_rate)
-    read_rate = int(content_length) / total_read_time
+    #The rate is of bytes actually received, that may be compressed.
+    min_response_rate = self._fetcher_policy.min_response_rate
+    read_rate = len(result.content or "") / total_read_time
     if read_rate < min_response_rate:
       raise errors.AbortedFetchError("%s Slow response rate of %s bytes/sec" % (fetch_url,
                                           read_rate))
     logging.debug("FetchedURL:"+ fetch_url)
     #Get the content from response. 
-    #Truncate content if target content size is lager than max content size
-    content = content[:target_length]
+    #Truncate content if target content size is lager than max content size,
+    #the truncated content is a view of received bytes, not a copy.
+    if target_length < len(content):
+      content = buffer(content, 0, target_length)
     #Toss truncated image content.
     if mime_type and mime_type not in TEXT_MIME_TYPES:
       if truncated:
         raise errors.AbortedFetchError("%s Truncated image" % fetch_url)
 
-    return {"url": fetch_url,
-            "fetched_url": fetched_url,
-            "time": self._time() - self._read_start_time,
-            "content": content,
-            "content_length": int(target_length),
-            "mime_type": mime_type,
-            "read_rate": int(read_rate),
-            "headers": result.headers}
+    fetch_result.time = self._time() - read_start_time
+    fetch_result.content_buffer = content
+    fetch_result.content_length = int(target_length)
+    fetch_result.mime_type = mime_type
+    fetch_result.read_rate = int(read_rate)
+    if mime_type is None or mime_type in TEXT_MIME_TYPES or mime_type.startswith("text/"):
+      fetch_result.encoding = detect_charset(content, get_header("content-type"))
+    return fetch_result
+    
+class SimpleHttpFetcher(PolicyFetcherBase):
+  """To fetch the web pages."""
+
+  def __init__(self, max_shards, fetcher_policy=None, probe_mode=PROBE_NONE,
+               redirect_cache=None, politeness_scheduler=None):
+    """Initializes a SimpleHttpFetcher class.
+  
+    Args:
+      max_shards: number of shard for web crawl process.
+      fetcher_policy: definition of policy for fetches,
+        FetcherPolicyInfo or CompiledFetcherPolicy.
+      probe_mode: if not PROBE_NONE, urls of non-text content are probed
+        with HEAD request before fetch, and skipped if the Content-Type
+        or Content-Length is not allowed.
+      redirect_cache: RedirectCache of permanent redirects, the cache
+        local to this fetcher is used if it is None.
+      politeness_scheduler: PolitenessScheduler of hosts, if it is set,
+        the request of url and the GET request after its probe wait for
+        the next slot of host, so that a slot of host is used by one
+        request.
     
+    Returns:
+      The result of fetches.
+    """
+    PolicyFetcherBase.__init__(self, fetcher_policy, redirect_cache)
+    self._max_shards = max_shards
+    self._probe_mode = probe_mode
+    self._politeness_scheduler = politeness_scheduler
+    #url pattern to probed mime type.
+    self._probe_cache = {}
+
+  def _find_probe_pattern(self, state):
+    """Set whether the current url of state is probed with HEAD request.
+
+    The mime type of probe result is cached per url pattern,
+    so the urls of known pattern are not probed again.
+
+    Args:
+      state: _FetchState of the fetch.
+
+    Raises:
+      AbortedFetchError: if the cached mime type of pattern is not allowed.
+    """
+    fetch_url = state.current_url
+    if not _should_probe(fetch_url, self._probe_mode):
+      return
+    pattern = _get_probe_pattern(fetch_url)
+    if pattern is not None and pattern in self._probe_cache:
+      mime_type = self._probe_cache[pattern]
+      if not self._fetcher_policy.is_valid_mime_type(mime_type):
+        raise errors.AbortedFetchError("%s Invalid mime-type by probe: %s" % (fetch_url,
+                                            mime_type))
+      return
+    state.probe = True
+    state.probe_pattern = pattern
+
+  def _create_probe_rpc(self, fetch_url):
+    """Start the asynchronous HTTP HEAD request of probe.
+
+    Returns:
+      The UserRPC object of urlfetch.
+    """
+    rpc = urlfetch.create_rpc(deadline=self._get_timeout(fetch_url))
+    urlfetch.make_fetch_call(rpc, fetch_url,
+                             method=urlfetch.HEAD,
+                             headers=self._fetcher_policy.headers,
+                             follow_redirects=self._fetcher_policy.follow_redirects)
+    return rpc
+
+  def _check_probe(self, state):
+    """Check the result of probe, that is the current rpc of state.
+
+    Args:
+      state: _FetchState of the fetch.
+
+    Returns:
+      seconds to wait for the slot of host, before the GET request.
+
+    Raises:
+      AbortedFetchError: if the Content-Type or Content-Length of
+        the url is not allowed.
+      DeferredFetchError: if the GET request is deferred by
+        the crawl delay of host.
+    """
+    fetch_url = state.current_url
+    pattern = state.probe_pattern
+    state.probe = False
+    state.probe_pattern = None
+    try:
+      result = state.rpc.get_result()
+    except Exception as e:
+      logging.debug("Probe failed %s: %s" % (fetch_url, e))
+      result = None
+    #Some servers do not support HEAD, then fetch without probe.
+    if result is not None and result.status_code == httplib.OK:
+      fetch_result = FetchResult(fetch_url, fetch_url, result.status_code,
+                                 result.headers)
+      mime_type = _get_mime_type(fetch_result.get_header("content-type"))
+      if pattern is not None:
+        if len(self._probe_cache) >= MAX_PROBE_CACHE_SIZE:
+          self._probe_cache.clear()
+        self._probe_cache[pattern] = mime_type
+      if not self._fetcher_policy.is_valid_mime_type(mime_type):
+        raise errors.AbortedFetchError("%s Invalid mime-type by probe: %s" % (fetch_url,
+                                            mime_type))
+      content_length = str(fetch_result.get_header("content-length", ""))
+      if (content_length.isdigit() and mime_type not in TEXT_MIME_TYPES
+          and int(content_length) > self._fetcher_policy.get_max_content_size(mime_type)):
+        #Truncated non-text content is tossed, so it is not fetched.
+        raise errors.AbortedFetchError("%s Too large content by probe: %s" % (fetch_url,
+                                            content_length))
+    #The probe used the slot of host, the GET request waits for the next.
+    return self._reserve_slot(fetch_url)
+
+  def _reserve_slot(self, fetch_url):
+    """Reserve the next slot of host of fetch_url by politeness_scheduler.
+
+    Returns:
+      seconds to wait for the slot, 0 if politeness_scheduler is not set.
+
+    Raises:
+      DeferredFetchError: if the wait exceeds max_wait of the scheduler.
+    """
+    if self._politeness_scheduler is None:
+      return 0
+    wait_time = self._politeness_scheduler.reserve(urls.get_domain(fetch_url))
+    if wait_time > self._politeness_scheduler.max_wait:
+      raise errors.DeferredFetchError("%s Fetch is deferred by crawl delay" % fetch_url)
+    return wait_time
+
+  def _create_rpc(self, fetch_url, conditional_headers=None):
+    """Start the asynchronous HTTP GET request.
+
+    Args:
+      fetch_url: url for fetch.
+      conditional_headers: headers of conditional request.
+
+    Returns:
+      The UserRPC object of urlfetch.
+    """
+    headers = self._fetcher_policy.headers
+    if conditional_headers:
+      headers = dict(headers)
+      headers.update(conditional_headers)
+    rpc = urlfetch.create_rpc(deadline=self._get_timeout(fetch_url))
+    #Redirects are followed by _follow_redirect.
+    urlfetch.make_fetch_call(rpc, fetch_url,
+                             headers = headers,
+                             follow_redirects = False)
+    return rpc
+
+  def _wait_any(self, rpcs):
+    """Wait until one of rpcs is completed.
+
+    Returns:
+      The completed rpc.
+    """
+    return apiproxy_stub_map.UserRPC.wait_any(rpcs)
+
+  def _cancel_rpc(self, rpc):
+    """Drop the outstanding rpc, the rpc of urlfetch can not be
+    cancelled, so its response is ignored.
+    """
+    pass
+
+  def _create_state(self, fetch_url, conditional_headers=None):
+    """Create the state of fetch of url, cached permanent redirects
+    are skipped.
+
+    Returns:
+      _FetchState of the fetch, whose probe is set if the url
+      is probed.
+    """
+    redirects = self._redirect_cache.resolve(fetch_url,
+                                             self._fetcher_policy.max_redirects)
+    state = _FetchState(fetch_url, redirects, conditional_headers, None)
+    self._find_probe_pattern(state)
+    return state
+
+  def _start_fetch(self, state):
+    """Start the first request of state.
+
+    The HEAD request of probe is started instead of the GET request,
+    if the url is probed.
+    """
+    if state.probe:
+      state.rpc = self._create_probe_rpc(state.current_url)
+    else:
+      self._start_get(state)
+
+  def _start_get(self, state):
+    """Start the GET request of the current url of state."""
+    state.read_start_time = self._time()
+    state.rpc = self._create_rpc(state.current_url, state.conditional_headers)
+
+  def _follow_redirect(self, state, result):
+    """Follow the redirect of response, if the response is redirected.
+
+    Args:
+      state: _FetchState of the fetch.
+      result: the response of urlfetch.
+
+    Returns:
+      True if the request to the location was started,
+      False if the response is not redirected.
+
+    Raises:
+      RedirectError: if redirect_mode is FOLLOW_NONE, the count of
+        redirects exceeds max_redirects, or Location is missing.
+    """
+    location = self._next_location(state, result)
+    if location is None:
+      return False
+    state.rpc = self._create_rpc(location, state.conditional_headers)
+    return True
+
+  def get(self, fetch_url, conditional_headers=None):
+    """To do HTTP GET request.
+
+    Args:
+      fetch_url: url for fetch.
+      conditional_headers: headers of conditional request,
+        that created by create_conditional_headers.
+      
+    Returns:
+      Return results of HTTP GET request. 
+    
+    Raises:
+      HttpFetchError: if HTTP Status is errored.
+      RetryableFetchError: if HTTP Status is transient error.
+      AbortedFetchException: if Content-Type is not valid,
+        or the fetch is aborted.
+      RedirectError: if redirect_mode is FOLLOW_NONE, and HTTP status is
+        redirected.
+      DeferredFetchError: if the request is deferred by the crawl delay
+        of host.
+    """
+    abort_count = self._abort_count
+    state = self._create_state(fetch_url, conditional_headers)
+    wait_time = self._reserve_slot(state.current_url)
+    if wait_time > 0:
+      self._sleep(wait_time)
+      self._check_aborted(abort_count, fetch_url)
+    self._start_fetch(state)
+    if state.probe:
+      wait_time = self._check_probe(state)
+      if wait_time > 0:
+        self._sleep(wait_time)
+      self._check_aborted(abort_count, fetch_url)
+      self._start_get(state)
+    try:
+      result = state.rpc.get_result()
+      while self._follow_redirect(state, result):
+        self._check_aborted(abort_count, fetch_url)
+        result = state.rpc.get_result()
+    except Exception as e:
+      self._record_error(state.current_url, e)
+      raise
+    return self._complete(state, result)
+
+  def get_many(self, fetch_urls, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               conditional_headers=None):
+    """To do HTTP GET requests concurrently.
+
+    At most max_in_flight requests are outstanding at the same time,
+    and the requests per host are limited by HostStats of the host,
+    the results are yielded in order of completion, and each of them
+    is checked with the same policy as get(). The request of url and
+    the GET request after its probe wait for the slot of host without
+    blocking the other requests, and the url whose slot is later than
+    max_wait of politeness_scheduler is yielded with DeferredFetchError.
+    If abort() is called, the outstanding requests are dropped and no
+    more result is yielded.
+
+    Args:
+      fetch_urls: iterable of urls for fetch.
+      max_in_flight: maximum number of outstanding requests.
+      conditional_headers: dict of url to headers of conditional request.
+
+    Returns:
+      Yields (url, result, error) tuples, error is the exception raised
+      by the fetch of url and result is None in that case.
+    """
+    url_iter = iter(fetch_urls)
+    if conditional_headers is None:
+      conditional_headers = {}
+    abort_count = self._abort_count
+    #Outstanding rpcs to tuple of _FetchState and HostStats of the request.
+    in_flight = {}
+    #urls waiting for the host to be under its limit of concurrent requests.
+    waiting = collections.deque()
+    #Heap of the start time and _FetchState of requests,
+    #that wait for the slot of host.
+    delayed = []
+    max_waiting = max_in_flight * 10
+    has_next = True
+    try:
+      while True:
+        if self._abort_count != abort_count:
+          logging.info("Fetch is aborted, %d requests are dropped" % len(in_flight))
+          return
+        while delayed and delayed[0][0] <= self._time():
+          state = heapq.heappop(delayed)[1]
+          try:
+            self._start_fetch(state)
+          except Exception as e:
+            yield (state.fetch_url, None, e)
+            continue
+          stats = self.get_host_stats(state.current_url, max_in_flight)
+          stats.start()
+          in_flight[state.rpc] = (state, stats)
+        while len(in_flight) < max_in_flight:
+          fetch_url = None
+          for i in xrange(len(waiting)):
+            if self.get_host_stats(waiting[0], max_in_flight).can_start():
+              fetch_url = waiting.popleft()
+              break
+            waiting.rotate(-1)
+          while fetch_url is None and has_next and len(waiting) < max_waiting:
+            try:
+              next_url = url_iter.next()
+            except StopIteration:
+              has_next = False
+              break
+            if self.get_host_stats(next_url, max_in_flight).can_start():
+              fetch_url = next_url
+            else:
+              waiting.append(next_url)
+          if fetch_url is None and not in_flight and waiting:
+            fetch_url = waiting.popleft()
+          if fetch_url is None:
+            break
+          try:
+            state = self._create_state(fetch_url,
+                                       conditional_headers.get(fetch_url))
+            wait_time = self._reserve_slot(state.current_url)
+            if wait_time > 0:
+              heapq.heappush(delayed, (self._time() + wait_time, state))
+              continue
+            self._start_fetch(state)
+          except Exception as e:
+            yield (fetch_url, None, e)
+            continue
+          stats = self.get_host_stats(state.current_url, max_in_flight)
+          stats.start()
+          in_flight[state.rpc] = (state, stats)
+        if not in_flight:
+          if not delayed:
+            break
+          self._sleep(max(0, delayed[0][0] - self._time()))
+          continue
+
+        rpc = self._wait_any(in_flight.keys())
+        state, stats = in_flight.pop(rpc)
+        stats.finish()
+        try:
+          if state.probe:
+            wait_time = self._check_probe(state)
+            if wait_time > 0:
+              heapq.heappush(delayed, (self._time() + wait_time, state))
+              continue
+            self._start_get(state)
+            stats.start()
+            in_flight[state.rpc] = (state, stats)
+            continue
+          try:
+            result = rpc.get_result()
+            redirected = self._follow_redirect(state, result)
+          except Exception as e:
+            self._record_error(state.current_url, e)
+            raise
+          if redirected:
+            stats = self.get_host_stats(state.current_url, max_in_flight)
+            stats.start()
+            in_flight[state.rpc] = (state, stats)
+            continue
+          fetch_result = self._complete(state, result)
+        except Exception as e:
+          yield (state.fetch_url, None, e)
+        else:
+          yield (state.fetch_url, fetch_result, None)
+    finally:
+      #The requests dropped by abort or by close of the generator
+      #are not outstanding any more.
+      for rpc, (state, stats) in in_flight.iteritems():
+        self._cancel_rpc(rpc)
+        stats.finish()
+
+class _HttpResponse(object):
+  """The response of PooledHttpFetcher, that has the attributes
+  used by PolicyFetcherBase as same as the response of urlfetch.
+  """
+  __slots__ = ("status_code", "headers", "content", "content_was_truncated")
+
+  def __init__(self, status_code, headers, content, content_was_truncated):
+    self.status_code = status_code
+    self.headers = headers
+    self.content = content
+    self.content_was_truncated = content_was_truncated
+
+def _create_ssl_context():
+  """Create the SSL context of PooledHttpFetcher.
+
+  The certificate is not validated, as same as urlfetch without
+  validate_certificate.
+  """
+  if ssl is None or not hasattr(ssl, "create_default_context"):
+    return None
+  context = ssl.create_default_context()
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+  return context
+
+def _wrap_ssl_socket(sock, host):
+  """Wrap the connected non-blocking socket by SSL, the handshake is
+  done by do_handshake() of the returned socket.
+  """
+  global _ssl_context
+  if ssl is None:
+    raise errors.HttpFetchError("SSL is not available")
+  if _ssl_context is None:
+    _ssl_context = _create_ssl_context()
+  if _ssl_context is None:
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+  return _ssl_context.wrap_socket(sock, server_hostname=host,
+                                  do_handshake_on_connect=False)
+
+_ssl_context = None
+
+def _is_ssl_eof(error):
+  """Returns True if the error is the closure of SSL connection."""
+  return (ssl is not None and isinstance(error, ssl.SSLError) and
+          error.args[0] == ssl.SSL_ERROR_ZERO_RETURN)
+
+def _would_block(error):
+  """Returns True if the error of non-blocking socket means that
+  the operation should be retried when the socket is ready.
+  """
+  if ssl is not None and isinstance(error, ssl.SSLError):
+    return error.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+  return error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class ConnectionPool(object):
+  """Pool of persistent HTTP/1.1 connections per host.
+
+  The connections are non-blocking sockets, a connection is used by
+  one request at a time, and is returned to the pool after the response
+  is read to the end. The pool is thread safe, and also caches the
+  addresses of hosts.
+  """
+
+  def __init__(self, max_idle_per_host=DEFAULT_MAX_IDLE_PER_HOST,
+               address_ttl=ADDRESS_CACHE_TTL):
+    """Initializes a ConnectionPool class.
+
+    Args:
+      max_idle_per_host: maximum number of idle connections per host,
+        the connections over this are closed when released.
+      address_ttl: seconds to reuse the resolved address of host.
+    """
+    self._max_idle_per_host = max_idle_per_host
+    self._address_ttl = address_ttl
+    #(scheme, netloc) to list of idle sockets.
+    self._idle = {}
+    #(host, port) to tuple of expiration time, family and address.
+    self._addresses = {}
+    self._lock = threading.Lock()
+
+  def resolve(self, host, port):
+    """Get the address of host.
+
+    The name resolution blocks, so the address is cached for address_ttl.
+
+    Returns:
+      Tuple of socket family and address.
+
+    Raises:
+      socket.error: if the host is not resolved.
+    """
+    now = time.time()
+    entry = self._addresses.get((host, port))
+    if entry is not None and entry[0] > now:
+      return entry[1:]
+    family, socktype, proto, canonname, address = socket.getaddrinfo(
+        host, port, 0, socket.SOCK_STREAM)[0]
+    with self._lock:
+      if len(self._addresses) >= MAX_ADDRESS_CACHE_SIZE:
+        self._addresses.clear()
+      self._addresses[(host, port)] = (now + self._address_ttl, family, address)
+    return (family, address)
+
+  def acquire(self, scheme, netloc):
+    """Get the idle connection to host.
+
+    The idle connection closed by the server is readable,
+    then it is closed and not returned.
+
+    Returns:
+      The socket of connection, or None if there is no idle connection.
+    """
+    while True:
+      with self._lock:
+        connections = self._idle.get((scheme, netloc))
+        if not connections:
+          return None
+        sock = connections.pop()
+      try:
+        readable = select.select([sock], [], [], 0)[0]
+      except (select.error, socket.error, ValueError):
+        readable = True
+      if not readable:
+        return sock
+      sock.close()
+
+  def release(self, scheme, netloc, sock):
+    """Return the connection, that the response was read to the end."""
+    with self._lock:
+      connections = self._idle.setdefault((scheme, netloc), [])
+      if len(connections) < self._max_idle_per_host:
+        connections.append(sock)
+        return
+    sock.close()
+
+  def close(self):
+    """Close all of idle connections."""
+    with self._lock:
+      idle = self._idle
+      self._idle = {}
+    for connections in idle.values():
+      for sock in connections:
+        sock.close()
+
+#Phases of _HttpRequest.
+_CONNECT, _HANDSHAKE, _SEND, _HEADERS, _BODY, _DONE = range(6)
+
+class _HttpRequest(object):
+  """HTTP/1.1 request of PooledHttpFetcher on a non-blocking socket.
+
+  The request is advanced by _EventLoop when its socket is ready,
+  and has get_result() like the rpc of urlfetch, so that the fetches
+  of PooledHttpFetcher are driven as same as SimpleHttpFetcher.
+  The body is read up to the max content size of its mime type.
+
+  Attributes:
+    deadline: the time the request fails by timeout.
+    want_write: True if the request waits for the socket to be writable,
+      otherwise it waits for the socket to be readable.
+    done: True if the result or the error is set.
+  """
+
+  def __init__(self, loop, method, url, headers, deadline,
+               get_max_content_size):
+    self._loop = loop
+    self.method = method
+    self.url = url
+    self.deadline = deadline
+    self._get_max_content_size = get_max_content_size
+    self._headers = headers
+    self.sock = None
+    self.want_write = True
+    self.done = False
+    self._phase = _CONNECT
+    self._reused = False
+    self._received = False
+    self._out = ""
+    self._buffer = ""
+    self._version = None
+    self._status_code = None
+    self._response_headers = None
+    self._body = []
+    self._size = 0
+    self._limit = 0
+    self._framing = None
+    self._remaining = None
+    self._truncated = False
+    self._result = None
+    self._error = None
+
+  def open(self, pool):
+    """Start the request with idle connection, or new connection."""
+    parsed_url = urlparse.urlsplit(self.url)
+    scheme = parsed_url.scheme.lower()
+    if scheme not in DEFAULT_HTTP_PORTS:
+      raise errors.HttpFetchError("%s Unsupported scheme: %s" % (self.url, scheme))
+    if not parsed_url.hostname:
+      raise errors.HttpFetchError("%s Invalid url" % self.url)
+    self._pool = pool
+    self._scheme = scheme
+    self._netloc = parsed_url.netloc
+    self._host = parsed_url.hostname
+    self._port = parsed_url.port or DEFAULT_HTTP_PORTS[scheme]
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+      path = "%s?%s" % (path, parsed_url.query)
+    lines = ["%s %s HTTP/1.1" % (self.method, path), "Host: %s" % self._netloc]
+    for name, value in self._headers.items():
+      lines.append("%s: %s" % (name, value))
+    self._request_data = "\r\n".join(lines) + "\r\n\r\n"
+    self.sock = pool.acquire(scheme, self._netloc)
+    if self.sock is not None:
+      self._reused = True
+      self._start_send()
+    else:
+      self._connect()
+
+  def _connect(self):
+    """Start the connection to host."""
+    family, address = self._pool.resolve(self._host, self._port)
+    self.sock = socket.socket(family, socket.SOCK_STREAM)
+    self.sock.setblocking(0)
+    error = self.sock.connect_ex(address)
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      raise socket.error(error, os.strerror(error))
+    self._phase = _CONNECT
+    self.want_write = True
+
+  def _start_send(self):
+    self._phase = _SEND
+    self._out = self._request_data
+    self.want_write = True
+
+  def _retry(self):
+    """Retry the request with new connection, that is used when
+    the idle connection was closed by the server.
+    """
+    self.sock.close()
+    self._reused = False
+    self._buffer = ""
+    self._connect()
+
+  def close(self):
+    """Close the socket of request, it is not reused."""
+    if self.sock is not None:
+      self.sock.close()
+
+  def fail(self, error):
+    """Set the error of request, and close the connection."""
+    self.close()
+    self._error = error
+    self._phase = _DONE
+    self.done = True
+
+  def on_ready(self):
+    """Advance the request as far as the socket does not block."""
+    try:
+      if self._phase == _CONNECT:
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+          raise socket.error(error, os.strerror(error))
+        if self._scheme == "https":
+          self.sock = _wrap_ssl_socket(self.sock, self._host)
+          self._phase = _HANDSHAKE
+        else:
+          self._start_send()
+      if self._phase == _HANDSHAKE:
+        try:
+          self.sock.do_handshake()
+        except ssl.SSLError as e:
+          if not _would_block(e):
+            raise
+          self.want_write = e.args[0] == ssl.SSL_ERROR_WANT_WRITE
+          return
+        self._start_send()
+      if self._phase == _SEND:
+        self._send()
+      if self._phase in (_HEADERS, _BODY):
+        self._receive()
+    except (socket.error, httplib.HTTPException) as e:
+      #The idle connection may be closed by the server, then retry
+      #with new connection.
+      if not self._reused or self._received:
+        raise
+      self._retry()
+
+  def _send(self):
+    while self._out:
+      try:
+        sent = self.sock.send(self._out)
+      except socket.error as e:
+        if not _would_block(e):
+          raise
+        return
+      self._out = self._out[sent:]
+    self._phase = _HEADERS
+    self.want_write = False
+
+  def _receive(self):
+    while not self.done:
+      try:
+        data = self.sock.recv(READ_CHUNK_SIZE)
+      except socket.error as e:
+        if _is_ssl_eof(e):
+          data = ""
+        elif _would_block(e):
+          return
+        else:
+          raise
+      if not data:
+        self._on_close()
+        return
+      self._received = True
+      if self._phase == _HEADERS:
+        self._buffer += data
+        self._parse_headers()
+      else:
+        self._on_body(data)
+
+  def _parse_headers(self):
+    """Parse the status line and headers in the buffer."""
+    while self._phase == _HEADERS:
+      end = self._buffer.find("\r\n\r\n")
+      if end < 0:
+        if len(self._buffer) > MAX_HEADER_SIZE:
+          raise httplib.LineTooLong("header")
+        return
+      lines = self._buffer[:end].split("\r\n")
+      rest = self._buffer[end + 4:]
+      self._buffer = ""
+      status_line = lines[0].split(None, 2)
+      if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+        raise httplib.BadStatusLine(lines[0])
+      try:
+        status_code = int(status_line[1])
+      except ValueError:
+        raise httplib.BadStatusLine(lines[0])
+      if 100 <= status_code < 200:
+        #Interim response like 100 Continue, the final response follows.
+        self._buffer = rest
+        continue
+      headers = {}
+      for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if not sep:
+          continue
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+          headers[name] = "%s, %s" % (headers[name], value)
+        else:
+          headers[name] = value
+      self._version = status_line[0]
+      self._status_code = status_code
+      self._response_headers = headers
+      self._start_body(rest)
+
+  def _start_body(self, rest):
+    """Decide how the body is delimited, and read the rest of buffer."""
+    headers = self._response_headers
+    mime_type = _get_mime_type(headers.get("content-type"))
+    self._limit = self._get_max_content_size(mime_type)
+    self._phase = _BODY
+    if (self.method == "HEAD" or self._status_code in
+        (httplib.NO_CONTENT, httplib.NOT_MODIFIED)):
+      self._framing = "none"
+    elif "chunked" in headers.get("transfer-encoding", "").lower():
+      self._framing = "chunked"
+      self._remaining = None
+    elif headers.get("content-length", "").isdigit():
+      self._framing = "length"
+      self._remaining = int(headers["content-length"])
+    else:
+      self._framing = "close"
+    if self._framing == "none" or self._remaining == 0:
+      self._finish(not rest)
+    elif rest:
+      self._on_body(rest)
+
+  def _on_body(self, data):
+    """Read the data of body by the framing of response."""
+    if self._framing == "chunked":
+      self._buffer += data
+      self._parse_chunks()
+    elif self._framing == "length":
+      self._append(data[:self._remaining])
+      self._remaining -= len(data)
+      if not self.done and self._remaining <= 0:
+        self._finish(self._remaining == 0)
+    else:
+      self._append(data)
+
+  def _parse_chunks(self):
+    """Parse the chunked body in the buffer."""
+    while not self.done:
+      if self._remaining is None:
+        end = self._buffer.find("\r\n")
+        if end < 0:
+          if len(self._buffer) > MAX_HEADER_SIZE:
+            raise httplib.LineTooLong("chunk size")
+          return
+        size = self._buffer[:end].split(";", 1)[0].strip()
+        self._buffer = self._buffer[end + 2:]
+        try:
+          self._remaining = int(size, 16)
+        except ValueError:
+          raise httplib.HTTPException("%s Invalid chunk size: %r" % (self.url, size))
+        if self._remaining == 0:
+          self._framing = "trailer"
+      elif self._framing == "trailer":
+        end = self._buffer.find("\r\n")
+        if end < 0:
+          return
+        line = self._buffer[:end]
+        self._buffer = self._buffer[end + 2:]
+        if not line:
+          self._finish(not self._buffer)
+      elif self._remaining > 0:
+        if not self._buffer:
+          return
+        data = self._buffer[:self._remaining]
+        self._buffer = self._buffer[len(data):]
+        self._remaining -= len(data)
+        self._append(data)
+      else:
+        #CRLF at the end of chunk.
+        if len(self._buffer) < 2:
+          return
+        self._buffer = self._buffer[2:]
+        self._remaining = None
+
+  def _append(self, data):
+    """Append the data to body, the body over the limit is truncated."""
+    if self._size + len(data) > self._limit:
+      #One byte over the limit is kept, so the content is known to be
+      #longer than the limit.
+      data = data[:self._limit + 1 - self._size]
+      self._truncated = True
+    if data:
+      self._body.append(data)
+      self._size += len(data)
+    if self._truncated:
+      #The rest of body is not read, so the connection is not reused.
+      self._finish(False)
+
+  def _on_close(self):
+    """The server closed the connection."""
+    if self._phase == _BODY and self._framing == "close":
+      self._finish(False)
+    elif self._phase == _HEADERS and not self._received:
+      raise httplib.BadStatusLine("")
+    else:
+      raise httplib.IncompleteRead("".join(self._body))
+
+  def _finish(self, reusable):
+    """Set the result, and return the connection to the pool
+    if it can be reused.
+    """
+    connection = self._response_headers.get("connection", "").lower()
+    if self._version == "HTTP/1.0":
+      reusable = reusable and "keep-alive" in connection
+    else:
+      reusable = reusable and "close" not in connection
+    if reusable and self._framing != "close":
+      self._pool.release(self._scheme, self._netloc, self.sock)
+    else:
+      self.sock.close()
+    self._result = _HttpResponse(self._status_code, self._response_headers,
+                                 "".join(self._body), self._truncated)
+    self._phase = _DONE
+    self.done = True
+
+  def get_result(self):
+    """Wait for the response, and get it.
+
+    Returns:
+      _HttpResponse of the request.
+
+    Raises:
+      The error of request, like socket.error, httplib.HTTPException,
+      or RetryableFetchError if the request took longer than its deadline.
+    """
+    if not self.done:
+      self._loop.wait_any([self])
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+class _Poller(object):
+  """Waits for the sockets to be ready by poll(), or by select()
+  where poll() is not available.
+  """
+
+  def __init__(self):
+    self._poll = None
+    if hasattr(select, "poll"):
+      self._poll = select.poll()
+    #fd to True if the fd waits to be writable.
+    self._fds = {}
+
+  def register(self, fd, want_write):
+    """Register fd, or change the event to wait."""
+    if self._fds.get(fd) == want_write:
+      return
+    if self._poll is not None:
+      mask = select.POLLOUT if want_write else select.POLLIN
+      if fd in self._fds:
+        self._poll.modify(fd, mask)
+      else:
+        self._poll.register(fd, mask)
+    self._fds[fd] = want_write
+
+  def unregister(self, fd):
+    if self._fds.pop(fd, None) is not None and self._poll is not None:
+      self._poll.unregister(fd)
+
+  def poll(self, timeout):
+    """Wait for timeout seconds at most.
+
+    Returns:
+      List of fds that are ready, or have error.
+    """
+    if self._poll is not None:
+      return [fd for fd, event in self._poll.poll(int(math.ceil(timeout * 1000)))]
+    readers = [fd for fd, want_write in self._fds.items() if not want_write]
+    writers = [fd for fd, want_write in self._fds.items() if want_write]
+    readable, writable, failed = select.select(readers, writers, writers, timeout)
+    return set(readable) | set(writable) | set(failed)
+
+class _EventLoop(object):
+  """Single-threaded loop, that advances the outstanding _HttpRequests
+  whose sockets are ready, and fails the requests over their deadline.
+  """
+
+  def __init__(self, pool, time_func):
+    self._pool = pool
+    self._time = time_func
+    self._poller = _Poller()
+    #fd to the request on the socket.
+    self._requests = {}
+    #Heap of deadline, sequence and request.
+    self._deadlines = []
+    self._sequence = 0
+
+  def start(self, request):
+    """Start the request, the error of start is set to the request."""
+    try:
+      request.open(self._pool)
+    except Exception as e:
+      request.fail(e)
+      return
+    self._register(request, None)
+    self._sequence += 1
+    heapq.heappush(self._deadlines, (request.deadline, self._sequence, request))
+
+  def _register(self, request, fd):
+    """Update the registration of request, that was on fd."""
+    new_fd = None
+    if not request.done:
+      new_fd = request.sock.fileno()
+    if fd is not None and fd != new_fd:
+      self._poller.unregister(fd)
+      self._requests.pop(fd, None)
+    if new_fd is not None:
+      self._poller.register(new_fd, request.want_write)
+      self._requests[new_fd] = request
+
+  def cancel(self, request):
+    """Drop the outstanding request, and close its connection."""
+    if request.done:
+      return
+    fd = request.sock.fileno()
+    request.fail(errors.AbortedFetchError("%s Fetch is aborted" % request.url))
+    self._register(request, fd)
+
+  def wait_any(self, requests):
+    """Advance the outstanding requests, until one of requests is done.
+
+    Returns:
+      The request that is done.
+    """
+    while True:
+      for request in requests:
+        if request.done:
+          return request
+      timeout = 0
+      while self._deadlines:
+        deadline, sequence, request = self._deadlines[0]
+        if request.done:
+          heapq.heappop(self._deadlines)
+          continue
+        timeout = max(0, deadline - self._time())
+        break
+      try:
+        ready = self._poller.poll(timeout)
+      except (select.error, IOError) as e:
+        if e.args[0] != errno.EINTR:
+          raise
+        ready = []
+      for fd in ready:
+        request = self._requests.get(fd)
+        if request is None:
+          continue
+        try:
+          request.on_ready()
+        except Exception as e:
+          request.fail(e)
+        self._register(request, fd)
+      now = self._time()
+      while self._deadlines and self._deadlines[0][0] <= now:
+        request = heapq.heappop(self._deadlines)[2]
+        if not request.done:
+          fd = request.sock.fileno()
+          request.fail(errors.RetryableFetchError("%s Request timeout" % request.url))
+          self._register(request, fd)
+
+class PooledHttpFetcher(SimpleHttpFetcher):
+  """To fetch the web pages with persistent connections, without urlfetch.
+
+  This fetcher is for running outside App Engine. The requests are sent
+  on non-blocking sockets, and a single-threaded event loop of the
+  thread waits for any of them by poll(), so thousands of requests
+  can be outstanding without a thread per request. Connections are
+  pooled per host and reused by HTTP/1.1 keep-alive, the body is read
+  up to the max content size of fetcher policy, and each request fails
+  at one deadline of the timeout of host, whatever the server sends.
+
+  The fetches are driven as same as SimpleHttpFetcher, so the probe,
+  the politeness of hosts, the limit of concurrent requests per host
+  and redirects are same.
+  """
+
+  def __init__(self, max_shards, fetcher_policy=None, probe_mode=PROBE_NONE,
+               redirect_cache=None, politeness_scheduler=None,
+               connection_pool=None):
+    """Initializes a PooledHttpFetcher class.
+
+    Args:
+      max_shards: number of shard for web crawl process.
+      fetcher_policy: definition of policy for fetches,
+        FetcherPolicyInfo or CompiledFetcherPolicy.
+      probe_mode: probe mode of SimpleHttpFetcher.
+      redirect_cache: RedirectCache of permanent redirects, the cache
+        local to this fetcher is used if it is None.
+      politeness_scheduler: PolitenessScheduler of hosts.
+      connection_pool: ConnectionPool to share the connections between
+        fetchers, the pool local to this fetcher is used if it is None.
+    """
+    SimpleHttpFetcher.__init__(self, max_shards, fetcher_policy, probe_mode,
+                               redirect_cache, politeness_scheduler)
+    if connection_pool is None:
+      connection_pool = ConnectionPool()
+    self._pool = connection_pool
+    #The event loop of each thread.
+    self._local = threading.local()
+
+  def _get_loop(self):
+    loop = getattr(self._local, "loop", None)
+    if loop is None:
+      loop = _EventLoop(self._pool, self._time)
+      self._local.loop = loop
+    return loop
+
+  def _start_request(self, method, fetch_url, headers):
+    """Start the request, that is advanced by the event loop.
+
+    Returns:
+      _HttpRequest of the request.
+    """
+    loop = self._get_loop()
+    request = _HttpRequest(loop, method, fetch_url, headers,
+                           self._time() + self._get_timeout(fetch_url),
+                           self._fetcher_policy.get_max_content_size)
+    loop.start(request)
+    return request
+
+  def _create_probe_rpc(self, fetch_url):
+    """Start the HEAD request of probe, the redirected probe is not
+    followed, then the url is fetched without probe.
+    """
+    return self._start_request("HEAD", fetch_url, self._fetcher_policy.headers)
+
+  def _create_rpc(self, fetch_url, conditional_headers=None):
+    """Start the GET request.
+
+    Returns:
+      _HttpRequest of the request.
+    """
+    headers = self._fetcher_policy.headers
+    if conditional_headers:
+      headers = dict(headers)
+      headers.update(conditional_headers)
+    return self._start_request("GET", fetch_url, headers)
+
+  def _wait_any(self, rpcs):
+    return self._get_loop().wait_any(rpcs)
+
+  def _cancel_rpc(self, rpc):
+    self._get_loop().cancel(rpc)
+
   def abort(self):
-    """Abort job 
-    Actually try to abort """
+    """Abort the fetches in progress, and close the idle connections."""
+    SimpleHttpFetcher.abort(self)
+    self._pool.close()
+
+def create_fetcher(max_shards, fetcher_policy, probe_mode=PROBE_NONE,
+                   redirect_cache=None, politeness_scheduler=None):
+  """Create the fetcher of fetch_engine of fetcher policy.
+
+  Args:
+    max_shards: number of shard for web crawl process.
+    fetcher_policy: definition of policy for fetches,
+      FetcherPolicyInfo or CompiledFetcherPolicy.
+    probe_mode: probe mode of fetcher.
+    redirect_cache: RedirectCache of permanent redirects.
+    politeness_scheduler: PolitenessScheduler of hosts.
 
+  Returns:
+    PooledHttpFetcher if fetch_engine is FETCH_ENGINE_POOLED,
+    otherwise SimpleHttpFetcher.
+  """
+  fetcher_policy = compile_fetcher_policy(fetcher_policy)
+  fetcher_class = SimpleHttpFetcher
+  if fetcher_policy.fetch_engine == configuration.FETCH_ENGINE_POOLED:
+    fetcher_class = PooledHttpFetcher
+  return fetcher_class(max_shards, fetcher_policy, probe_mode=probe_mode,
+                       redirect_cache=redirect_cache,
+                       politeness_scheduler=politeness_scheduler)
@@ -14,14 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
 import logging
-import robotparser
 import datetime
-import re
+import httplib
+import time
 
 from mapreduce.lib.files import file_service_pb
 
-from urlparse import urlparse
 
 from google.appengine.ext import ndb
 from google.appengine.ext import blobstore
@@ -38,37 +38,63 @@ from mapreduce.lib import files
 from mapreduce.lib.pipeline import common as pipeline_common
 from mapreduce import output_writers
 from mapreduce import util
+from mapreduce import context
 
+from lakshmi import cache
+from lakshmi import canonicals
+from lakshmi import circuit_breaker
 from lakshmi import configuration
+from lakshmi import errors
 from lakshmi import fetchers
+from lakshmi import politeness
+from lakshmi import redirects
+from lakshmi import robots
+from lakshmi import urls
 from lakshmi.datum import CrawlDbDatum
 from lakshmi.datum import FetchedDbDatum
 from lakshmi.datum import ContentDbDatum
+from lakshmi.datum import FingerprintDbDatum
 
 #Define Fetch Status
 UNFETCHED, FETCHED, FAILED, SKIPPED, EXPORTED = range(5) 
+#Execution modes of robots.txt stages of FetcherPipeline.
+ROBOTS_MODE_FUSED = "fused"
+ROBOTS_MODE_TWO_STAGE = "two_stage"
+#Maximum count of asset hosts, whose robots.txt is cached in shard.
+MAX_ASSET_ROBOTS_RULES = 1000
+#Seconds to reuse the robots.txt of asset host cached in shard.
+ASSET_ROBOTS_RULES_TTL = 10 * 60
+#Count of domains read by a call of map function of robots.txt stages,
+#whose robots.txt are fetched concurrently.
+ROBOTS_DOMAINS_PER_CALL = fetchers.DEFAULT_MAX_IN_FLIGHT
+#Maximum count of urls of a fetch set, that are fetched by a call of
+#_fetchMap. The fetches of a set finish within the deadline of task,
+#even if the host answers them one by one in request_timeout.
+MAX_URLS_PER_FETCH_SET = 20
 
 def getDomain(url):
-  parsed_uri = urlparse(url)
-  return '%s://%s' % (parsed_uri.scheme, parsed_uri.netloc)
+  return urls.get_domain(url)
 
 def _extact_domain_map(entity_type):
   """Extract domain from url map function.
     
+  The extract_domain_url is set when CrawlDbDatum is put,
+  so that the entity is not written by this map function,
+  except the entity that was stored without it.
+
   Args:
     entity_type: The entity of crawl_db_datum.
     
   Returns:
     result: extracted domain name, value is none char
   """
-  data = ndb.Model.to_dict(entity_type)
   extract_domain = ""
-  fetch_status = data.get("last_status", 2) 
-  if fetch_status == UNFETCHED:
-    url = data.get("url")
-    extract_domain = getDomain(url)
-    entity_type.extract_domain_url = extract_domain
-    entity_type.put()
+  if entity_type.last_status == UNFETCHED:
+    extract_domain = entity_type.extract_domain_url
+    if extract_domain is None:
+      #Stored before extract_domain_url is set at put.
+      entity_type.put()
+      extract_domain = entity_type.extract_domain_url
 
   yield(extract_domain, "")
 
@@ -96,18 +122,113 @@ class _ExactDomainMapreducePipeline(base_handler.PipelineBase):
           job_name,
           params,
           shard_count):
+    #Only the urls to fetch are read.
+    mapper_params = dict(params)
+    mapper_params[_StatusDatastoreInputReader.STATUSES_PARAM] = [UNFETCHED]
     yield mapreduce_pipeline.MapreducePipeline(
         job_name,
         __name__ + "._extact_domain_map",
         __name__ + "._grouped_domain_reduce",
-        "mapreduce.input_readers.DatastoreInputReader",
+        __name__ + "._StatusDatastoreInputReader",
         "mapreduce.output_writers.BlobstoreOutputWriter",
-        mapper_params=params,
+        mapper_params=mapper_params,
         reducer_params={
             "mime_type": "text/plain",
         },
         shards=shard_count)
 
+class _StatusDatastoreInputReader(input_readers.DatastoreInputReader):
+  """Reader that reads CrawlDbDatum of the statuses.
+
+  This input reader shards the entities by key ranges like
+  DatastoreInputReader, and each shard queries only the entities of
+  'statuses' parameter in its key range, so that the cost of scan
+  is not grown by the urls of other statuses.
+  The query of last_status and key range is served by built-in indexes.
+  All entities are read if 'statuses' parameter is not specified.
+  """
+  STATUSES_PARAM = "statuses"
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a list of input readers for the input spec.
+
+    Args:
+      mapper_spec: The mapper specification to split from. Must contain
+          'entity_kind' parameter, and may contain 'statuses' parameter.
+
+    Returns:
+      A list of _StatusDatastoreInputReader corresponding to the specified shards.
+    """
+    readers = super(_StatusDatastoreInputReader, cls).split_input(mapper_spec)
+    statuses = input_readers._get_params(mapper_spec).get(cls.STATUSES_PARAM)
+    for reader in readers or []:
+      reader._statuses = statuses
+    return readers
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    """Validates mapper spec and all mapper parameters.
+
+    Args:
+      mapper_spec: The MapperSpec for this InputReader.
+
+    Raises:
+      BadReaderParamsError: required parameters are missing or invalid.
+    """
+    super(_StatusDatastoreInputReader, cls).validate(mapper_spec)
+    statuses = input_readers._get_params(mapper_spec).get(cls.STATUSES_PARAM)
+    if statuses is not None and (not isinstance(statuses, list) or
+        not statuses or not all(isinstance(s, (int, long)) for s in statuses)):
+      raise input_readers.BadReaderParamsError("_StatusDatastoreInputReader:'statuses' must be a list of status")
+
+  def to_json(self):
+    """Serializes the state of reader with its statuses."""
+    json = super(_StatusDatastoreInputReader, self).to_json()
+    json[self.STATUSES_PARAM] = getattr(self, "_statuses", None)
+    return json
+
+  @classmethod
+  def from_json(cls, json):
+    """Creates the reader from the state serialized by to_json."""
+    reader = super(_StatusDatastoreInputReader, cls).from_json(json)
+    reader._statuses = json.get(cls.STATUSES_PARAM)
+    return reader
+
+  def _iter_key_range(self, k_range):
+    """Yields the key and entity of the statuses in the key range."""
+    statuses = getattr(self, "_statuses", None)
+    if statuses is None:
+      for key, entity in super(_StatusDatastoreInputReader, self)._iter_key_range(k_range):
+        yield key, entity
+      return
+    model_class = util.for_name(self._entity_kind)
+    query = model_class.query(model_class.last_status.IN(statuses),
+                              namespace=k_range.namespace)
+    if k_range.key_start:
+      key_start = ndb.Key.from_old_key(k_range.key_start)
+      if k_range.include_start:
+        query = query.filter(model_class._key >= key_start)
+      else:
+        query = query.filter(model_class._key > key_start)
+    if k_range.key_end:
+      key_end = ndb.Key.from_old_key(k_range.key_end)
+      if k_range.include_end:
+        query = query.filter(model_class._key <= key_end)
+      else:
+        query = query.filter(model_class._key < key_end)
+    #The entities are yielded in the order of key, so that
+    #the reader resumes from the last key.
+    query = query.order(model_class._key)
+    cursor = None
+    while True:
+      entities, cursor, more = query.fetch_page(self._batch_size,
+                                                start_cursor=cursor)
+      for entity in entities:
+        yield entity.key, entity
+      if not more:
+        break
+
 class _RobotsLineInputReader(input_readers.BlobstoreLineInputReader):
   """Reader that for robots fetch map job's files consists from line.
   
@@ -149,11 +270,11 @@ class _RobotsLineInputReader(input_readers.BlobstoreLineInputReader):
     for blob_key, blob_size in blob_sizes.items():
       blob_chunk_size = blob_size // shards_per_blob
       for i in xrange(shards_per_blob - 1):
-        chunks.append(input_readers.BlobstoreLineInputReader.from_json(
+        chunks.append(cls.from_json(
             {cls.BLOB_KEY_PARAM: blob_key,
              cls.INITIAL_POSITION_PARAM: blob_chunk_size * i,
              cls.END_POSITION_PARAM: blob_chunk_size * (i + 1)}))
-      chunks.append(input_readers.BlobstoreLineInputReader.from_json(
+      chunks.append(cls.from_json(
           {cls.BLOB_KEY_PARAM: blob_key,
            cls.INITIAL_POSITION_PARAM: blob_chunk_size * (shards_per_blob - 1),
            cls.END_POSITION_PARAM: blob_size}))
@@ -191,32 +312,150 @@ class _RobotsLineInputReader(input_readers.BlobstoreLineInputReader):
         raise input_readers.BadReaderParamsError("_RobotsLineInputReader:Could not find blobinfo for key %s" %
                                    blob_key_str)
 
+class _DomainBatchInputReader(_RobotsLineInputReader):
+  """Reader that reads the domain urls of robots.txt stages in batches.
+
+  The value of data is the list of at most ROBOTS_DOMAINS_PER_CALL
+  domain urls, so that the map function fetches their robots.txt
+  concurrently. Empty lines are skipped.
+  """
+
+  def next(self):
+    """Returns the position of first line and the list of domain urls."""
+    position = None
+    domain_urls = []
+    while len(domain_urls) < ROBOTS_DOMAINS_PER_CALL:
+      try:
+        offset, line = super(_DomainBatchInputReader, self).next()
+      except StopIteration:
+        if not domain_urls:
+          raise
+        break
+      if position is None:
+        position = offset
+      if line:
+        domain_urls.append(line)
+    return (position, domain_urls)
+
+def _store_robots(url, result, error):
+  """Store the fetched robots.txt of host to robots_cache.
+  Whether the host responded is recorded to host_circuit_breaker.
+
+  Args:
+    url: the host url, like http://www.example.com.
+    result: the FetchResult of robots.txt, or None if the fetch failed.
+    error: the exception raised by the fetch, or None.
+
+  Returns:
+    the content of robots.txt, that disallows all urls if
+    it could not be fetched, or None if the fetch was stopped by abort.
+  """
+  if error is None:
+    host_circuit_breaker.record_success(url)
+    content = result.content
+    robots_cache.put(url, content, result)
+  elif isinstance(error, errors.HttpFetchError):
+    logging.warning("Robots.txt Fetch Error Occurs:" + str(error))
+    _record_fetch_error(url, error)
+    if (not fetchers.is_retryable_error(error) and error.status_code is not None
+        and 400 <= error.status_code < 500):
+      #robots.txt does not exist, then all urls are allowed.
+      content = ""
+      robots_cache.put(url, content)
+    else:
+      content = robots.DISALLOW_ALL
+      robots_cache.put(url, content, failed=True)
+  else:
+    logging.warning("Robots.txt Fetch Error Occurs:" + str(error))
+    #The fetch stopped by abort is not a failure of host.
+    if _is_aborted():
+      return None
+    content = robots.DISALLOW_ALL
+    _record_fetch_error(url, error)
+    robots_cache.put(url, content, failed=True)
+  return content
+
+def _fetch_robots_many(hosts):
+  """Fetch robots.txt of hosts concurrently, and store them to robots_cache.
+
+  Args:
+    hosts: list of host urls, like http://www.example.com.
+
+  Returns:
+    dict of host url to the content of robots.txt. The host whose
+    fetch was deferred by crawl delay, or stopped by abort, is not
+    contained, and its urls are left for next run.
+  """
+  robots_urls = dict(("%s/robots.txt" % str(host), host) for host in hosts)
+  contents = {}
+  for robots_url, result, error in shard_fetcher.get_many(robots_urls.keys()):
+    host = robots_urls[robots_url]
+    if isinstance(error, errors.DeferredFetchError):
+      logging.info(str(error))
+      continue
+    content = _store_robots(host, result, error)
+    if content is not None:
+      contents[host] = content
+  return contents
+
+def _fetch_robots(url):
+  """Fetch robots.txt of host, and store it to robots_cache.
+
+  Args:
+    url: the host url, like http://www.example.com.
+
+  Returns:
+    the content of robots.txt, or None if the fetch was deferred by
+    crawl delay or stopped by abort.
+  """
+  return _fetch_robots_many([url]).get(url)
+
+def _get_robots_contents(hosts):
+  """Get the robots.txt of hosts from robots_cache, and fetch the
+  robots.txt that are not cached or expired by a batch.
+
+  Returns:
+    dict of host url to the content of robots.txt, as same as
+    _fetch_robots_many.
+  """
+  contents = {}
+  missing = []
+  for host in hosts:
+    content = robots_cache.get(host)
+    if content is None:
+      missing.append(host)
+    else:
+      contents[host] = content
+  if missing:
+    contents.update(_fetch_robots_many(missing))
+  return contents
+
 def _robots_fetch_map(data):
   """Map function of fetch robots.txt from page.
 
   Fetch robots.txt from Web Pages in specified url,
   Fetched result content will store to Blobstore,
   which will parse and set the score for urls.
+  The robots.txt is cached by robots_cache, and only the robots.txt
+  that is not cached or expired is fetched. The robots.txt of domains
+  of a batch are fetched concurrently.
   
   Args:
-    data: key value data, that key is position, value is url.
+    data: key value data, that key is position, value is the list of
+      domain urls.
 
   Returns:
     url: extract domain url.
     content: content of fetched from url's robots.txt
   """
-  fetcher = fetchers.SimpleHttpFetcher(1, fetcher_policy_yaml.fetcher_policy)
-  k, url = data
-  logging.debug("data"+str(k)+":"+str(url))
-  content = ""
-  try:
-    result = fetcher.get("%s/robots.txt" % str(url))
-    content = result.get("content")
-  except Exception as e:
-    logging.warning("Robots.txt Fetch Error Occurs:" + e.message)
-    content = "User-agent: *\nDisallow: /"
-
-  yield (url, content)
+  k, domain_urls = data
+  logging.debug("data"+str(k)+":"+str(domain_urls))
+  if _is_aborted():
+    return
+  contents = _get_robots_contents(domain_urls)
+  for url in domain_urls:
+    if url in contents:
+      yield (url, contents[url])
 
 class _RobotsFetchPipeline(base_handler.PipelineBase):
   """Pipeline to execute RobotFetch jobs.
@@ -225,6 +464,7 @@ class _RobotsFetchPipeline(base_handler.PipelineBase):
     job_name: job name as string.
     blob_keys: files which urls for fetch robots.txt are stored. 
     shards: number of shards.
+    abort_key: memcache key of the abort flag, or None.
 
   Returns:
     file_names: output path of fetch results.
@@ -232,61 +472,264 @@ class _RobotsFetchPipeline(base_handler.PipelineBase):
   def run(self,
           job_name,
           blob_keys,
-          shards):
+          shards,
+          abort_key=None):
     yield mapreduce_pipeline.MapperPipeline(
       job_name,
       __name__ + "._robots_fetch_map",
-      __name__ + "._RobotsLineInputReader",
+      __name__ + "._DomainBatchInputReader",
       output_writer_spec=output_writers.__name__ + ".KeyValueBlobstoreOutputWriter" ,
       params={
             "blob_keys": blob_keys,
+            ABORT_KEY_PARAM: abort_key,
           },
       shards=shards)
 
 fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+fetcher_policy = fetchers.compile_fetcher_policy(fetcher_policy_yaml.fetcher_policy)
+redirect_cache = redirects.PersistentRedirectCache()
+politeness_scheduler = politeness.PolitenessScheduler(fetcher_policy)
+#The fetcher is created once, and reused by every record of the shard,
+#its requests wait for the slot of host by politeness_scheduler.
+shard_fetcher = fetchers.create_fetcher(1, fetcher_policy,
+                                        redirect_cache=redirect_cache,
+                                        politeness_scheduler=politeness_scheduler)
+#Targets of src= are mostly non-text, so probe them before fetch,
+#and the GET request after the probe waits for the next slot of host.
+content_fetcher = fetchers.create_fetcher(1, fetcher_policy,
+                                          probe_mode=fetchers.PROBE_ALL,
+                                          redirect_cache=redirect_cache,
+                                          politeness_scheduler=politeness_scheduler)
+robots_cache = robots.RobotsCache(fetcher_policy)
+canonical_cache = canonicals.CanonicalCache()
+#Compiled robots.txt of asset hosts, that is local to the shard.
+asset_robots_rules = cache.LRUCache(MAX_ASSET_ROBOTS_RULES)
+host_circuit_breaker = circuit_breaker.HostCircuitBreaker()
+
+#Mapper parameter of the deadline of crawl in seconds.
+CRAWL_DEADLINE_PARAM = "crawl_deadline"
+
+def _get_crawl_deadline(start_time):
+  """Get the deadline of crawl from crawl_end_time of fetcher policy.
+
+  Args:
+    start_time: the time of start of crawl in seconds.
+
+  Returns:
+    the deadline in seconds, or None if crawl_end_time is not set.
+  """
+  if fetcher_policy.crawl_end_time is None:
+    return None
+  return start_time + fetcher_policy.crawl_end_time
+
+def _get_mapper_param(name):
+  """Get the parameter of running mapper, or None."""
+  ctx = context.get()
+  if ctx is None:
+    return None
+  return ctx.mapreduce_spec.mapper.params.get(name)
+
+def _is_crawl_deadline_reached():
+  """Returns True if there is not enough time for new fetch before deadline.
+
+  The deadline is the CRAWL_DEADLINE_PARAM of the mapper.
+  The fetch that starts later than one request_timeout before
+  the deadline may not finish by the deadline.
+  """
+  deadline = _get_mapper_param(CRAWL_DEADLINE_PARAM)
+  if deadline is None:
+    return False
+  return time.time() + fetcher_policy.request_timeout > deadline
+
+#Mapper parameter of the memcache key of the abort flag.
+ABORT_KEY_PARAM = "abort_key"
+_ABORT_KEY_PREFIX = "FETCHER_ABORT_KEY:"
+#Seconds to reuse the abort flag, that is read from memcache by the shard.
+ABORT_CHECK_INTERVAL = 1.0
+_abort_flag = {"key": None, "aborted": False, "checked_time": 0}
+
+def _get_abort_key(pipeline_id):
+  """Get the memcache key of the abort flag of the pipeline."""
+  return _ABORT_KEY_PREFIX + pipeline_id
+
+def _set_abort_flag(key, aborted):
+  """Set the abort flag of FetcherPipeline."""
+  if aborted:
+    memcache.set(key, True)
+  else:
+    memcache.delete(key)
+
+def _is_aborted():
+  """Returns True if FetcherPipeline is aborted.
+
+  The flag is keyed by the ABORT_KEY_PARAM of the mapper, so that
+  the abort of a pipeline does not stop the other pipelines.
+  The flag is read from memcache at most once in ABORT_CHECK_INTERVAL,
+  so that the map functions can check it for each record, and
+  the fetches in progress of the shard are aborted when it is set.
+  """
+  key = _get_mapper_param(ABORT_KEY_PARAM)
+  if key is None:
+    return False
+  now = time.time()
+  if (key != _abort_flag["key"] or
+      now - _abort_flag["checked_time"] >= ABORT_CHECK_INTERVAL):
+    aborted = bool(memcache.get(key))
+    if aborted and not (key == _abort_flag["key"] and _abort_flag["aborted"]):
+      shard_fetcher.abort()
+      content_fetcher.abort()
+    _abort_flag["key"] = key
+    _abort_flag["aborted"] = aborted
+    _abort_flag["checked_time"] = now
+  return _abort_flag["aborted"]
 
 def _makeFetchSetBufferMap(binary_record):
   """Map function of create fetch buffers,
-  that output thus is one or more fetch url to fetch or skip.
+  that output thus is one or more fetch sets of urls to fetch or skip.
   
   Arg:
     binary_record: key value data, that key is extract domain url,
       value is content from robots.txt.
 
   Returns:
-    url: to fetch url.
-    fetch_or_unfetch: the boolean value of fetch or unfetch,
-      if sets true is fetch, false is skip.
+    url: extract domain url.
+    fetch_set: the urls of domain and whether they are fetched,
+      encoded by _encode_fetch_set.
   """
   proto = file_service_pb.KeyValue()
   proto.ParseFromString(binary_record)
   extract_domain_url = proto.key()
   content = proto.value()
+  crawl_datum_future = _query_domain_urls(extract_domain_url)
+  for record in _make_fetch_set(extract_domain_url, content,
+                                crawl_datum_future):
+    yield record
+
+def _query_domain_urls(extract_domain_url):
+  """Start the query of CrawlDbDatum of domain.
+
+  Returns:
+    the future of query.
+  """
   #Extract urls from CrawlDbDatum.
   try:
     query = CrawlDbDatum.query(CrawlDbDatum.extract_domain_url==extract_domain_url)
-    crawl_datum_future = query.fetch_async()
+    return query.fetch_async()
   except Exception as e:
     logging.warning("Fetch error occurs from CrawlDbDatum" + e.message)
 
-  can_fetch = False
-  #Get the fetcher policy from resource.
-  user_agent = fetcher_policy_yaml.fetcher_policy.agent_name
-  rp = robotparser.RobotFileParser()
-  try:
-    rp.parse(content.split("\n").__iter__())
-  except Exception as e:
-    logging.warning("RobotFileParser raises exception:" + e.message) 
-   
-  for crawl_datum in crawl_datum_future.get_result():
-    url = crawl_datum.url
-    try:
-      can_fetch = rp.can_fetch(user_agent, url)
-    except Exception as e:
-      logging.warning("RobotFileParser raises exception:" + e.message)
-      url = ""
-    
-    yield (url, can_fetch)
+def _make_fetch_set(extract_domain_url, content, crawl_datum_future):
+  """Check the urls of domain by robots.txt.
+
+  Args:
+    extract_domain_url: the domain url.
+    content: the content of robots.txt of domain.
+    crawl_datum_future: the future of query of CrawlDbDatum of domain.
+
+  Returns:
+    url: extract domain url.
+    fetch_set: at most MAX_URLS_PER_FETCH_SET urls of domain and whether
+      they are fetched, encoded by _encode_fetch_set.
+  """
+  #The robots.txt is compiled for the agent of fetcher policy.
+  rules = robots_cache.get_rules(extract_domain_url, content)
+  politeness_scheduler.set_robots_crawl_delay(extract_domain_url,
+                                              rules.crawl_delay)
+  if rules.sitemaps:
+    logging.debug("Sitemaps of %s:%s" % (extract_domain_url, rules.sitemaps))
+
+  #All urls of the domain are checked by a call.
+  domain_urls = [crawl_datum.url for crawl_datum in crawl_datum_future.get_result()]
+  fetch_set = zip(domain_urls, rules.can_fetch_many(domain_urls))
+  #The aliases are looked up by a batch, and cached in memcache
+  #for _fetchMap.
+  canonical_cache.prefetch([url for url, can_fetch in fetch_set if can_fetch])
+  for i in xrange(0, len(fetch_set), MAX_URLS_PER_FETCH_SET):
+    yield (extract_domain_url,
+           _encode_fetch_set(fetch_set[i:i + MAX_URLS_PER_FETCH_SET]))
+
+def _encode_fetch_set(fetch_set):
+  """Encode the fetch set to the value of record.
+
+  Args:
+    fetch_set: list of tuples of url and whether it is fetched.
+
+  Returns:
+    the lines of url and boolean value separated by tab.
+  """
+  return "\n".join("%s\t%s" % (url, can_fetch) for url, can_fetch in fetch_set)
+
+def _decode_fetch_set(value):
+  """Decode the value of record encoded by _encode_fetch_set.
+
+  Returns:
+    list of tuples of url and whether it is fetched.
+  """
+  fetch_set = []
+  for line in value.split("\n"):
+    if line:
+      url, can_fetch = line.rsplit("\t", 1)
+      fetch_set.append((url, _str2bool(can_fetch)))
+  return fetch_set
+
+def _robots_fetch_set_map(data):
+  """Map function of fetch robots.txt and create fetch buffers.
+
+  The fused stage of _robots_fetch_map and _makeFetchSetBufferMap,
+  the robots.txt of domains of a batch are fetched concurrently, or read
+  from robots_cache, and the urls of domains are checked in the same pass.
+
+  Args:
+    data: key value data, that key is position, value is the list of
+      domain urls.
+
+  Returns:
+    url: extract domain url.
+    fetch_set: the urls of domain and whether they are fetched,
+      encoded by _encode_fetch_set.
+  """
+  k, domain_urls = data
+  if _is_aborted():
+    return
+  #The queries run while robots.txt are fetched.
+  crawl_datum_futures = [(url, _query_domain_urls(url)) for url in domain_urls]
+  contents = _get_robots_contents(domain_urls)
+  for extract_domain_url, crawl_datum_future in crawl_datum_futures:
+    if extract_domain_url not in contents:
+      #The urls of domain are left UNFETCHED for next run.
+      continue
+    for record in _make_fetch_set(extract_domain_url,
+                                  contents[extract_domain_url],
+                                  crawl_datum_future):
+      yield record
+
+class _RobotsFetchSetsBufferPipeline(base_handler.PipelineBase):
+  """Pipeline to execute the fused RobotsFetch and FetchSetsBuffer jobs.
+  
+  Args:
+    job_name: job name as string.
+    blob_keys: files which urls for fetch robots.txt are stored. 
+    shards: number of shards.
+    abort_key: memcache key of the abort flag, or None.
+
+  Returns:
+    file_names: output path of fetch set buffers.
+  """
+  def run(self,
+          job_name,
+          blob_keys,
+          shards,
+          abort_key=None):
+    yield mapreduce_pipeline.MapperPipeline(
+      job_name,
+      __name__ + "._robots_fetch_set_map",
+      __name__ + "._DomainBatchInputReader",
+      output_writer_spec=output_writers.__name__ + ".KeyValueBlobstoreOutputWriter" ,
+      params={
+            "blob_keys": blob_keys,
+            ABORT_KEY_PARAM: abort_key,
+          },
+      shards=shards)
 
 class _FetchSetsBufferPipeline(base_handler.PipelineBase):
   """Pipeline to execute FetchSetsBuffer jobs.
@@ -294,13 +737,15 @@ class _FetchSetsBufferPipeline(base_handler.PipelineBase):
   Args:
     job_name: job name as string.
     file_names: file names of fetch result of robots.txt.
+    abort_key: memcache key of the abort flag, or None.
 
   Returns:
     file_names: output path of fetch results.
   """
   def run(self,
           job_name,
-          file_names):
+          file_names,
+          abort_key=None):
     yield mapreduce_pipeline.MapperPipeline(
       job_name,
       __name__ + "._makeFetchSetBufferMap",
@@ -308,73 +753,309 @@ class _FetchSetsBufferPipeline(base_handler.PipelineBase):
       output_writer_spec=output_writers.__name__ + ".KeyValueBlobstoreOutputWriter" ,
       params={
             "files": file_names,
+            ABORT_KEY_PARAM: abort_key,
           },
       shards=len(file_names))
 
 def _str2bool(v):
   return v.lower() in ("yes", "true", "t", "1")
 
+def _getFetchedDatum(crawl_db_datum_key):
+  """Get the FetchedDbDatum of previous fetch, or None."""
+  fetched_datums = FetchedDbDatum.query(ancestor=crawl_db_datum_key).fetch(1)
+  if len(fetched_datums)>0:
+    return fetched_datums[0]
+  return None
+
+def _parse_http_headers(http_headers):
+  """Parse the stored http_headers of FetchedDbDatum to dict."""
+  if not http_headers:
+    return {}
+  try:
+    headers = ast.literal_eval(http_headers)
+  except (ValueError, SyntaxError) as e:
+    logging.warning("Can not parse stored http headers:" + str(e))
+    return {}
+  if not isinstance(headers, dict):
+    return {}
+  return headers
+
+@ndb.transactional(xg=True)
+def _get_content_owner(fingerprint, crawl_db_key):
+  """Get the key of CrawlDbDatum whose FetchedDbDatum holds the content.
+
+  The url of crawl_db_key becomes the owner of content, if the fingerprint
+  is new, or the content of previous owner was changed or deleted.
+  The owner is checked and updated in a transaction, so that the
+  concurrent fetches of identical content agree on the owner.
+
+  Args:
+    fingerprint: the fingerprint of fetched content.
+    crawl_db_key: the key of CrawlDbDatum of fetched url.
+
+  Returns:
+    the key of CrawlDbDatum of owner.
+  """
+  index = FingerprintDbDatum.get_by_id(fingerprint)
+  if index is None:
+    index = FingerprintDbDatum(id=fingerprint, crawl_db_key=crawl_db_key)
+    index.put()
+    return crawl_db_key
+  owner_key = index.crawl_db_key
+  if owner_key == crawl_db_key:
+    return owner_key
+  owner_datum = _getFetchedDatum(owner_key)
+  if (owner_datum is not None and owner_datum.duplicate_of is None and
+      owner_datum.fingerprint == fingerprint):
+    return owner_key
+  index.crawl_db_key = crawl_db_key
+  index.put()
+  return crawl_db_key
+
+def _has_content_retry(crawl_db_key):
+  """Returns True if the fetch of content of the page will be retried."""
+  content_datums = ContentDbDatum.query(ancestor=crawl_db_key).fetch()
+  return any(datum.next_fetch_time is not None for datum in content_datums)
+
+def _is_waiting_retry(crawl_db_datums):
+  """Returns True if the url is in backoff of retry."""
+  now = datetime.datetime.now()
+  for datum in crawl_db_datums:
+    if datum.next_fetch_time is not None and datum.next_fetch_time > now:
+      return True
+  return False
+
+def _schedule_retry(crawl_db_datums, error):
+  """Schedule the retry of the url, that failed by transient error.
+
+  The url is retried by next run after the backoff delay,
+  until the count of attempts reaches max_fetch_attempts.
+
+  Args:
+    crawl_db_datums: CrawlDbDatums of the url, or ContentDbDatums of
+      the target of content fetch.
+    error: the error of fetch.
+
+  Returns:
+    UNFETCHED if the url will be retried, otherwise FAILED.
+  """
+  attempts = max(datum.fetch_attempts or 0 for datum in crawl_db_datums) + 1
+  if attempts >= fetcher_policy.max_fetch_attempts:
+    result = FAILED
+    next_fetch_time = None
+  else:
+    result = UNFETCHED
+    delay = fetchers.get_retry_delay(fetcher_policy, attempts,
+                                     getattr(error, "retry_after", None))
+    next_fetch_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+  for datum in crawl_db_datums:
+    datum.fetch_attempts = attempts
+    datum.next_fetch_time = next_fetch_time
+  return result
+
+def _schedule_deferred_fetch(datums):
+  """Schedule the fetch of the url, that was deferred before the request.
+
+  The url is fetched by next run, and the count of attempts is kept,
+  as the deferral is not a failure of host.
+
+  Args:
+    datums: CrawlDbDatums of the url, or ContentDbDatums of
+      the target of content fetch.
+  """
+  now = datetime.datetime.now()
+  for datum in datums:
+    datum.fetch_attempts = datum.fetch_attempts or 0
+    datum.next_fetch_time = now
+
+def _record_fetch_error(host, error):
+  """Record the error of fetch to the circuit breaker of host."""
+  if fetchers.is_connection_error(error):
+    host_circuit_breaker.record_failure(host)
+  else:
+    #The host responded.
+    host_circuit_breaker.record_success(host)
+
+def _check_page_fetch(url, could_fetch, crawl_db_datums):
+  """Check whether the page is fetched now.
+
+  Args:
+    url: the url of page.
+    could_fetch: whether the url is allowed by robots.txt.
+    crawl_db_datums: CrawlDbDatums of the url.
+
+  Returns:
+    None if the page is fetched, otherwise the status of the url.
+  """
+  if not could_fetch:
+    return FAILED
+  canonical_url = canonical_cache.resolve(url)
+  if canonical_url != url:
+    #The alias is not fetched, its canonical url is fetched instead.
+    logging.info("Fetch is skipped by canonical url %s:%s" % (canonical_url, url))
+    _add_crawl_url(canonical_url)
+    return FETCHED
+  if _is_crawl_deadline_reached():
+    #The url is left UNFETCHED, it will be fetched by next run.
+    logging.info("Fetch is deferred by crawl deadline:" + url)
+    return UNFETCHED
+  if _is_waiting_retry(crawl_db_datums):
+    #The url is left UNFETCHED until the backoff is expired.
+    logging.info("Fetch is deferred by retry backoff:" + url)
+    return UNFETCHED
+  if not host_circuit_breaker.allow(getDomain(url)):
+    #The host is down, the url is left UNFETCHED for next run.
+    logging.info("Fetch is deferred by circuit breaker:" + url)
+    return UNFETCHED
+  return None
+
+def _store_page(url, crawl_db_key, fetched_datum, fetch_result):
+  """Store the fetched page to FetchedDbDatum.
+
+  The errors of datastore are not the outcome of fetch, they are
+  raised, so that the record is retried by mapreduce.
+
+  Args:
+    url: the url of page.
+    crawl_db_key: the key of CrawlDbDatum of the url.
+    fetched_datum: FetchedDbDatum of previous fetch, or None.
+    fetch_result: the FetchResult of page.
+
+  Returns:
+    True if the outlinks of page are extracted.
+  """
+  if fetch_result.status_code == httplib.NOT_MODIFIED:
+    #Keep the stored content, and skip the extraction of outlinks,
+    #unless the fetch of its content is waiting retry.
+    return _has_content_retry(crawl_db_key)
+  #Identical content of other url is stored only once,
+  #and its outlinks are not extracted again.
+  fingerprint = fetch_result.fingerprint
+  owner_key = _get_content_owner(fingerprint, crawl_db_key)
+  duplicate_of = None
+  fetched_content = fetch_result.text
+  if owner_key != crawl_db_key:
+    logging.info("Content is duplicate of %s:%s" % (owner_key.id(), url))
+    duplicate_of = owner_key
+    fetched_content = None
+  #Storing to datastore
+  if fetched_datum is None:
+    fetched_datum = FetchedDbDatum(parent=crawl_db_key)
+  fetched_datum.populate(
+      url=url, fetched_url = fetch_result.fetched_url,
+      fetch_time = fetch_result.time, fetched_content = fetched_content,
+      charset = fetch_result.encoding,
+      content_type =  fetch_result.mime_type,
+      content_size = fetch_result.content_length,
+      response_rate = fetch_result.read_rate,
+      http_headers = str(fetch_result.headers),
+      fingerprint = fingerprint,
+      duplicate_of = duplicate_of)
+  fetched_datum.put()
+  return duplicate_of is None
+
+def _update_status(crawl_db_datums, result, fetch_date):
+  """Update the status of fetch to all datums of the url."""
+  for datum in crawl_db_datums:
+    datum.last_status = result
+    datum.last_fetched = fetch_date
+    if result == FETCHED:
+      datum.fetch_attempts = 0
+      datum.next_fetch_time = None
+
 def _fetchMap(binary_record):
   """Map function of create fetch result,
   that create FetchResulDatum entity, will be store to datastore. 
+  The urls of a fetch set are fetched concurrently by get_many of
+  shard_fetcher, that limits the requests in flight to the host, and
+  waits for the slot of host by its crawl delay.
+  If the page was fetched before, the request is conditional with
+  stored validators, and not modified page keeps the stored content
+  and is not output, so its outlinks are not extracted again.
 
   Arg:
-    binary_record: key value data, that key is url to fetch,
-      value is boolean value of can be fetch.
+    binary_record: key value data, that key is extract domain url,
+      value is the fetch set encoded by _encode_fetch_set.
 
   Returns:
-    url: to fetch url.
-    fetch_result: the result of fetch.
+    url: fetched url, whose outlinks are extracted.
   """
   proto = file_service_pb.KeyValue()
   proto.ParseFromString(binary_record)
-  url = proto.key()
-  could_fetch = _str2bool(proto.value())
-  result = UNFETCHED
-  fetched_url = ""
-  fetch_date = None
+  if _is_aborted():
+    #The urls are left as they are, that will be fetched by next run.
+    return
   #Fetch to CrawlDbDatum
-  try:
-    query = CrawlDbDatum.query(CrawlDbDatum.url==url)
-    crawl_db_datum_future = query.fetch_async() 
-  except Exception as e:
-    logging.warning("Failed create key, caused by invalid url:" + url + ":" + e.message)
-    could_fetch = False
-  
-  if could_fetch:
-    #start fetch    
-    fetcher = fetchers.SimpleHttpFetcher(1, fetcher_policy_yaml.fetcher_policy)
+  queries = []
+  for url, could_fetch in _decode_fetch_set(proto.value()):
     try:
-      fetch_result = fetcher.get(url)
-      if fetch_result:
-        #Storing to datastore
-        crawl_db_datums = crawl_db_datum_future.get_result()
-        fetche_datum = FetchedDbDatum(parent=crawl_db_datums[0].key,
-            url=url, fetched_url = fetch_result.get("fetched_url"),
-            fetch_time = fetch_result.get("time"), fetched_content = fetch_result.get("content"),
-            content_type =  fetch_result.get("mime_type"),
-            content_size = fetch_result.get("read_rate"),
-            response_rate = fetch_result.get("read_rate"),
-            http_headers = str(fetch_result.get("headers")))
-        fetche_datum.put()
-        #update time of last fetched 
-        result = FETCHED
-        fetch_date = datetime.datetime.now()
-        fetched_url = ("%s\n"%url)
+      query = CrawlDbDatum.query(CrawlDbDatum.url==url)
+      queries.append((url, could_fetch, query.fetch_async()))
     except Exception as e:
-      logging.warning("Fetch Page Error Occurs:" + e.message)
-      result = FAILED
-  else:
-    result = FAILED
-  
-  #Update status to all datums.
-  crawl_db_datums = crawl_db_datum_future.get_result()
-  for datum in crawl_db_datums:
-    datum.last_status = result
-    datum.last_fetched = fetch_date
-  ndb.put_multi(crawl_db_datums)
-
-  yield fetched_url
+      logging.warning("Failed create key, caused by invalid url:" + url + ":" + e.message)
+
+  updated_datums = []
+  #url to tuple of CrawlDbDatums and the future of FetchedDbDatum.
+  pages = {}
+  for url, could_fetch, crawl_db_future in queries:
+    crawl_db_datums = crawl_db_future.get_result()
+    if not crawl_db_datums:
+      #The url was deleted since the fetch set was created.
+      logging.warning("CrawlDbDatum is not found:" + url)
+      continue
+    result = _check_page_fetch(url, could_fetch, crawl_db_datums)
+    if result is not None:
+      _update_status(crawl_db_datums, result, None)
+      updated_datums.extend(crawl_db_datums)
+      continue
+    fetched_future = FetchedDbDatum.query(
+        ancestor=crawl_db_datums[0].key).fetch_async(1)
+    pages[url] = (crawl_db_datums, fetched_future)
+
+  #start fetch
+  fetched_datums = {}
+  conditional_headers = {}
+  for url, (crawl_db_datums, fetched_future) in pages.iteritems():
+    fetched_datum = (fetched_future.get_result() or [None])[0]
+    fetched_datums[url] = fetched_datum
+    #The duplicate has no stored content to keep, so it is fetched
+    #without validators, and its owner is checked by the fingerprint.
+    if fetched_datum is not None and fetched_datum.duplicate_of is None:
+      conditional_headers[url] = fetchers.create_conditional_headers(
+          _parse_http_headers(fetched_datum.http_headers))
+  #The permanent redirects of the fetch set are looked up by a batch.
+  redirect_cache.prefetch(pages.keys())
+  fetched_urls = []
+  for url, fetch_result, error in shard_fetcher.get_many(
+      pages.keys(), conditional_headers=conditional_headers):
+    crawl_db_datums = pages[url][0]
+    fetch_date = None
+    if isinstance(error, errors.DeferredFetchError):
+      #The host is busy, the url is left UNFETCHED for next run.
+      logging.info(str(error))
+      result = UNFETCHED
+    elif error is not None:
+      logging.warning("Fetch Page Error Occurs:" + str(error))
+      _record_fetch_error(getDomain(url), error)
+      if fetchers.is_retryable_error(error):
+        result = _schedule_retry(crawl_db_datums, error)
+      else:
+        result = FAILED
+    else:
+      host_circuit_breaker.record_success(getDomain(url))
+      if _store_page(url, crawl_db_datums[0].key, fetched_datums[url],
+                     fetch_result):
+        fetched_urls.append(url)
+      #update time of last fetched
+      result = FETCHED
+      fetch_date = datetime.datetime.now()
+    _update_status(crawl_db_datums, result, fetch_date)
+    updated_datums.extend(crawl_db_datums)
+  #The urls dropped by abort are left as they are.
+  ndb.put_multi(updated_datums)
+
+  for url in fetched_urls:
+    yield ("%s\n" % url)
 
 class _FetchPagePipeline(base_handler.PipelineBase):
   """Pipeline to execute FetchPagePipeline jobs.
@@ -383,6 +1064,8 @@ class _FetchPagePipeline(base_handler.PipelineBase):
     job_name: job name as string.
     file_names: file names of fetch result count and status 
     shards: number of shards.
+    crawl_deadline: the deadline of crawl in seconds, or None.
+    abort_key: memcache key of the abort flag, or None.
 
   Returns:
     file_names: output path of fetch results.
@@ -390,7 +1073,9 @@ class _FetchPagePipeline(base_handler.PipelineBase):
   def run(self,
           job_name,
           file_names,
-          shards):
+          shards,
+          crawl_deadline=None,
+          abort_key=None):
     yield mapreduce_pipeline.MapperPipeline(
       job_name,
       __name__ + "._fetchMap",
@@ -398,6 +1083,8 @@ class _FetchPagePipeline(base_handler.PipelineBase):
       output_writer_spec=output_writers.__name__ + ".BlobstoreOutputWriter" ,
       params={
         "files": file_names,
+        CRAWL_DEADLINE_PARAM: crawl_deadline,
+        ABORT_KEY_PARAM: abort_key,
       },
       shards=len(file_names))
 
@@ -409,6 +1096,32 @@ def _set_parser_param(key, params):
 def _get_parser_param(key):
   return memcache.get(key) 
 
+def _add_crawl_url(url):
+  """Add the url to CrawlDbDatum as UNFETCHED, if it is not added."""
+  if CrawlDbDatum.query(CrawlDbDatum.url==url).get(keys_only=True) is None:
+    CrawlDbDatum.insert_or_fail(url, parent=ndb.Key(CrawlDbDatum, url),
+                                url=url, last_status=UNFETCHED)
+
+def _record_canonical_url(url, content, base_url, fetched_datum):
+  """Record the page as alias, if it declares other canonical url.
+
+  The canonical url is added to CrawlDbDatum, so that it is fetched
+  by next run instead of the alias. The stored content of alias is
+  removed, and it is not the owner of its fingerprint any more.
+
+  Returns:
+    True if the page is recorded as alias.
+  """
+  canonical_url = canonicals.extract_canonical_url(content, base_url)
+  if canonical_url is None or not canonical_cache.put(url, canonical_url):
+    return False
+  logging.info("Page is alias of %s:%s" % (canonical_url, url))
+  _add_crawl_url(canonical_cache.resolve(canonical_url))
+  fetched_datum.fetched_content = None
+  fetched_datum.fingerprint = None
+  fetched_datum.put()
+  return True
+
 def _extract_content_urls_map(data):
   """Map function of extract outlinks from content.
 
@@ -430,11 +1143,17 @@ def _extract_content_urls_map(data):
   Note:Note:The above function to return the URL of the target of 
     url that will fetch in the next job(FetchContentPipeline)
 
+  The page that declares other canonical url by rel=canonical link or
+  meta refresh is recorded as alias, that is not fetched again, and
+  its outlinks are extracted from the canonical url instead.
+
   Args:
     data: key value data, that key is position, value is url.
 
   Returns:
     url: The page url.
+    content_urls: the urls of targets of page separated by newline,
+      that are fetched by a call of _fetchContentMap.
   """
   k, url = data
   query = CrawlDbDatum.query(CrawlDbDatum.url==url)
@@ -447,6 +1166,9 @@ def _extract_content_urls_map(data):
     content = fetched_datum.fetched_content
     mime_type = fetched_datum.content_type
     if content is not None:
+      if _record_canonical_url(url, content, fetched_datum.fetched_url or url,
+                               fetched_datum):
+        return
       parsed_obj = None
       try:
         params = _get_parser_param(_PARSER_PARAM_KEY)
@@ -454,8 +1176,15 @@ def _extract_content_urls_map(data):
       except Exception as e:
         logging.warning("Can not handle for %s[params:%s]:%s"%(mime_type, params, e.message))
       if parsed_obj is not None:
-        for content_urls in parsed_obj:
-          yield (url, content_urls)
+        #The outlinks are resolved by the url of page, and canonicalized.
+        base_url = fetched_datum.fetched_url or url
+        content_urls = []
+        for content_url in parsed_obj:
+          content_url = urls.canonicalize(content_url, base_url)
+          if content_url is not None and content_url not in content_urls:
+            content_urls.append(content_url)
+        if content_urls:
+          yield (url, "\n".join(content_urls))
       
 class _ExtractOutlinksPipeline(base_handler.PipelineBase):
   """Pipeline to execute ExtractOutlinksPipeline.
@@ -494,13 +1223,146 @@ def _getCrawlDatum(crawl_db_datum_future):
     return crawl_db_datums[0]
   return None
 
+#Bytes written to blobstore by a call, that bounds the copy of content.
+BLOB_WRITE_CHUNK_SIZE = 512 * 1024
+
+def _write_blob(f, content):
+  """Write the content to the blobstore file in chunks.
+
+  Args:
+    f: the file opened by files.open().
+    content: the content as str or buffer, only a chunk of it is
+      copied at a time.
+  """
+  for offset in xrange(0, len(content), BLOB_WRITE_CHUNK_SIZE):
+    f.write(str(buffer(content, offset, BLOB_WRITE_CHUNK_SIZE)))
+
+def _get_asset_robots_rules_many(hosts):
+  """Get the compiled robots.txt of asset hosts.
+
+  The rules are cached in the shard, and robots.txt is read from
+  robots_cache or fetched at the first use of the host. The robots.txt
+  of hosts are fetched concurrently by shard_fetcher, that waits for
+  the slot of host, and is recorded to host_circuit_breaker, as same
+  as the fetch of content. The Crawl-delay of rules is set to
+  politeness_scheduler, so that the content is fetched by it.
+
+  Args:
+    hosts: list of host urls, like http://www.example.com.
+
+  Returns:
+    dict of host url to RobotsRules. The host whose robots.txt can not
+    be fetched now, by crawl delay or by abort, is not contained.
+  """
+  now = time.time()
+  rules = {}
+  missing = []
+  for host in set(hosts):
+    entry = asset_robots_rules.get(host)
+    if entry is not None and entry[1] > now:
+      rules[host] = entry[0]
+    else:
+      missing.append(host)
+  for host, content in _get_robots_contents(missing).iteritems():
+    host_rules = robots_cache.get_rules(host, content)
+    politeness_scheduler.set_robots_crawl_delay(host, host_rules.crawl_delay)
+    asset_robots_rules.put(host, (host_rules, now + ASSET_ROBOTS_RULES_TTL))
+    rules[host] = host_rules
+  return rules
+
+def _get_asset_robots_rules(host):
+  """Get the compiled robots.txt of asset host.
+
+  Returns:
+    the RobotsRules of host, or None if robots.txt can not be fetched
+    now, by crawl delay or by abort.
+  """
+  return _get_asset_robots_rules_many([host]).get(host)
+
+def _check_content_fetch(target_url, content_datum, robots_rules):
+  """Check whether the target of content is fetched now.
+
+  Args:
+    target_url: the url of target.
+    content_datum: ContentDbDatum of the target, or None.
+    robots_rules: dict of host url to RobotsRules.
+
+  Returns:
+    True if the target is fetched, False if it is skipped.
+
+  Raises:
+    DeferredFetchError: if the fetch of target is deferred to next run.
+  """
+  host = getDomain(target_url)
+  if _is_crawl_deadline_reached():
+    raise errors.DeferredFetchError("%s Fetch is deferred by crawl deadline"
+                                    % target_url)
+  if content_datum and _is_waiting_retry([content_datum]):
+    logging.info("Fetch is deferred by retry backoff:" + target_url)
+    return False
+  if not host_circuit_breaker.allow(host):
+    raise errors.DeferredFetchError("%s Fetch is deferred by circuit breaker"
+                                    % target_url)
+  if host not in robots_rules:
+    raise errors.DeferredFetchError("%s Fetch is deferred by fetch of robots.txt"
+                                    % target_url)
+  if not robots_rules[host].can_fetch(target_url):
+    logging.info("Fetch is disallowed by robots.txt:" + target_url)
+    return False
+  return True
+
+def _handle_content_error(target_url, content_datum, error):
+  """Schedule the next fetch of target, whose fetch was deferred or failed.
+
+  Returns:
+    True if content_datum is updated.
+  """
+  if isinstance(error, errors.DeferredFetchError):
+    #The target was not requested, it is fetched by next run.
+    logging.info(str(error))
+    if content_datum:
+      _schedule_deferred_fetch([content_datum])
+      return True
+    return False
+  _record_fetch_error(getDomain(target_url), error)
+  if fetchers.is_retryable_error(error):
+    logging.info("Fetch Error Occurs, that could be retried:" + str(error))
+    if content_datum:
+      _schedule_retry([content_datum], error)
+      return True
+  else:
+    logging.warning("Fetch Error Occurs:" + str(error))
+  return False
+
+def _store_content(fetch_result):
+  """Store the fetched content to blobstore.
+
+  Returns:
+    the serving url of stored content.
+  """
+  blob_io = files.blobstore.create(mime_type=fetch_result.mime_type,
+      _blobinfo_uploaded_filename=fetch_result.fetched_url)
+  with files.open(blob_io, 'a') as f:
+    _write_blob(f, fetch_result.content_buffer)
+  files.finalize(blob_io)
+  blob_key = files.blobstore.get_blob_key(blob_io)
+  return images.get_serving_url(str(blob_key))
+
 def _fetchContentMap(binary_record):
   """Map function of fetch content.
   Fetched content will store to blobstore.
+  The targets of a page are fetched concurrently by get_many of
+  content_fetcher, and the robots.txt of their hosts are fetched by
+  a batch. The target disallowed by robots.txt of its host is not fetched.
+  The target that failed by transient error is retried by next run
+  after the backoff delay, as same as the page. The target deferred by
+  crawl deadline, circuit breaker, robots.txt or crawl delay is stored
+  with next_fetch_time, so that its page is output again by _fetchMap
+  even if the page is not modified.
 
   Arg:
     binary_record: key value data, that key is url of target page,
-      value is url of target of fetch.
+      value is urls of targets of fetch separated by newline.
 
   Returns:
     url: fetched url.
@@ -508,47 +1370,85 @@ def _fetchContentMap(binary_record):
   proto = file_service_pb.KeyValue()
   proto.ParseFromString(binary_record)
   page_url = proto.key()
-  target_url = proto.value()
+  if _is_aborted():
+    return
   #Fetch to CrawlDbDatum
   try:
     query = CrawlDbDatum.query(CrawlDbDatum.url==page_url)
     crawl_db_datum_future = query.fetch_async() 
   except Exception as e:
     logging.warning("Failed create key, caused by invalid url:" + page_url + ":" + e.message)
-  
-  #start fetch    
-  fetcher = fetchers.SimpleHttpFetcher(1, fetcher_policy_yaml.fetcher_policy)
-  stored_url = None
-  if re.match("^/", target_url):
-    crawl_db_datum = _getCrawlDatum(crawl_db_datum_future)
-    target_url = "%s%s" % (crawl_db_datum.extract_domain_url, target_url)
+    return
+
+  canonical_urls = []
+  for target_url in proto.value().split("\n"):
+    canonical_url = urls.canonicalize(target_url, page_url)
+    if canonical_url is None:
+      logging.info("Fetch is skipped by unsupported url:" + target_url)
+    else:
+      canonical_urls.append(canonical_url)
+  #The aliases are resolved to their canonical urls by a batch.
+  canonical_cache.prefetch(canonical_urls)
+  target_urls = []
+  for canonical_url in canonical_urls:
+    target_url = canonical_cache.resolve(canonical_url)
+    if target_url not in target_urls:
+      target_urls.append(target_url)
 
-  try:
-    fetch_result = fetcher.get(target_url)
-    if fetch_result:
-      #Storing to blobstore
-      blob_io = files.blobstore.create(mime_type=fetch_result.get("mime_type"),
-          _blobinfo_uploaded_filename=fetch_result.get("fetched_url"))
-      with files.open(blob_io, 'a') as f:
-        f.write(fetch_result.get("content"))
-      files.finalize(blob_io)
-      blob_key = files.blobstore.get_blob_key(blob_io)
-      stored_url = images.get_serving_url(str(blob_key))
-  except Exception as e:
-    logging.warning("Fetch Error Occurs:" + e.message)
-
-  #Put content to datastore.
   crawl_db_datum = _getCrawlDatum(crawl_db_datum_future)
-  if crawl_db_datum and stored_url is not None:
-    entity = ContentDbDatum(parent=crawl_db_datum.key,
-          fetched_url=fetch_result.get("fetched_url"),
-          stored_url=stored_url,
-          content_type=fetch_result.get("mime_type"),
-          content_size=fetch_result.get("content_length"),
-          http_headers=str(fetch_result.get("headers")))
-    entity.put()
-
-  yield "%s:%s" % (target_url, stored_url)
+  content_datums = {}
+  if crawl_db_datum:
+    keys = [ndb.Key(ContentDbDatum, target_url, parent=crawl_db_datum.key)
+            for target_url in target_urls]
+    for target_url, content_datum in zip(target_urls, ndb.get_multi(keys)):
+      if content_datum is None:
+        content_datum = ContentDbDatum(id=target_url, parent=crawl_db_datum.key)
+      content_datums[target_url] = content_datum
+
+  robots_rules = _get_asset_robots_rules_many(
+      [getDomain(target_url) for target_url in target_urls])
+  updated_datums = []
+  fetch_urls = []
+  for target_url in target_urls:
+    content_datum = content_datums.get(target_url)
+    try:
+      if _check_content_fetch(target_url, content_datum, robots_rules):
+        fetch_urls.append(target_url)
+    except errors.DeferredFetchError as e:
+      if _handle_content_error(target_url, content_datum, e):
+        updated_datums.append(content_datum)
+
+  #start fetch
+  redirect_cache.prefetch(fetch_urls)
+  stored_urls = {}
+  for target_url, fetch_result, error in content_fetcher.get_many(fetch_urls):
+    content_datum = content_datums.get(target_url)
+    if error is None:
+      host_circuit_breaker.record_success(getDomain(target_url))
+      try:
+        stored_url = _store_content(fetch_result)
+      except Exception as e:
+        error = e
+    if error is not None:
+      if _handle_content_error(target_url, content_datum, error):
+        updated_datums.append(content_datum)
+      continue
+    stored_urls[target_url] = stored_url
+    #Put content to datastore.
+    if content_datum:
+      content_datum.populate(
+            fetched_url=fetch_result.fetched_url,
+            stored_url=stored_url,
+            content_type=fetch_result.mime_type,
+            content_size=fetch_result.content_length,
+            http_headers=str(fetch_result.headers),
+            fetch_attempts=0,
+            next_fetch_time=None)
+      updated_datums.append(content_datum)
+  ndb.put_multi(updated_datums)
+
+  for target_url in target_urls:
+    yield "%s:%s" % (target_url, stored_urls.get(target_url))
 
 class _FetchContentPipeline(base_handler.PipelineBase):
   """Pipeline to execute FetchContentPipeline.
@@ -560,6 +1460,8 @@ class _FetchContentPipeline(base_handler.PipelineBase):
     job_name: job name as string.
     file_names: file names of stored target url records. 
     shards: number of shards
+    crawl_deadline: the deadline of crawl in seconds, or None.
+    abort_key: memcache key of the abort flag, or None.
 
   Returns:
     file_names: output path of fetch results.
@@ -567,7 +1469,9 @@ class _FetchContentPipeline(base_handler.PipelineBase):
   def run(self,
           job_name,
           file_names,
-          shards=8):
+          shards=8,
+          crawl_deadline=None,
+          abort_key=None):
     yield mapreduce_pipeline.MapperPipeline(
         job_name,
         __name__ + "._fetchContentMap",
@@ -575,6 +1479,8 @@ class _FetchContentPipeline(base_handler.PipelineBase):
         output_writer_spec=output_writers.__name__ + ".BlobstoreOutputWriter" ,
         params={
         "files": file_names,
+        CRAWL_DEADLINE_PARAM: crawl_deadline,
+        ABORT_KEY_PARAM: abort_key,
         },
         shards=shards)
 
@@ -589,6 +1495,16 @@ class FetcherPipeline(base_handler.PipelineBase):
       outlinks url list.
     shards: number of shard for fetch job.
 
+  The deadline of crawl is crawl_end_time of fetcher policy from start,
+  the fetch stages stop to fetch before the deadline, and urls that
+  are not fetched are left UNFETCHED for next run.
+  If the pipeline is aborted, the map functions of fetch stages
+  stop to fetch within ABORT_CHECK_INTERVAL. The abort flag is keyed by
+  the root pipeline id, so other running pipelines are not stopped.
+  robots_mode selects the execution of robots.txt stages,
+  ROBOTS_MODE_FUSED fetches robots.txt and creates fetch sets in a pass,
+  ROBOTS_MODE_TWO_STAGE runs RobotsFetch and FetchSetsBuffer jobs.
+
   Returns:
     The list of filenames as string. Resulting files contain serialized
     file_service_pb.KeyValues protocol messages with all values collated
@@ -598,20 +1514,38 @@ class FetcherPipeline(base_handler.PipelineBase):
           job_name,
           params,
           parser_params,
-          shards=8):
+          shards=8,
+          robots_mode=ROBOTS_MODE_FUSED):
+    crawl_deadline = _get_crawl_deadline(time.time())
+    abort_key = _get_abort_key(self.root_pipeline_id)
     extract_domain_files = yield _ExactDomainMapreducePipeline(job_name,
         params=params,
         shard_count=shards)
-    robots_files = yield _RobotsFetchPipeline(job_name, extract_domain_files, shards)
-    fetch_set_buffer_files = yield _FetchSetsBufferPipeline(job_name, robots_files)
-    fetch_files = yield _FetchPagePipeline(job_name, fetch_set_buffer_files, shards)
+    if robots_mode == ROBOTS_MODE_TWO_STAGE:
+      robots_files = yield _RobotsFetchPipeline(job_name, extract_domain_files, shards,
+                                                abort_key)
+      fetch_set_buffer_files = yield _FetchSetsBufferPipeline(job_name, robots_files,
+                                                              abort_key)
+      temp_files = [extract_domain_files, robots_files, fetch_set_buffer_files]
+    else:
+      fetch_set_buffer_files = yield _RobotsFetchSetsBufferPipeline(job_name,
+          extract_domain_files, shards, abort_key)
+      temp_files = [extract_domain_files, fetch_set_buffer_files]
+    fetch_files = yield _FetchPagePipeline(job_name, fetch_set_buffer_files, shards,
+                                           crawl_deadline, abort_key)
     outlinks_files = yield _ExtractOutlinksPipeline(job_name, fetch_files, parser_params, shards)
-    results_files = yield _FetchContentPipeline(job_name, outlinks_files, shards)
-    temp_files = [extract_domain_files, robots_files, fetch_set_buffer_files, fetch_files]
+    results_files = yield _FetchContentPipeline(job_name, outlinks_files, shards,
+                                                crawl_deadline, abort_key)
+    temp_files.append(fetch_files)
     with pipeline.After(results_files):
       all_temp_files = yield pipeline_common.Extend(*temp_files)
       yield mapper_pipeline._CleanupPipeline(all_temp_files)
 
+  def finalized(self):
+    """Set the abort flag, so that the running shards stop to fetch."""
+    if self.was_aborted:
+      _set_abort_flag(_get_abort_key(self.root_pipeline_id), True)
+
 
 def _clean_map(crawl_db_datum):
   """Delete entities map function.
@@ -667,10 +1601,14 @@ class CleanDatumPipeline(base_handler.PipelineBase):
           clean_all=False,
           shards=8):
     memcache.set(key=CLEAN_ALL_KEY, value=clean_all)
+    params = dict(params)
+    if not clean_all:
+      #Only the urls to delete are read.
+      params[_StatusDatastoreInputReader.STATUSES_PARAM] = [FETCHED, SKIPPED, FAILED]
     yield mapreduce_pipeline.MapperPipeline(
       job_name,
       __name__+"._clean_map",
-      "mapreduce.input_readers.DatastoreInputReader",
+      __name__ + "._StatusDatastoreInputReader",
       output_writer_spec=output_writers.__name__ + ".BlobstoreOutputWriter" ,
       params=params,
       shards=shards)
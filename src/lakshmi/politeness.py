@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-host politeness scheduler.
+
+Every shard of the fetch jobs reserves a time slot of the host before
+fetching, the slots of a host are spaced by its crawl delay.
+The reservation is kept in memcache, and falls back to datastore
+when memcache is not available.
+"""
+
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from lakshmi import fetchers
+from lakshmi.datum import HostDbDatum
+
+#Namespace of memcache for politeness.
+MEMCACHE_NAMESPACE = "lakshmi_politeness"
+#Prefix of memcache key of robots.txt crawl delay.
+CRAWL_DELAY_KEY_PREFIX = "crawl_delay:"
+#Maximum seconds to wait the slot, url is deferred if wait is longer.
+DEFAULT_MAX_WAIT = 10
+#Upper bound of max_wait, that keeps the sleep of a mapper call far
+#below the deadline of task queue request.
+MAX_WAIT_LIMIT = 60
+#Number of retry for compare and set of memcache.
+CAS_RETRIES = 5
+#Expiration seconds of memcache entries.
+MEMCACHE_EXPIRATION = 24 * 60 * 60
+
+@ndb.transactional
+def _reserve_datastore(host, crawl_delay, now, max_wait):
+  """Reserve the slot of host with datastore.
+
+  Returns:
+    the reserved time of slot, or the time of next available slot
+    if it is later than max_wait.
+  """
+  entity = HostDbDatum.get_by_id(host)
+  if entity is None:
+    entity = HostDbDatum(id=host)
+  slot = max(now, entity.next_fetch_time or 0)
+  if slot - now <= max_wait:
+    entity.next_fetch_time = slot + crawl_delay
+    entity.put()
+  return slot
+
+class PolitenessScheduler(object):
+  """Spaces the fetches of a host by the crawl delay.
+
+  The crawl delay of a host is the larger of the crawl_delay of
+  fetcher policy and the Crawl-delay of the host's robots.txt,
+  that is RobotsRules.crawl_delay stored by set_robots_crawl_delay().
+  """
+
+  def __init__(self, fetcher_policy, max_wait=DEFAULT_MAX_WAIT):
+    """Initializes a PolitenessScheduler class.
+
+    Args:
+      fetcher_policy: definition of policy for fetches,
+        FetcherPolicyInfo or CompiledFetcherPolicy.
+      max_wait: maximum seconds to wait the slot of host,
+        that is limited to MAX_WAIT_LIMIT.
+    """
+    self._crawl_delay = fetchers.compile_fetcher_policy(fetcher_policy).crawl_delay
+    self._max_wait = min(max_wait, MAX_WAIT_LIMIT)
+    self._time = time.time
+    self._sleep = time.sleep
+
+  @property
+  def max_wait(self):
+    """Maximum seconds to wait the slot of host."""
+    return self._max_wait
+
+  def set_robots_crawl_delay(self, host, crawl_delay):
+    """Store the Crawl-delay of robots.txt of host.
+
+    Args:
+      host: the host url, like http://www.example.com.
+      crawl_delay: crawl delay in seconds, or None if not specified.
+    """
+    crawl_delay = crawl_delay or 0.0
+    memcache.set(CRAWL_DELAY_KEY_PREFIX + host, crawl_delay,
+                 time=MEMCACHE_EXPIRATION, namespace=MEMCACHE_NAMESPACE)
+    entity = HostDbDatum.get_by_id(host)
+    if entity is None:
+      entity = HostDbDatum(id=host)
+    if entity.crawl_delay != crawl_delay:
+      entity.crawl_delay = crawl_delay
+      entity.put()
+
+  def get_crawl_delay(self, host):
+    """Get the crawl delay of host in seconds."""
+    robots_delay = memcache.get(CRAWL_DELAY_KEY_PREFIX + host,
+                                namespace=MEMCACHE_NAMESPACE)
+    if robots_delay is None:
+      entity = HostDbDatum.get_by_id(host)
+      robots_delay = 0.0
+      if entity is not None and entity.crawl_delay:
+        robots_delay = entity.crawl_delay
+      memcache.set(CRAWL_DELAY_KEY_PREFIX + host, robots_delay,
+                   time=MEMCACHE_EXPIRATION, namespace=MEMCACHE_NAMESPACE)
+    return max(self._crawl_delay, robots_delay)
+
+  def reserve(self, host):
+    """Reserve the next slot of host.
+
+    Args:
+      host: the host url, like http://www.example.com.
+
+    Returns:
+      seconds to wait before fetch. If it is larger than max_wait,
+      the slot has not been reserved.
+    """
+    crawl_delay = self.get_crawl_delay(host)
+    if not crawl_delay:
+      return 0
+    now = self._time()
+    slot = self._reserve_memcache(host, crawl_delay, now)
+    if slot is None:
+      logging.warning("Politeness falls back to datastore: %s" % host)
+      slot = _reserve_datastore(host, crawl_delay, now, self._max_wait)
+    return max(0, slot - now)
+
+  def _reserve_memcache(self, host, crawl_delay, now):
+    """Reserve the slot of host with compare and set of memcache.
+
+    Returns:
+      the time of slot, or None if memcache is not available.
+    """
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+      next_fetch_time = client.gets(host, namespace=MEMCACHE_NAMESPACE)
+      if next_fetch_time is None:
+        if client.add(host, now + crawl_delay, time=MEMCACHE_EXPIRATION,
+                      namespace=MEMCACHE_NAMESPACE):
+          return now
+        continue
+      slot = max(now, next_fetch_time)
+      if slot - now > self._max_wait:
+        return slot
+      if client.cas(host, slot + crawl_delay, time=MEMCACHE_EXPIRATION,
+                    namespace=MEMCACHE_NAMESPACE):
+        return slot
+    return None
+
+  def wait(self, host):
+    """Wait for the slot of host.
+
+    Args:
+      host: the host url, like http://www.example.com.
+
+    Returns:
+      True if the slot was reserved and waited, False if the fetch
+      should be deferred to next run.
+    """
+    wait_time = self.reserve(host)
+    if wait_time > self._max_wait:
+      return False
+    if wait_time > 0:
+      self._sleep(wait_time)
+    return True
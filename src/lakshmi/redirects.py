@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent cache of permanent redirects.
+
+The redirects are stored to datastore, and cached in memcache,
+so later runs and other shards go straight to the redirect target.
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from lakshmi import fetchers
+from lakshmi.datum import RedirectDbDatum
+
+#Namespace of memcache for redirects.
+MEMCACHE_NAMESPACE = "lakshmi_redirects"
+#Expiration seconds of memcache entries.
+MEMCACHE_EXPIRATION = 24 * 60 * 60
+#Maximum count of urls looked up by a batch call of memcache and datastore.
+MAX_BATCH_SIZE = 1000
+#Value of cache entry of the url, that is not redirected.
+_NOT_REDIRECT = ""
+
+class PersistentRedirectCache(fetchers.RedirectCache):
+  """RedirectCache backed by memcache and datastore."""
+
+  def get(self, url):
+    """Get the location of permanent redirect of url, or None."""
+    if url in self._redirects:
+      return self._redirects[url]
+    location = memcache.get(url, namespace=MEMCACHE_NAMESPACE)
+    if location is None:
+      entity = RedirectDbDatum.get_by_id(url)
+      location = _NOT_REDIRECT
+      if entity is not None:
+        location = entity.location
+      #The url that is not redirected is also cached, so that other
+      #shards do not look up datastore again.
+      memcache.set(url, location, time=MEMCACHE_EXPIRATION,
+                   namespace=MEMCACHE_NAMESPACE)
+    location = location or None
+    #Unknown url is also cached in local, to not look up it again.
+    fetchers.RedirectCache.put(self, url, location)
+    return location
+
+  def prefetch(self, fetch_urls):
+    """Look up the urls that are not cached in local by batches
+    of MAX_BATCH_SIZE urls.
+
+    The urls that are not redirected are also cached, so that get() of
+    them does not look up memcache and datastore one by one.
+
+    Args:
+      fetch_urls: list of urls.
+    """
+    missing = [url for url in fetch_urls if url not in self._redirects]
+    for i in xrange(0, len(missing), MAX_BATCH_SIZE):
+      self._prefetch_batch(missing[i:i + MAX_BATCH_SIZE])
+
+  def _prefetch_batch(self, missing):
+    """Look up the urls, that are not cached in local."""
+    locations = memcache.get_multi(missing, namespace=MEMCACHE_NAMESPACE)
+    unknown = [url for url in missing if url not in locations]
+    if unknown:
+      entities = ndb.get_multi([ndb.Key(RedirectDbDatum, url) for url in unknown])
+      stored = {}
+      for url, entity in zip(unknown, entities):
+        stored[url] = entity.location if entity is not None else _NOT_REDIRECT
+      memcache.set_multi(stored, time=MEMCACHE_EXPIRATION,
+                         namespace=MEMCACHE_NAMESPACE)
+      locations.update(stored)
+    for url, location in locations.iteritems():
+      fetchers.RedirectCache.put(self, url, location or None)
+
+  def put(self, url, location):
+    """Store the permanent redirect from url to location."""
+    if self._redirects.get(url) == location:
+      return
+    fetchers.RedirectCache.put(self, url, location)
+    memcache.set(url, location, time=MEMCACHE_EXPIRATION,
+                 namespace=MEMCACHE_NAMESPACE)
+    RedirectDbDatum(id=url, location=location).put()
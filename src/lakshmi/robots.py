@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rules and persistent cache of robots.txt.
+
+The robots.txt is compiled once for the agent of crawler into RobotsRules,
+that checks the urls of a host without scanning all rules for each url.
+The robots.txt of hosts are stored to datastore, and cached in memcache
+with the compiled rules, so that the crawl runs fetch and compile
+robots.txt again only after it is expired.
+"""
+
+import logging
+import re
+import time
+import urllib
+import urlparse
+
+from google.appengine.api import memcache
+
+from lakshmi import fetchers
+from lakshmi.datum import RobotsDbDatum
+
+#Namespace of memcache for robots.txt.
+MEMCACHE_NAMESPACE = "lakshmi_robots"
+#robots.txt that disallows all urls, used when it could not be fetched.
+DISALLOW_ALL = "User-agent: *\nDisallow: /"
+
+_MAX_AGE_RE = re.compile(r"(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*\"?([0-9]+)", re.I)
+_NO_CACHE_RE = re.compile(r"(?:^|,)\s*(?:no-cache|no-store)\s*(?:,|=|$)", re.I)
+
+def get_cache_ttl(fetch_result, max_ttl, now=None):
+  """Get the time to live of response from its cache headers.
+
+  Args:
+    fetch_result: the FetchResult of response.
+    max_ttl: maximum time to live in seconds, that is used if
+      the response has no cache headers.
+    now: the current time in seconds, time.time() is used if it is None.
+
+  Returns:
+    the time to live in seconds, 0 if the response should not be cached.
+  """
+  cache_control = fetch_result.get_header("cache-control")
+  if cache_control:
+    if _NO_CACHE_RE.search(cache_control):
+      return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match:
+      return min(max_ttl, float(match.group(1)))
+  expires = fetch_result.get_header("expires")
+  if expires is not None:
+    #Invalid Expires means already expired.
+    return min(max_ttl, fetchers.parse_retry_after(expires, now) or 0)
+  return max_ttl
+
+#Characters that are not escaped by normalization of path.
+_PATH_SAFE_CHARS = "/?&=;:@+$,!*'()~"
+#Characters that are changed by normalization of path, like escapes.
+_PATH_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_.\-%s]"
+                             % re.escape(_PATH_SAFE_CHARS))
+#Key of rule in node of trie.
+_RULE = None
+
+def _normalize_path(path):
+  """Normalize the percent-encoding of path, to compare rules and urls."""
+  return urllib.quote(urllib.unquote(path), _PATH_SAFE_CHARS)
+
+def _compile_pattern(path):
+  """Compile the path pattern that has wildcards, * and $ at end."""
+  end = ""
+  if path.endswith("$"):
+    path = path[:-1]
+    end = r"\Z"
+  return re.compile(".*".join(re.escape(part) for part in path.split("*")) + end)
+
+def _product_token(agent):
+  """Get the product token of user-agent in lower case, like RFC 9309."""
+  return agent.split("/")[0].strip().lower()
+
+class RobotsRules(object):
+  """Rules of robots.txt compiled for an agent.
+
+  The group of user-agent that equals to the product token of agent name
+  is used, even if it has no rule, or the group of * if there is not
+  such group, and the rules of groups for the same agent are merged.
+  The most specific rule, that is the longest path, decides whether the
+  url is allowed, and Allow wins if Allow and Disallow are the same
+  length, like RFC 9309.
+  The paths of rules are normalized once when they are compiled, the
+  rules without wildcard are kept in the prefix trie, and the rules
+  with wildcard are compiled to regular expressions.
+
+  Attributes:
+    crawl_delay: the Crawl-delay in seconds for the agent, or None.
+    sitemaps: list of urls of Sitemap directives.
+  """
+
+  def __init__(self, content, agent_name):
+    """Initializes a RobotsRules class.
+
+    Args:
+      content: the content of robots.txt.
+      agent_name: the agent name of crawler.
+    """
+    agent_name = _product_token(agent_name)
+    self.sitemaps = []
+    #Rules and Crawl-delay of the agent and of "*".
+    groups = {True: ([], []), False: ([], [])}
+    #True if a group of the agent exists, that may have no rule.
+    agent_seen = False
+    agents = []
+    in_rules = False
+    for line in content.splitlines():
+      i = line.find("#")
+      if i >= 0:
+        line = line[:i]
+      if ":" not in line:
+        continue
+      field, value = line.split(":", 1)
+      field = field.strip().lower()
+      value = value.strip()
+      if field == "sitemap":
+        if value:
+          self.sitemaps.append(value)
+        continue
+      if field == "user-agent":
+        if in_rules:
+          agents = []
+          in_rules = False
+        agent = _product_token(value)
+        if agent == agent_name:
+          agent_seen = True
+        agents.append(agent)
+        continue
+      in_rules = True
+      matched = [agent != "*" for agent in agents
+                 if agent == "*" or agent == agent_name]
+      if not matched:
+        continue
+      if field in ("allow", "disallow"):
+        #Empty Disallow allows all urls, that is same as no rule.
+        if value:
+          for is_agent in set(matched):
+            groups[is_agent][0].append((field == "allow", value))
+      elif field == "crawl-delay":
+        try:
+          delay = float(value)
+        except ValueError:
+          continue
+        for is_agent in set(matched):
+          groups[is_agent][1].append(delay)
+
+    rules, delays = groups[agent_seen]
+    self.crawl_delay = delays[0] if delays else None
+    self._trie = {}
+    self._patterns = []
+    for allow, path in rules:
+      path = _normalize_path(path)
+      if "*" in path or path.endswith("$"):
+        self._patterns.append((len(path), allow, _compile_pattern(path)))
+        continue
+      node = self._trie
+      for char in path:
+        node = node.setdefault(char, {})
+      #Allow wins against Disallow of the same path.
+      node[_RULE] = node.get(_RULE, False) or allow
+    #The longer pattern is checked first, to stop at the shorter ones,
+    #and Allow is checked before Disallow of the same length.
+    self._patterns.sort(key=lambda pattern: (-pattern[0], not pattern[1]))
+
+  def can_fetch(self, url):
+    """Returns True if the url is allowed by the rules."""
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or "/"
+    if parsed.query:
+      path = "%s?%s" % (path, parsed.query)
+    if path == "/robots.txt":
+      return True
+    #The path of canonical url has nothing to normalize, unless
+    #it has escapes.
+    if _PATH_UNSAFE_RE.search(path):
+      path = _normalize_path(path)
+    #The longest rule without wildcard, that is prefix of path.
+    length = -1
+    allowed = True
+    node = self._trie
+    for i, char in enumerate(path):
+      node = node.get(char)
+      if node is None:
+        break
+      if _RULE in node:
+        length = i + 1
+        allowed = node[_RULE]
+    for pattern_length, allow, pattern in self._patterns:
+      if pattern_length < length:
+        break
+      if pattern_length == length and (allowed or not allow):
+        continue
+      if pattern.match(path):
+        return allow
+    return allowed
+
+  def can_fetch_many(self, urls):
+    """Check the urls of a host.
+
+    Args:
+      urls: list of urls.
+
+    Returns:
+      list of True if the url is allowed, in the order of urls.
+    """
+    can_fetch = self.can_fetch
+    return [can_fetch(url) for url in urls]
+
+class RobotsCache(object):
+  """Cache of robots.txt keyed by host, backed by memcache and datastore."""
+
+  def __init__(self, fetcher_policy):
+    """Initializes a RobotsCache class.
+
+    Args:
+      fetcher_policy: definition of policy for fetches,
+        FetcherPolicyInfo or CompiledFetcherPolicy.
+    """
+    self._fetcher_policy = fetchers.compile_fetcher_policy(fetcher_policy)
+    self._time = time.time
+
+  def get(self, host):
+    """Get the content of robots.txt of host.
+
+    Args:
+      host: the host url, like http://www.example.com.
+
+    Returns:
+      the content of robots.txt, or None if it is not cached or expired.
+    """
+    entry = self._get_entry(host)
+    if entry is None or entry["expires"] <= self._time():
+      return None
+    return entry["content"]
+
+  def put(self, host, content, fetch_result=None, failed=False):
+    """Store the robots.txt of host.
+
+    Args:
+      host: the host url, like http://www.example.com.
+      content: the content of robots.txt.
+      fetch_result: the FetchResult of robots.txt, whose cache headers
+        shorten the time to live.
+      failed: True if the robots.txt could not be fetched, that is
+        cached for robots_failure_ttl of fetcher policy.
+    """
+    now = self._time()
+    if failed:
+      ttl = self._fetcher_policy.robots_failure_ttl
+    elif fetch_result is not None:
+      ttl = get_cache_ttl(fetch_result, self._fetcher_policy.robots_cache_ttl,
+                          now)
+    else:
+      ttl = self._fetcher_policy.robots_cache_ttl
+    if ttl <= 0:
+      return
+    entry = {"content": content, "fetched_time": now, "expires": now + ttl}
+    self._set_entry(host, entry)
+    RobotsDbDatum(id=host, content=content, fetched_time=now,
+                  expires=entry["expires"], failed=failed).put()
+
+  def get_rules(self, host, content):
+    """Get the compiled robots.txt of host for the agent of fetcher policy.
+
+    The compiled rules are cached with the content, so that the
+    robots.txt is not compiled again until it is expired.
+
+    Args:
+      host: the host url, like http://www.example.com.
+      content: the content of robots.txt.
+
+    Returns:
+      the RobotsRules of content.
+    """
+    entry = memcache.get(host, namespace=MEMCACHE_NAMESPACE)
+    if (entry is not None and entry["content"] == content and
+        entry.get("rules") is not None):
+      return entry["rules"]
+    rules = RobotsRules(content, self._fetcher_policy.agent_name)
+    if entry is not None and entry["content"] == content:
+      entry["rules"] = rules
+      self._set_entry(host, entry)
+    return rules
+
+  def _get_entry(self, host):
+    """Get the cache entry of host from memcache or datastore, or None."""
+    entry = memcache.get(host, namespace=MEMCACHE_NAMESPACE)
+    if entry is None:
+      entity = RobotsDbDatum.get_by_id(host)
+      if entity is None:
+        return None
+      entry = {"content": entity.content or "",
+               "fetched_time": entity.fetched_time,
+               "expires": entity.expires}
+      if entry["expires"] > self._time():
+        self._set_entry(host, entry)
+    return entry
+
+  def _set_entry(self, host, entry):
+    """Set the cache entry of host to memcache until it is expired."""
+    #memcache takes the expiration as the absolute unix time.
+    try:
+      memcache.set(host, entry, time=int(entry["expires"]),
+                   namespace=MEMCACHE_NAMESPACE)
+    except ValueError as e:
+      #The rules of huge robots.txt exceed the size limit of memcache.
+      logging.warning("Can not cache robots.txt of %s:%s" % (host, e))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utilities of urls.
+
+The urls are canonicalized when they are inserted to the frontier and
+emitted as outlinks, so that the variants of a url are fetched once.
+"""
+
+import posixpath
+import re
+import urllib
+import urlparse
+
+from lakshmi import cache
+
+#Schemes of urls that can be fetched.
+FETCHABLE_SCHEMES = ("http", "https")
+#Default ports of schemes, that are removed from canonical url.
+DEFAULT_PORTS = {"http": 80, "https": 443}
+#Maximum count of hosts, whose split scheme and host are cached.
+MAX_SPLIT_CACHE_SIZE = 10000
+
+#Characters that are not escaped in path and query of canonical url.
+_PATH_SAFE_CHARS = "/:@!$&'()*+,;=~%"
+_QUERY_SAFE_CHARS = "/:@!$'()*+,;=?~%"
+_ESCAPE_RE = re.compile(r"%([0-9a-fA-F]{2})")
+_DUPLICATE_SLASH_RE = re.compile(r"/{2,}")
+#The scheme and netloc part of url, like http://www.example.com.
+_HOST_PREFIX_RE = re.compile(r"[^:/?#]*://[^/?#]*")
+#Unreserved characters of RFC 3986, that are decoded if escaped.
+_UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                        "0123456789-._~")
+
+_split_cache = cache.LRUCache(MAX_SPLIT_CACHE_SIZE)
+
+def split_host(url):
+  """Get the scheme and host of url.
+
+  The result is cached by the scheme and netloc part of url,
+  that is shared by the urls of the same host.
+
+  Returns:
+    the tuple of lower case scheme and host.
+  """
+  match = _HOST_PREFIX_RE.match(url)
+  prefix = match.group(0) if match else url
+  split = _split_cache.get(prefix)
+  if split is None:
+    parsed_uri = urlparse.urlsplit(prefix)
+    split = (parsed_uri.scheme.lower(), parsed_uri.netloc.lower())
+    _split_cache.put(prefix, split)
+  return split
+
+def get_domain(url):
+  """Get the domain url of url, like http://www.example.com."""
+  return '%s://%s' % split_host(url)
+
+def _normalize_escape(match):
+  """Decode the escape of unreserved character, and upper the others."""
+  char = chr(int(match.group(1), 16))
+  if char in _UNRESERVED:
+    return char
+  return "%" + match.group(1).upper()
+
+def _quote(value, safe):
+  """Escape the characters that are not safe, and normalize the escapes."""
+  if isinstance(value, unicode):
+    value = value.encode("utf-8")
+  return _ESCAPE_RE.sub(_normalize_escape, urllib.quote(value, safe))
+
+def _remove_dot_segments(path):
+  """Remove . and .. segments of path, and the duplicate slashes."""
+  path = _DUPLICATE_SLASH_RE.sub("/", path)
+  if "." not in path:
+    return path
+  normalized = posixpath.normpath(path)
+  #normpath removes the trailing slash, and keeps leading "//".
+  if path.endswith(("/", "/.", "/..")) and normalized != "/":
+    normalized += "/"
+  return _DUPLICATE_SLASH_RE.sub("/", normalized)
+
+def canonicalize(url, base_url=None):
+  """Canonicalize the url.
+
+  The relative url is resolved by base_url, and the canonical url has
+  lower case scheme and host without default port, the path without
+  . and .. segments and duplicate slashes, the query sorted by name,
+  that keeps the order of values of the same name,
+  normalized escapes, and no fragment.
+
+  Args:
+    url: the url to canonicalize.
+    base_url: the url of page, that url is linked from.
+
+  Returns:
+    the canonical url, or None if the url is not http or https url.
+  """
+  url = url.strip()
+  if base_url:
+    url = urlparse.urljoin(base_url, url)
+  parsed_uri = urlparse.urlsplit(url)
+  scheme = parsed_uri.scheme.lower()
+  if scheme not in FETCHABLE_SCHEMES or not parsed_uri.hostname:
+    return None
+  host = parsed_uri.hostname.lower().rstrip(".")
+  if ":" in host:
+    #The brackets of IPv6 address are removed by urlsplit.
+    host = "[%s]" % host
+  elif isinstance(host, unicode):
+    try:
+      host = host.encode("idna")
+    except UnicodeError:
+      return None
+  try:
+    port = parsed_uri.port
+  except ValueError:
+    return None
+  if port is not None and port != DEFAULT_PORTS[scheme]:
+    host = "%s:%d" % (host, port)
+  if parsed_uri.username is not None:
+    host = "%s@%s" % (parsed_uri.netloc.rsplit("@", 1)[0], host)
+  path = _remove_dot_segments(_quote(parsed_uri.path, _PATH_SAFE_CHARS)) or "/"
+  query = parsed_uri.query
+  if query:
+    params = [_quote(param, _QUERY_SAFE_CHARS) for param in query.split("&") if param]
+    #The order of values of the same name is kept.
+    query = "&".join(sorted(params, key=lambda param: param.split("=", 1)[0]))
+  return urlparse.urlunsplit((scheme, host, path, query, ""))
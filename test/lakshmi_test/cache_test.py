@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from lakshmi import cache
+
+class LRUCacheTest(unittest.TestCase):
+  """Tests for LRUCache."""
+
+  def testGetAndPut(self):
+    lru = cache.LRUCache(4)
+    self.assertEquals(None, lru.get("a"))
+    self.assertEquals(1, lru.get("a", 1))
+    lru.put("a", 2)
+    self.assertEquals(2, lru.get("a"))
+    self.assertTrue("a" in lru)
+    lru.put("a", 3)
+    self.assertEquals(3, lru.get("a"))
+    self.assertEquals(1, len(lru))
+
+  def testEvictLeastRecentlyUsed(self):
+    lru = cache.LRUCache(4)
+    for key in "abcd":
+      lru.put(key, key)
+    lru.get("a")
+    lru.put("e", "e")
+    self.assertEquals(4, len(lru))
+    self.assertFalse("b" in lru)
+    for key in "acde":
+      self.assertEquals(key, lru.get(key))
+
+if __name__ == "__main__":
+  unittest.main()
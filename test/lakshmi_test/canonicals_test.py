@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from testlib import testutil
+from lakshmi import canonicals
+from lakshmi.datum import CanonicalDbDatum
+
+BASE_URL = "http://foo.com/dir/page.html?ref=top"
+
+class ExtractCanonicalUrlTest(unittest.TestCase):
+  """Tests for extract_canonical_url."""
+
+  def testCanonicalLink(self):
+    content = ("<html><head><title>Page</title>"
+               "<link rel='stylesheet' href='/style.css'>"
+               "<LINK REL=\"Canonical\" HREF=\"/dir/page.html\" />"
+               "</head><body></body></html>")
+    self.assertEquals("http://foo.com/dir/page.html",
+                      canonicals.extract_canonical_url(content, BASE_URL))
+    content = "<link href=http://Foo.com:80/page rel=canonical>"
+    self.assertEquals("http://foo.com/page",
+                      canonicals.extract_canonical_url(content, BASE_URL))
+
+  def testMetaRefresh(self):
+    content = ("<html><head>"
+               "<meta http-equiv=\"Refresh\" content=\"0; URL='../new.html'\">"
+               "</head></html>")
+    self.assertEquals("http://foo.com/new.html",
+                      canonicals.extract_canonical_url(content, BASE_URL))
+    #Delayed refresh, and refresh of the page itself are not alias.
+    content = "<meta http-equiv=\"refresh\" content=\"30;url=/new.html\">"
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+    content = "<meta http-equiv=\"refresh\" content=\"0\">"
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+
+  def testCanonicalLinkPrecedesRefresh(self):
+    content = ("<meta http-equiv=\"refresh\" content=\"0;url=/new.html\">"
+               "<link rel=\"canonical\" href=\"/page.html\">")
+    self.assertEquals("http://foo.com/page.html",
+                      canonicals.extract_canonical_url(content, BASE_URL))
+
+  def testOtherHost(self):
+    #The canonical url and refresh to other host are not alias.
+    content = "<link rel=\"canonical\" href=\"http://bar.com/dir/page.html\">"
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+    content = "<meta http-equiv=\"refresh\" content=\"0;url=http://bar.com/\">"
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+    content = "<link rel=\"canonical\" href=\"https://FOO.com/page.html\">"
+    self.assertEquals("https://foo.com/page.html",
+                      canonicals.extract_canonical_url(content, BASE_URL))
+
+  def testOnlyHead(self):
+    content = ("<html><head><title>Page</title></head><body>"
+               "<link rel=\"canonical\" href=\"/page.html\"></body></html>")
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+    content = "<link rel=\"canonical\" href=\"javascript:void(0)\">"
+    self.assertEquals(None, canonicals.extract_canonical_url(content, BASE_URL))
+
+class CanonicalCacheTest(testutil.HandlerTestBase):
+  """Tests for CanonicalCache."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    self.cache = canonicals.CanonicalCache()
+
+  def testPutAndGet(self):
+    self.assertEquals(None, self.cache.get("http://foo.com/a"))
+    self.assertTrue(self.cache.put("http://foo.com/a", "http://foo.com/b"))
+    self.assertEquals("http://foo.com/b", self.cache.get("http://foo.com/a"))
+    self.assertEquals("http://foo.com/b",
+        CanonicalDbDatum.get_by_id("http://foo.com/a").canonical_url)
+    #Other run reads it from datastore.
+    canonicals.memcache.flush_all()
+    other_cache = canonicals.CanonicalCache()
+    self.assertEquals("http://foo.com/b", other_cache.get("http://foo.com/a"))
+
+  def testResolve(self):
+    self.cache.put("http://foo.com/a", "http://foo.com/b")
+    self.cache.put("http://foo.com/b", "http://foo.com/c")
+    self.assertEquals("http://foo.com/c", self.cache.resolve("http://foo.com/a"))
+    self.assertEquals("http://foo.com/d", self.cache.resolve("http://foo.com/d"))
+
+  def testPrefetch(self):
+    self.cache.put("http://foo.com/a", "http://foo.com/b")
+    canonicals.memcache.flush_all()
+    other_cache = canonicals.CanonicalCache()
+    other_cache.prefetch(["http://foo.com/a", "http://foo.com/c"])
+    #The urls are cached in memcache, also the url that is not alias.
+    self.assertEquals("http://foo.com/b", canonicals.memcache.get(
+        "http://foo.com/a", namespace=canonicals.MEMCACHE_NAMESPACE))
+    self.assertEquals("", canonicals.memcache.get(
+        "http://foo.com/c", namespace=canonicals.MEMCACHE_NAMESPACE))
+    self.assertEquals("http://foo.com/b", other_cache.get("http://foo.com/a"))
+    self.assertEquals(None, other_cache.get("http://foo.com/c"))
+
+  def testPrefetchInBatches(self):
+    get_multi = canonicals.memcache.get_multi
+    batches = []
+    def record_get_multi(keys, *args, **kwargs):
+      batches.append(len(keys))
+      return get_multi(keys, *args, **kwargs)
+    max_batch_size = canonicals.MAX_BATCH_SIZE
+    canonicals.MAX_BATCH_SIZE = 2
+    canonicals.memcache.get_multi = record_get_multi
+    try:
+      self.cache.prefetch(["http://foo.com/%d" % i for i in range(5)])
+    finally:
+      canonicals.MAX_BATCH_SIZE = max_batch_size
+      canonicals.memcache.get_multi = get_multi
+    self.assertEquals([2, 2, 1], batches)
+    self.assertEquals("", canonicals.memcache.get(
+        "http://foo.com/4", namespace=canonicals.MEMCACHE_NAMESPACE))
+
+  def testLoop(self):
+    self.assertTrue(self.cache.put("http://foo.com/a", "http://foo.com/b"))
+    self.assertFalse(self.cache.put("http://foo.com/b", "http://foo.com/a"))
+    self.assertFalse(self.cache.put("http://foo.com/c", "http://foo.com/c"))
+    self.assertEquals("http://foo.com/b", self.cache.resolve("http://foo.com/a"))
+    self.assertEquals("http://foo.com/b", self.cache.resolve("http://foo.com/b"))
+
+if __name__ == "__main__":
+  unittest.main()
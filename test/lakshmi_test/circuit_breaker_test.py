@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from testlib import testutil
+from lakshmi import circuit_breaker
+
+class HostCircuitBreakerTest(testutil.HandlerTestBase):
+  """Tests for HostCircuitBreaker."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    self.breaker = circuit_breaker.HostCircuitBreaker(failure_threshold=3,
+                                                      cooldown=60)
+    self.now = 1000.0
+    self.breaker._time = lambda: self.now
+
+  def testOpenAfterConsecutiveFailures(self):
+    host = "http://foo.com"
+    self.assertFalse(self.breaker.record_failure(host))
+    self.assertFalse(self.breaker.record_failure(host))
+    self.assertTrue(self.breaker.allow(host))
+    self.assertTrue(self.breaker.record_failure(host))
+    self.assertFalse(self.breaker.allow(host))
+    self.assertTrue(self.breaker.allow("http://bar.com"))
+
+  def testSuccessResetsFailures(self):
+    host = "http://foo.com"
+    self.breaker.record_failure(host)
+    self.breaker.record_failure(host)
+    #Other shard sees the failures, and resets them by success.
+    other_breaker = circuit_breaker.HostCircuitBreaker(failure_threshold=3)
+    self.assertTrue(other_breaker.allow(host))
+    other_breaker.record_success(host)
+    self.assertFalse(self.breaker.record_failure(host))
+    self.assertTrue(self.breaker.allow(host))
+
+  def testHalfOpenProbe(self):
+    host = "http://foo.com"
+    for i in range(3):
+      self.breaker.record_failure(host)
+    self.assertFalse(self.breaker.allow(host))
+    self.now += 61
+    #Only one probe is allowed.
+    self.assertTrue(self.breaker.allow(host))
+    self.assertFalse(self.breaker.allow(host))
+    #The probe failed, the circuit is open again.
+    self.assertTrue(self.breaker.record_failure(host))
+    self.assertFalse(self.breaker.allow(host))
+    self.now += 61
+    self.assertTrue(self.breaker.allow(host))
+    #The probe succeeded, the circuit is closed.
+    self.breaker.record_success(host)
+    self.assertTrue(self.breaker.allow(host))
+    self.assertTrue(self.breaker.allow(host))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -14,17 +14,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import BaseHTTPServer
+import codecs
 import os
+import SocketServer
+import threading
+import time
 import unittest
+import gzip
+import StringIO
+import zlib
 
 from testlib import testutil
 from lakshmi import fetchers
 from lakshmi import configuration
 from lakshmi import errors
+from google.appengine.api import apiproxy_stub
 from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import urlfetch
 from google.appengine.api import urlfetch_stub
 
 
+class MockPolitenessScheduler(object):
+  """PolitenessScheduler that returns the given wait times."""
+  max_wait = 10
+
+  def __init__(self, wait_times):
+    self.wait_times = wait_times
+    self.hosts = []
+
+  def reserve(self, host):
+    self.hosts.append(host)
+    return self.wait_times.pop(0)
+
 class SimpleHttpFetcherTest(testutil.FetchTestBase):
   
   def assertLR(self, resultL, resultR):
@@ -122,6 +144,233 @@ class SimpleHttpFetcherTest(testutil.FetchTestBase):
     self.assertTrue(content_type!=None)
     self.assertEquals("text/html", content_type)
   
+  def testFetchResultHeaders(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    result = simple_http_fetcher.get("http://static_resource/simple-page.html")
+    self.assertTrue(isinstance(result, fetchers.FetchResult))
+    self.assertEquals("text/html", result.get_header("content-type"))
+    self.assertEquals("text/html", result["mime_type"])
+    self.assertEquals(None, result.get("_lowered_headers"))
+    self.assertEquals(None, result.get("unknown"))
+    #Headers are not duplicated in lowercase.
+    self.assertEquals(2, len(result.headers.keys()))
+
+  def testCharsetDetection(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    url = "http://static_resource/simple-page.html"
+    text = u"<html><head><title>\u30c6\u30b9\u30c8</title></head></html>"
+    #Charset of Content-Type header.
+    static_content = text.encode("euc-jp")
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html; charset=EUC-JP"})
+    result = simple_http_fetcher.get(url)
+    self.assertEquals("euc_jp", result.encoding)
+    self.assertEquals(text, result.text)
+    #Charset of <meta> declaration.
+    meta = u"<meta http-equiv=\"Content-Type\" content=\"text/html; charset=Shift_JIS\">"
+    static_content = (meta + text).encode("shift_jis")
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    result = simple_http_fetcher.get(url)
+    self.assertEquals("shift_jis", result.encoding)
+    self.assertEquals(meta + text, result.text)
+    #Byte order mark.
+    static_content = codecs.BOM_UTF8 + text.encode("utf-8")
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    result = simple_http_fetcher.get(url)
+    self.assertEquals("utf-8", result.encoding)
+    self.assertEquals(text, result.text)
+    #Not declared, and not valid in utf-8.
+    self.assertEquals(fetchers.FALLBACK_CHARSET,
+                      fetchers.detect_charset("caf\xe9 au lait"))
+    #Truncated in the middle of a character.
+    static_content = text.encode("utf-8")[:21]
+    self.assertEquals("utf-8", fetchers.detect_charset(static_content))
+    self.assertEquals("utf-8", fetchers.detect_charset(buffer(static_content)))
+
+  def testErrorStatus(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    url = "http://static_resource/simple-page.html"
+    self.setReturnValue(status_code=503,
+                        headers={"Content-Type": "text/html",
+                                 "Retry-After": "120"})
+    try:
+      simple_http_fetcher.get(url)
+      self.fail("RetryableFetchError should be raised")
+    except errors.RetryableFetchError as e:
+      self.assertEquals(503, e.status_code)
+      self.assertEquals(120.0, e.retry_after)
+      self.assertTrue(fetchers.is_retryable_error(e))
+    self.setReturnValue(status_code=404,
+                        headers={"Content-Type": "text/html"})
+    try:
+      simple_http_fetcher.get(url)
+      self.fail("HttpFetchError should be raised")
+    except errors.HttpFetchError as e:
+      self.assertEquals(404, e.status_code)
+      self.assertFalse(fetchers.is_retryable_error(e))
+
+  def testRetryDelay(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    policy = fetchers.compile_fetcher_policy(fetcher_policy_yaml.fetcher_policy)
+    base_delay = policy.retry_base_delay
+    self.assertEquals(base_delay / 2.0,
+                      fetchers.get_retry_delay(policy, 1, random=lambda: 0.0))
+    self.assertEquals(base_delay * 4,
+                      fetchers.get_retry_delay(policy, 3, random=lambda: 1.0))
+    self.assertEquals(policy.max_retry_delay,
+                      fetchers.get_retry_delay(policy, 100, random=lambda: 1.0))
+    self.assertEquals(base_delay * 10,
+                      fetchers.get_retry_delay(policy, 1, base_delay * 10,
+                                               random=lambda: 1.0))
+    self.assertEquals(30.0, fetchers.parse_retry_after(
+        "Mon, 01 Oct 2012 00:00:30 GMT", now=1349049600))
+    self.assertEquals(None, fetchers.parse_retry_after("invalid"))
+
+  def testCompiledFetcherPolicy(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    policy = fetchers.compile_fetcher_policy(fetcher_policy_yaml.fetcher_policy)
+    self.assertEquals(5000, policy.get_max_content_size("image/png"))
+    self.assertEquals(1000, policy.get_max_content_size("text/html"))
+    self.assertEquals(frozenset(["text/html", "image/png"]), policy.valid_mime_types)
+    self.assertTrue(policy.is_valid_mime_type("image/png"))
+    self.assertFalse(policy.is_valid_mime_type("text/xml"))
+    self.assertEquals(20.0, policy.request_timeout)
+    self.assertEquals(15.0, policy.crawl_end_time)
+    default_policy = fetchers.compile_fetcher_policy(
+        configuration.FetcherPolicyYaml.create_default_policy().fetcher_policy)
+    self.assertEquals(None, default_policy.crawl_end_time)
+    self.assertTrue(policy.follow_redirects)
+    self.assertTrue(policy.headers["User-Agent"].startswith("Mozilla/5.0 (compatible; test/"))
+    self.assertTrue(policy is fetchers.compile_fetcher_policy(policy))
+    self.assertRaises(AttributeError, setattr, policy, "min_response_rate", 1)
+
+  def testProbeRejectsInvalidMimeType(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    self.setReturnValue(headers={"Content-Length": 20000,
+                                 "Content-Type": "application/pdf"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, probe_mode=fetchers.PROBE_NON_TEXT)
+    self.assertRaises(errors.AbortedFetchError,
+                      simple_http_fetcher.get, "http://static_resource/docs/a.pdf")
+    self.assertEquals(urlfetch.HEAD, self._urlfetch_mock.request.method())
+    #The url of same pattern is rejected by probe cache without request.
+    self.setReturnValue(headers={"Content-Length": 20000,
+                                 "Content-Type": "text/html"})
+    self.assertRaises(errors.AbortedFetchError,
+                      simple_http_fetcher.get, "http://static_resource/docs/b.pdf")
+    #Text content is not probed.
+    result = simple_http_fetcher.get("http://static_resource/docs/c.html")
+    self.assertEquals(urlfetch.GET, self._urlfetch_mock.request.method())
+    self.assertEquals("text/html", result.mime_type)
+
+  def testProbeRejectsLargeContent(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    self.setReturnValue(headers={"Content-Length": 10000,
+                                 "Content-Type": "image/png"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, probe_mode=fetchers.PROBE_ALL)
+    self.assertRaises(errors.AbortedFetchError,
+                      simple_http_fetcher.get, "http://static_resource/image?id=1")
+    self.assertEquals(urlfetch.HEAD, self._urlfetch_mock.request.method())
+
+  def testProbeWithoutExtensionIsNotCached(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    self.setReturnValue(headers={"Content-Length": 100,
+                                 "Content-Type": "application/pdf"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, probe_mode=fetchers.PROBE_ALL)
+    self.assertRaises(errors.AbortedFetchError,
+                      simple_http_fetcher.get, "http://static_resource/images/a")
+    #Other url of the same directory is probed again.
+    self.setReturnValue(content="a" * 100,
+                        headers={"Content-Length": 100,
+                                 "Content-Type": "image/png"})
+    result = simple_http_fetcher.get("http://static_resource/images/b")
+    self.assertEquals("image/png", result.mime_type)
+
+  def testProbeOfDynamicPageIsNotCached(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    self.setReturnValue(headers={"Content-Length": 100,
+                                 "Content-Type": "application/pdf"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, probe_mode=fetchers.PROBE_ALL)
+    self.assertRaises(errors.AbortedFetchError,
+                      simple_http_fetcher.get, "http://static_resource/image.php?id=1")
+    #The dynamic page of the same directory may serve other content type.
+    self.setReturnValue(content="a" * 100,
+                        headers={"Content-Length": 100,
+                                 "Content-Type": "image/png"})
+    result = simple_http_fetcher.get("http://static_resource/image.php?id=2")
+    self.assertEquals("image/png", result.mime_type)
+    self.assertEquals(None, fetchers._get_probe_pattern(
+        "http://static_resource/image.php?id=2"))
+    self.assertEquals(None, fetchers._get_probe_pattern(
+        "http://static_resource/images/a"))
+
+  def testProbeWaitsForNextSlot(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    #The probe takes the first slot, and the GET request the next.
+    scheduler = MockPolitenessScheduler([0, 3])
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, probe_mode=fetchers.PROBE_ALL,
+        politeness_scheduler=scheduler)
+    slept = []
+    simple_http_fetcher._sleep = slept.append
+    self.setReturnValue(content="a" * 100,
+                        headers={"Content-Length": 100,
+                                 "Content-Type": "image/png"})
+    result = simple_http_fetcher.get("http://static_resource/images/a.png")
+    self.assertEquals("image/png", result.mime_type)
+    self.assertEquals(["http://static_resource"] * 2, scheduler.hosts)
+    self.assertEquals([3], slept)
+    #The GET request is deferred, if the slot is later than max_wait,
+    #that is retried without counting a failure of host.
+    scheduler.wait_times.extend([0, scheduler.max_wait + 1])
+    self.assertRaises(errors.DeferredFetchError,
+                      simple_http_fetcher.get, "http://static_resource/images/b")
+    self.assertEquals([3], slept)
+
+  def testGetManyWaitsForSlot(self):
+    fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+    scheduler = MockPolitenessScheduler([0, 2, MockPolitenessScheduler.max_wait + 1])
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+        fetcher_policy_yaml.fetcher_policy, politeness_scheduler=scheduler)
+    now = [100.0]
+    simple_http_fetcher._time = lambda: now[0]
+    def sleep(seconds):
+      now[0] += seconds
+    simple_http_fetcher._sleep = sleep
+    self.setReturnValue(content="a" * 100,
+                        headers={"Content-Length": 100,
+                                 "Content-Type": "text/html"})
+    fetch_urls = ["http://static_resource/a", "http://static_resource/b",
+                  "http://static_resource/c"]
+    results = dict((url, (result, error)) for url, result, error
+                   in simple_http_fetcher.get_many(fetch_urls))
+    self.assertEquals(3, len(results))
+    self.assertEquals(None, results["http://static_resource/a"][1])
+    #The second url waits for its slot without blocking the first.
+    self.assertEquals(None, results["http://static_resource/b"][1])
+    self.assertTrue(now[0] >= 102.0)
+    #The slot later than max_wait is deferred to next run.
+    self.assertTrue(isinstance(results["http://static_resource/c"][1],
+                               errors.DeferredFetchError))
+
   def redirectUrl(self):
     return "http://static_resource/redirect"
   
@@ -194,7 +443,386 @@ class SimpleHttpFetcherTest(testutil.FetchTestBase):
     simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
                                    fetcher_policy_yaml.fetcher_policy)
     simple_http_fetcher.get(url)
-  
+
+  def testGetMany(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    urls = ["http://static_resource/page_%d.html" % i for i in range(5)]
+    results = list(simple_http_fetcher.get_many(urls, max_in_flight=2))
+    self.assertEquals(5, len(results))
+    self.assertEquals(set(urls), set([url for url, result, error in results]))
+    for url, result, error in results:
+      self.assertTrue(error is None)
+      self.assertEquals(static_content, result.get("content"))
+
+  def testGetManyHostLimit(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    #The urls of a host wait for the limit of the host.
+    urls = ["http://static_resource/page_%d.html" % i for i in range(10)]
+    results = list(simple_http_fetcher.get_many(urls, max_in_flight=10))
+    self.assertEquals(set(urls), set([url for url, result, error in results]))
+    stats = simple_http_fetcher.get_host_stats(urls[0])
+    self.assertEquals(0, stats.in_flight)
+    self.assertTrue(stats.limit > fetchers.INITIAL_HOST_CONCURRENCY)
+
+  def testGetManyAbort(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    urls = ["http://static_resource/page_%d.html" % i for i in range(5)]
+    results = []
+    for url, result, error in simple_http_fetcher.get_many(urls, max_in_flight=2):
+      results.append(url)
+      simple_http_fetcher.abort()
+    #The outstanding request is dropped.
+    self.assertEquals(1, len(results))
+    self.assertEquals(0, simple_http_fetcher.get_host_stats(urls[0]).in_flight)
+    #The fetcher can be used after abort.
+    result = simple_http_fetcher.get(urls[0])
+    self.assertEquals(static_content, result.content)
+
+  def testGetManyClose(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    urls = ["http://static_resource/page_%d.html" % i for i in range(5)]
+    results = simple_http_fetcher.get_many(urls, max_in_flight=2)
+    results.next()
+    #The outstanding requests are released by close of the generator.
+    results.close()
+    self.assertEquals(0, simple_http_fetcher.get_host_stats(urls[0]).in_flight)
+
+  def testGetManyPolicyError(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    self.setReturnValue(headers={"Content-Length": 20000,
+                                 "Content-Type": "text/xml"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    urls = ["http://static_resource/simple-page.html",
+            "invalidScheme://static_resource/simple-page.html"]
+    results = list(simple_http_fetcher.get_many(urls))
+    self.assertEquals(2, len(results))
+    for url, result, error in results:
+      self.assertTrue(result is None)
+      self.assertTrue(error is not None)
+    errors_by_url = dict((url, error) for url, result, error in results)
+    self.assertTrue(isinstance(errors_by_url[urls[0]], errors.AbortedFetchError))
+
+  def testGzipDecompressionIsBounded(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    buf = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode="w")
+    gzip_file.write("a" * 1000000)
+    gzip_file.close()
+    static_content = buf.getvalue()
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html",
+                                 "Content-Encoding": "gzip"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    result = simple_http_fetcher.get("http://static_resource/large.html")
+    self.assertEquals(1000, result.get("content_length"))
+    self.assertEquals("a" * 1000, result.get("content"))
+
+  def testTruncatedGzipImage(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy_sizes.yaml")
+    buf = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode="w")
+    gzip_file.write(os.urandom(500))
+    gzip_file.close()
+    #The compressed body is cut off by urlfetch.
+    static_content = buf.getvalue()[:200]
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "image/png",
+                                 "Content-Encoding": "gzip"},
+                        content_was_truncated=True)
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    self.assertRaisesRegexp(errors.AbortedFetchError, "Truncated image",
+                            simple_http_fetcher.get,
+                            "http://static_resource/image.png")
+
+  def testDeflateDecompression(self):
+    fetcher_policy_yaml = self.getCustomFetcherPolicy("fetcher_policy.yaml")
+    static_content = "<html><body>TestContent</body></html>"
+    compressed = zlib.compress(static_content)
+    self.setReturnValue(content=compressed,
+                        headers={"Content-Length": len(compressed),
+                                 "Content-Type": "text/html",
+                                 "Content-Encoding": "deflate"})
+    simple_http_fetcher = fetchers.SimpleHttpFetcher(1,
+                                   fetcher_policy_yaml.fetcher_policy)
+    result = simple_http_fetcher.get("http://static_resource/simple-page.html")
+    self.assertEquals(static_content, result.get("content"))
+    self.assertEquals(len(static_content), result.get("content_length"))
+
+class HostStatsTest(unittest.TestCase):
+  """Tests for HostStats."""
+
+  def testConcurrencyLimit(self):
+    stats = fetchers.HostStats(4)
+    self.assertEquals(fetchers.INITIAL_HOST_CONCURRENCY, stats.limit)
+    stats.in_flight = 2
+    self.assertFalse(stats.can_start())
+    for i in range(3):
+      stats.record_success(0.1, 1000)
+    self.assertTrue(stats.can_start())
+    for i in range(100):
+      stats.record_success(0.1, 1000)
+    self.assertEquals(4, stats.limit)
+    stats.record_failure()
+    self.assertEquals(2, stats.limit)
+    for i in range(10):
+      stats.record_failure()
+    self.assertEquals(1, stats.limit)
+    self.assertEquals(10000, int(stats.read_rate))
+
+  def testTimeout(self):
+    stats = fetchers.HostStats(4)
+    for i in range(fetchers.MIN_HOST_LATENCY_SAMPLES - 1):
+      stats.record_success(1.0, 1000)
+    self.assertEquals(20.0, stats.get_timeout(20.0))
+    stats.record_success(1.0, 1000)
+    self.assertEquals(3.0, stats.get_timeout(20.0))
+    for i in range(fetchers.HOST_LATENCY_SAMPLES):
+      stats.record_success(0.01, 1000)
+    self.assertEquals(fetchers.MIN_HOST_TIMEOUT, stats.get_timeout(20.0))
+    for i in range(fetchers.HOST_LATENCY_SAMPLES):
+      stats.record_success(30.0, 1000)
+    self.assertEquals(20.0, stats.get_timeout(20.0))
+
+class RedirectURLFetchServiceMock(apiproxy_stub.APIProxyStub):
+  """Mock for urlfetch, that returns the response specified by url."""
+  def __init__(self, responses, service_name="urlfetch"):
+    super(RedirectURLFetchServiceMock, self).__init__(service_name)
+    self.responses = responses
+    self.requested_urls = []
+
+  def _Dynamic_Fetch(self, request, response):
+    self.requested_urls.append(request.url())
+    status_code, headers = self.responses[request.url()]
+    response.set_content("")
+    response.set_statuscode(status_code)
+    for header_key, header_value in headers.items():
+      new_header = response.add_header()
+      new_header.set_key(header_key)
+      new_header.set_value(header_value)
+    response.set_finalurl(request.url())
+    response.set_contentwastruncated(False)
+
+class RedirectFetcherTest(unittest.TestCase):
+  """Tests for redirects of SimpleHttpFetcher."""
+
+  def setUp(self):
+    unittest.TestCase.setUp(self)
+    self.responses = {
+      "http://static_resource/old": (301, {"Location": "/moved"}),
+      "http://static_resource/moved": (302, {"Location": "http://static_resource/final"}),
+      "http://static_resource/final": (200, {"Content-Type": "text/html"}),
+      "http://static_resource/loop": (302, {"Location": "http://static_resource/loop"}),
+    }
+    self._urlfetch_mock = RedirectURLFetchServiceMock(self.responses)
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub("urlfetch", self._urlfetch_mock)
+    fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+    self.redirect_cache = fetchers.RedirectCache()
+    self.fetcher = fetchers.SimpleHttpFetcher(1, fetcher_policy_yaml.fetcher_policy,
+                                              redirect_cache=self.redirect_cache)
+
+  def testFollowRedirects(self):
+    result = self.fetcher.get("http://static_resource/old")
+    self.assertEquals("http://static_resource/final", result.fetched_url)
+    self.assertEquals(["http://static_resource/moved",
+                       "http://static_resource/final"], result.redirects)
+    #Only permanent redirect is cached.
+    self.assertEquals("http://static_resource/moved",
+                      self.redirect_cache.get("http://static_resource/old"))
+    self.assertEquals(None, self.redirect_cache.get("http://static_resource/moved"))
+
+    self._urlfetch_mock.requested_urls = []
+    result = self.fetcher.get("http://static_resource/old")
+    self.assertEquals("http://static_resource/final", result.fetched_url)
+    self.assertEquals(["http://static_resource/moved",
+                       "http://static_resource/final"],
+                      self._urlfetch_mock.requested_urls)
+
+  def testMaxRedirects(self):
+    self.assertRaises(errors.RedirectError,
+                      self.fetcher.get, "http://static_resource/loop")
+    max_redirects = configuration.FetcherPolicyYaml.create_default_policy(
+        ).fetcher_policy.max_redirects
+    self.assertEquals(int(max_redirects) + 1, len(self._urlfetch_mock.requested_urls))
+
+class _LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def handle_error(self, request, client_address):
+    #Truncated responses are reset by the fetcher.
+    pass
+
+class _LocalHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handler of local HTTP/1.1 server for PooledHttpFetcher."""
+  protocol_version = "HTTP/1.1"
+  connection_count = 0
+  pages = {
+    "/page.html": (200, "text/html", "<html><body>TestContent</body></html>"),
+    "/redirect": (301, "text/html", ""),
+    "/large.html": (200, "text/html", "a" * 5000),
+    "/large.png": (200, "image/png", "a" * 10000),
+  }
+
+  def setup(self):
+    _LocalHTTPHandler.connection_count += 1
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+  def do_GET(self):
+    path = self.path.split("?")[0]
+    if path == "/slow":
+      #The body trickles, so each read is within the timeout of socket.
+      self.send_response(200)
+      self.send_header("Content-Type", "text/html")
+      self.send_header("Content-Length", "100")
+      self.end_headers()
+      for i in range(100):
+        self.wfile.write("a")
+        self.wfile.flush()
+        time.sleep(0.05)
+      return
+    if path == "/chunked":
+      self.send_response(200)
+      self.send_header("Content-Type", "text/html")
+      self.send_header("Transfer-Encoding", "chunked")
+      self.end_headers()
+      for chunk in ("<html>", "<body>Chunked</body>", "</html>"):
+        self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+      self.wfile.write("0\r\n\r\n")
+      return
+    status_code, content_type, content = self.pages[path]
+    self.send_response(status_code)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(content)))
+    if status_code == 301:
+      self.send_header("Location", "/page.html")
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, format, *args):
+    pass
+
+class PooledHttpFetcherTest(unittest.TestCase):
+  """Tests for PooledHttpFetcher with local HTTP server."""
+
+  def setUp(self):
+    unittest.TestCase.setUp(self)
+    _LocalHTTPHandler.connection_count = 0
+    self.server = _LocalHTTPServer(("127.0.0.1", 0), _LocalHTTPHandler)
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+    self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+    yaml_path = os.path.join(os.path.dirname(__file__), "resource",
+                             "fetcher_policy_sizes.yaml")
+    self.fetcher_policy = configuration.parse_fetcher_policy_yaml(
+        open(yaml_path)).fetcher_policy
+    self.fetcher = fetchers.PooledHttpFetcher(1, self.fetcher_policy)
+
+  def tearDown(self):
+    self.fetcher.abort()
+    self.server.shutdown()
+    self.server.server_close()
+    unittest.TestCase.tearDown(self)
+
+  def testKeepAlive(self):
+    for i in range(3):
+      result = self.fetcher.get(self.base_url + "/page.html")
+      self.assertEquals(200, result.status_code)
+      self.assertEquals("<html><body>TestContent</body></html>", result.content)
+      self.assertEquals("text/html", result.mime_type)
+    self.assertEquals(1, _LocalHTTPHandler.connection_count)
+
+  def testRedirect(self):
+    result = self.fetcher.get(self.base_url + "/redirect")
+    self.assertEquals(self.base_url + "/page.html", result.fetched_url)
+    self.assertEquals([self.base_url + "/page.html"], result.redirects)
+
+  def testTruncation(self):
+    result = self.fetcher.get(self.base_url + "/large.html")
+    self.assertEquals(1000, result.content_length)
+    self.assertEquals("a" * 1000, result.content)
+    #The truncated content is a view of received bytes.
+    self.assertTrue(isinstance(result.content_buffer, buffer))
+    self.assertEquals(1000, len(result.content_buffer))
+    self.assertEquals(u"a" * 1000, result.text)
+    self.assertRaises(errors.AbortedFetchError,
+                      self.fetcher.get, self.base_url + "/large.png")
+    #Truncated connections are not reused.
+    self.fetcher.get(self.base_url + "/page.html")
+    self.assertEquals(3, _LocalHTTPHandler.connection_count)
+
+  def testGetManyAbort(self):
+    urls = ["%s/page.html?%d" % (self.base_url, i) for i in range(20)]
+    results = []
+    for url, result, error in self.fetcher.get_many(urls, max_in_flight=2):
+      results.append(url)
+      self.fetcher.abort()
+    self.assertEquals(1, len(results))
+
+  def testChunked(self):
+    for i in range(2):
+      result = self.fetcher.get(self.base_url + "/chunked")
+      self.assertEquals("<html><body>Chunked</body></html>", result.content)
+    self.assertEquals(1, _LocalHTTPHandler.connection_count)
+
+  def testDeadline(self):
+    self.fetcher_policy.request_timeout = "500"
+    fetcher = fetchers.PooledHttpFetcher(1, self.fetcher_policy)
+    start_time = time.time()
+    self.assertRaises(errors.RetryableFetchError,
+                      fetcher.get, self.base_url + "/slow")
+    #The body is not finished in 5 seconds, the request fails at
+    #the deadline of request, not at the timeout of each read.
+    self.assertTrue(time.time() - start_time < 2)
+
+  def testCreateFetcher(self):
+    self.assertTrue(isinstance(fetchers.create_fetcher(1, self.fetcher_policy),
+                               fetchers.SimpleHttpFetcher))
+    self.assertFalse(isinstance(fetchers.create_fetcher(1, self.fetcher_policy),
+                                fetchers.PooledHttpFetcher))
+    self.fetcher_policy.fetch_engine = configuration.FETCH_ENGINE_POOLED
+    self.assertTrue(isinstance(fetchers.create_fetcher(1, self.fetcher_policy),
+                               fetchers.PooledHttpFetcher))
+
+  def testGetMany(self):
+    urls = ["%s/page.html?%d" % (self.base_url, i) for i in range(20)]
+    results = list(self.fetcher.get_many(urls, max_in_flight=5))
+    self.assertEquals(sorted(urls), sorted(url for url, result, error in results))
+    for url, result, error in results:
+      self.assertEquals(None, error)
+      self.assertEquals("<html><body>TestContent</body></html>", result.content)
+    #Connections are reused across the urls.
+    self.assertTrue(_LocalHTTPHandler.connection_count < len(urls))
+
 class SimpleHttpFetcherRealTest(unittest.TestCase):
   def setUp(self):
     unittest.TestCase.setUp(self)
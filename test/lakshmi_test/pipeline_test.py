@@ -16,9 +16,12 @@
 
 import unittest
 import os
+import datetime
 import re
+import time
 
 from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
 
 from mapreduce.lib import files
 from mapreduce.lib import pipeline
@@ -26,6 +29,10 @@ from mapreduce.lib.files import file_service_pb
 from mapreduce import input_readers
 from testlib import testutil
 from mapreduce import test_support
+from lakshmi import cache
+from lakshmi import canonicals
+from lakshmi import circuit_breaker
+from lakshmi import fetchers
 from lakshmi import pipelines
 from lakshmi.datum import CrawlDbDatum
 from lakshmi.datum import FetchedDbDatum
@@ -58,6 +65,20 @@ def createMockFetchedDatum(url, html_text, status):
         fetched_content = html_text, content_type="text/html")
     fetched_datum.put()
 
+def createFetchSetRecord(fetch_set):
+  """Create the record of fetch set, that is the input of _fetchMap."""
+  proto = file_service_pb.KeyValue()
+  proto.set_key(pipelines.getDomain(fetch_set[0][0]))
+  proto.set_value(pipelines._encode_fetch_set(fetch_set))
+  return proto
+
+class BusyPolitenessScheduler(object):
+  """PolitenessScheduler whose next slot of host is later than max_wait."""
+  max_wait = 10
+
+  def reserve(self, host):
+    return self.max_wait + 1
+
 def createLinkDatum(parent_url, url):
   """Create Link CrawlDbDatum mock data."""
   key = ndb.Key(CrawlDbDatum, parent_url)
@@ -106,6 +127,35 @@ class ExactDomainPilelineTest(testutil.HandlerTestBase):
     entities = query.fetch()
     for entity in entities:
       self.assertEquals("http://hoge_0.com", entity.extract_domain_url)
+
+  def testOnlyPendingUrls(self):
+    createMockCrawlDbDatum(2, 2, False)
+    createMockFetchedDatum("http://fetched.com/content_0", "Content", pipelines.FETCHED)
+    p = pipelines._ExactDomainMapreducePipeline("ExactDomainMapreducePipeline",
+                                                 params={
+                                                         "entity_kind": "lakshmi.datum.CrawlDbDatum",
+                                                         },
+                                                 shard_count=3)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+    finished_map = pipelines._ExactDomainMapreducePipeline.from_id(p.pipeline_id)
+
+    domains = []
+    for file_path in finished_map.outputs.default.value:
+      blob_key = files.blobstore.get_blob_key(file_path)
+      reader = input_readers.BlobstoreLineInputReader(blob_key, 0, 100)
+      domains.extend(content[1] for content in reader if content[1])
+    self.assertEquals(["http://hoge_0.com", "http://hoge_1.com"], sorted(domains))
+
+  def testExtractDomainUrlAtPut(self):
+    url = "http://hoge_0.com/content_0"
+    datum = CrawlDbDatum(parent=ndb.Key(CrawlDbDatum, url), url=url,
+                         last_status=pipelines.UNFETCHED)
+    datum.put()
+    self.assertEquals("http://hoge_0.com", datum.extract_domain_url)
+    #The domain is not written again by the map function.
+    results = list(pipelines._extact_domain_map(datum))
+    self.assertEquals([("http://hoge_0.com", "")], results)
     
 class RobotFetcherPipelineTest(testutil.HandlerTestBase):
   """Tests for RobotFetcherPipelineTest."""
@@ -194,6 +244,58 @@ class RobotFetcherPipelineTest(testutil.HandlerTestBase):
       self.assertEquals("invalidScheme://test_url.com", key)
       self.assertEquals("User-agent: *\nDisallow: /", value)
 
+class RobotsFetchSetsBufferPipelineTest(testutil.HandlerTestBase):
+  """Tests for RobotsFetchSetsBufferPipeline."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    pipeline.Pipeline._send_mail = self._send_mail
+    self.emails = []
+
+  def _send_mail(self, sender, subject, body, html=None):
+    """Callback function for sending mail."""
+    self.emails.append((sender, subject, body, html))
+
+  def createMockData(self, domain_count):
+    file_path = files.blobstore.create("text/plain", "myblob")
+    with files.open(file_path, 'a') as fp:
+      fp.write("\n".join(["http://hoge_%d.com" % i for i in range(domain_count)]))
+    files.finalize(file_path)
+    blob_key = files.blobstore.get_blob_key(file_path)
+    return [str(files.blobstore.get_file_name(blob_key))]
+
+  def testSuccessfulRun(self):
+    blob_keys = self.createMockData(2)
+    createMockCrawlDbDatum(2, 3, True)
+    static_content = "User-agent: *\nDisallow: /content_0"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/plain"})
+    p = pipelines._RobotsFetchSetsBufferPipeline("RobotsFetchSetsBufferPipeline",
+                                                 blob_keys, 2)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+    finished_map = pipelines._RobotsFetchSetsBufferPipeline.from_id(p.pipeline_id)
+
+    #The fetch sets are created in the same pass.
+    file_paths = finished_map.outputs.default.value
+    self.assertTrue(len(file_paths) > 0)
+    reader = input_readers.RecordsReader(file_paths, 0)
+    fetch_sets = {}
+    for binary_record in reader:
+      proto = file_service_pb.KeyValue()
+      proto.ParseFromString(binary_record)
+      #The urls of domain are grouped to a fetch set.
+      for url, can_fetch in pipelines._decode_fetch_set(proto.value()):
+        self.assertEquals(proto.key(), pipelines.getDomain(url))
+        fetch_sets[url] = can_fetch
+    self.assertEquals(6, len(fetch_sets))
+    for d in range(2):
+      self.assertFalse(fetch_sets["http://hoge_%d.com/content_0" % d])
+      self.assertTrue(fetch_sets["http://hoge_%d.com/content_1" % d])
+    #The robots.txt is cached for next run.
+    self.assertEquals(static_content, pipelines.robots_cache.get("http://hoge_0.com"))
+
 class FetchSetsBufferPipelineTest(testutil.HandlerTestBase):
   """Tests for FetchSetsBufferPipeline."""
   def setUp(self):
@@ -252,22 +354,21 @@ class FetchPagePipelineTest(testutil.HandlerTestBase):
     testutil.HandlerTestBase.setUp(self)
     pipeline.Pipeline._send_mail = self._send_mail
     self.emails = []
+    pipelines.canonical_cache = canonicals.CanonicalCache()
 
   def _send_mail(self, sender, subject, body, html=None):
     """Callback function for sending mail."""
     self.emails.append((sender, subject, body, html))
 
   def createMockData(self, data):
-    """Create mock data for FetchSetsBufferPipeline"""
+    """Create mock data for FetchPagePipeline, data is url and can_fetch
+    or the list of them of a domain."""
+    if not isinstance(data, list):
+      data = [data]
     input_file = files.blobstore.create()
     with files.open(input_file, "a") as f:
       with records.RecordsWriter(f) as w:
-        key = str(data[0])
-        value = str(data[1])
-        proto = file_service_pb.KeyValue()
-        proto.set_key(key)
-        proto.set_value(value)
-        w.write(proto.Encode())
+        w.write(createFetchSetRecord(data).Encode())
 
     files.finalize(input_file)
     input_file = files.blobstore.get_file_name(
@@ -299,6 +400,284 @@ class FetchPagePipelineTest(testutil.HandlerTestBase):
     fetched_datum = FetchedDbDatum.query(ancestor=entity.key).fetch()
     self.assertTrue(fetched_datum is not None)
 
+  def testNotModified(self):
+    url = "http://hoge_0.com/content_0"
+    createMockFetchedDatum(url, "<html><body>Stored</body></html>", pipelines.FETCHED)
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    fetched_datum = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()[0]
+    fetched_datum.http_headers = str({"ETag": "\"abc\"",
+                                      "Last-Modified": "Mon, 01 Oct 2012 00:00:00 GMT"})
+    fetched_datum.put()
+    file_name = self.createMockData((url, True))
+    self.setReturnValue(status_code=304)
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    request_headers = dict((header.key(), header.value())
+                           for header in self._urlfetch_mock.request.header_list())
+    self.assertEquals("\"abc\"", request_headers.get("If-None-Match"))
+    self.assertEquals("Mon, 01 Oct 2012 00:00:00 GMT",
+                      request_headers.get("If-Modified-Since"))
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.FETCHED, crawl_db_datum.last_status)
+    self.assertTrue(crawl_db_datum.last_fetched is not None)
+    fetched_datums = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()
+    self.assertEquals(1, len(fetched_datums))
+    self.assertEquals("<html><body>Stored</body></html>", fetched_datums[0].fetched_content)
+
+  def testDuplicateContent(self):
+    createMockCrawlDbDatum(1, 2, True)
+    file_name1 = self.createMockData(("http://hoge_0.com/content_0", True))
+    file_name2 = self.createMockData(("http://hoge_0.com/content_1", True))
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name1, file_name2], 2)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    #The content is stored once, and referenced from the other url.
+    fetched_datums = FetchedDbDatum.query().fetch()
+    self.assertEquals(2, len(fetched_datums))
+    owners = [datum for datum in fetched_datums if datum.duplicate_of is None]
+    duplicates = [datum for datum in fetched_datums if datum.duplicate_of is not None]
+    self.assertEquals(1, len(owners))
+    self.assertEquals(1, len(duplicates))
+    self.assertEquals(static_content, owners[0].fetched_content)
+    self.assertEquals(None, duplicates[0].fetched_content)
+    self.assertEquals(owners[0].key.parent(), duplicates[0].duplicate_of)
+    self.assertEquals(owners[0].fingerprint, duplicates[0].fingerprint)
+    for url in ("http://hoge_0.com/content_0", "http://hoge_0.com/content_1"):
+      crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+      self.assertEquals(pipelines.FETCHED, crawl_db_datum.last_status)
+
+  def testDuplicateOfChangedOwner(self):
+    createMockCrawlDbDatum(1, 2, True)
+    owner_url = "http://hoge_0.com/content_0"
+    url = "http://hoge_0.com/content_1"
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html",
+                                 "ETag": "\"abc\""})
+    for fetch_url in (owner_url, url):
+      file_name = self.createMockData((fetch_url, True))
+      p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+      p.start()
+      test_support.execute_until_empty(self.taskqueue)
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    duplicate = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()[0]
+    self.assertNotEquals(None, duplicate.duplicate_of)
+
+    #The content of owner was changed.
+    owner_datum = pipelines._getFetchedDatum(duplicate.duplicate_of)
+    owner_datum.fingerprint = "changed"
+    owner_datum.put()
+    file_name = self.createMockData((url, True))
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    #The duplicate is fetched without validators, and stores the content.
+    request_headers = dict((header.key(), header.value())
+                           for header in self._urlfetch_mock.request.header_list())
+    self.assertEquals(None, request_headers.get("If-None-Match"))
+    fetched_datums = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()
+    self.assertEquals(1, len(fetched_datums))
+    self.assertEquals(None, fetched_datums[0].duplicate_of)
+    self.assertEquals(static_content, fetched_datums[0].fetched_content)
+
+  def testFetchSet(self):
+    createMockCrawlDbDatum(1, 3, True)
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    #The urls of a fetch set are fetched by a call.
+    proto = createFetchSetRecord([("http://hoge_0.com/content_0", True),
+                                  ("http://hoge_0.com/content_1", True),
+                                  ("http://hoge_0.com/content_2", False)])
+    fetched_urls = list(pipelines._fetchMap(proto.Encode()))
+
+    #The duplicate content is not output.
+    self.assertEquals(1, len(fetched_urls))
+    self.assertEquals(2, len(FetchedDbDatum.query().fetch()))
+    for n, status in enumerate([pipelines.FETCHED, pipelines.FETCHED,
+                                pipelines.FAILED]):
+      crawl_db_datum = CrawlDbDatum.query(
+          CrawlDbDatum.url=="http://hoge_0.com/content_%d" % n).fetch()[0]
+      self.assertEquals(status, crawl_db_datum.last_status)
+
+  def testHostLimitThrottlesSlowHost(self):
+    createMockCrawlDbDatum(1, 6, True)
+    #The host is too slow, every request exceeds the deadline.
+    def fetch_timeout(request, response):
+      raise apiproxy_errors.DeadlineExceededError("The host is too slow")
+    self._urlfetch_mock._Dynamic_Fetch = fetch_timeout
+    fetcher = fetchers.SimpleHttpFetcher(1, pipelines.fetcher_policy)
+    in_flight = []
+    wait_any = fetcher._wait_any
+    def record_wait_any(rpcs):
+      in_flight.append(len(rpcs))
+      return wait_any(rpcs)
+    fetcher._wait_any = record_wait_any
+    shard_fetcher = pipelines.shard_fetcher
+    host_circuit_breaker = pipelines.host_circuit_breaker
+    pipelines.shard_fetcher = fetcher
+    pipelines.host_circuit_breaker = circuit_breaker.HostCircuitBreaker()
+    proto = createFetchSetRecord([("http://hoge_0.com/content_%d" % n, True)
+                                  for n in range(6)])
+    try:
+      self.assertEquals([], list(pipelines._fetchMap(proto.Encode())))
+    finally:
+      del self._urlfetch_mock._Dynamic_Fetch
+      pipelines.shard_fetcher = shard_fetcher
+      pipelines.host_circuit_breaker = host_circuit_breaker
+
+    #The requests start at the initial limit of host, that is halved by
+    #the first timeout, then the rest are sent one by one.
+    self.assertEquals([int(fetchers.INITIAL_HOST_CONCURRENCY)] + [1] * 5,
+                      in_flight)
+    self.assertEquals(1, fetcher.get_host_stats("http://hoge_0.com").limit)
+    for n in range(6):
+      crawl_db_datum = CrawlDbDatum.query(
+          CrawlDbDatum.url=="http://hoge_0.com/content_%d" % n).fetch()[0]
+      self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+      self.assertEquals(1, crawl_db_datum.fetch_attempts)
+
+  def testInsertCanonicalUrl(self):
+    url = "HTTP://Example.com:80/a/./b"
+    datum = CrawlDbDatum.insert_or_fail(url, parent=ndb.Key(CrawlDbDatum, url),
+                                        url=url, last_status=pipelines.UNFETCHED)
+    #The parent is keyed by the canonical url, as same as the entity.
+    self.assertEquals("http://example.com/a/b", datum.url)
+    self.assertEquals(ndb.Key(CrawlDbDatum, "http://example.com/a/b"),
+                      datum.key.parent())
+    self.assertEquals(None, CrawlDbDatum.insert_or_fail(
+        "http://example.com/a/b",
+        parent=ndb.Key(CrawlDbDatum, "http://example.com/a/b"),
+        url="http://example.com/a/b"))
+
+  def testCanonicalUrl(self):
+    createMockCrawlDbDatum(1, 1, True)
+    pipelines.canonical_cache.put("http://hoge_0.com/content_0",
+                                  "http://hoge_0.com/canonical")
+    file_name = self.createMockData(("http://hoge_0.com/content_0", True))
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    #The alias is not fetched, and its canonical url is added.
+    self.assertEquals(0, len(FetchedDbDatum.query().fetch()))
+    crawl_db_datum = CrawlDbDatum.query(
+        CrawlDbDatum.url=="http://hoge_0.com/content_0").fetch()[0]
+    self.assertEquals(pipelines.FETCHED, crawl_db_datum.last_status)
+    crawl_db_datum = CrawlDbDatum.query(
+        CrawlDbDatum.url=="http://hoge_0.com/canonical").fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+
+  def testRetryTransientError(self):
+    url = "http://hoge_0.com/content_0"
+    createMockCrawlDbDatum(1, 1, True)
+    file_name = self.createMockData((url, True))
+    self.setReturnValue(status_code=503,
+                        headers={"Content-Type": "text/html",
+                                 "Retry-After": "120"})
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+    self.assertEquals(1, crawl_db_datum.fetch_attempts)
+    self.assertTrue(crawl_db_datum.next_fetch_time >
+                    datetime.datetime.now() + datetime.timedelta(seconds=100))
+
+    #The url is not fetched in backoff.
+    self._urlfetch_mock.request = None
+    file_name = self.createMockData((url, True))
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1)
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+    self.assertEquals(None, self._urlfetch_mock.request)
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+    self.assertEquals(1, crawl_db_datum.fetch_attempts)
+
+  def testAbort(self):
+    url = "http://hoge_0.com/content_0"
+    createMockCrawlDbDatum(1, 1, True)
+    file_name = self.createMockData((url, True))
+    self._urlfetch_mock.request = None
+    abort_key = pipelines._get_abort_key("aborted")
+    pipelines._set_abort_flag(abort_key, True)
+    try:
+      #The flag of the other pipeline does not stop the fetch.
+      p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1,
+                                       None, pipelines._get_abort_key("other"))
+      p.start()
+      test_support.execute_until_empty(self.taskqueue)
+      self.assertNotEquals(None, self._urlfetch_mock.request)
+
+      self._urlfetch_mock.request = None
+      crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+      crawl_db_datum.last_status = pipelines.UNFETCHED
+      crawl_db_datum.put()
+      p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1,
+                                       None, abort_key)
+      p.start()
+      test_support.execute_until_empty(self.taskqueue)
+    finally:
+      pipelines._set_abort_flag(abort_key, False)
+
+    self.assertEquals(None, self._urlfetch_mock.request)
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+
+  def testMissingCrawlDbDatum(self):
+    proto = createFetchSetRecord([("http://hoge_0.com/deleted", True)])
+    self._urlfetch_mock.request = None
+    self.assertEquals([], list(pipelines._fetchMap(proto.Encode())))
+    self.assertEquals(None, self._urlfetch_mock.request)
+
+  def testStorageErrorIsRaised(self):
+    url = "http://hoge_0.com/content_0"
+    createMockCrawlDbDatum(1, 1, True)
+    static_content = "<html><body>TestContent</body></html>"
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "text/html"})
+    def failing_owner(fingerprint, crawl_db_key):
+      raise RuntimeError("datastore is unavailable")
+    get_content_owner = pipelines._get_content_owner
+    pipelines._get_content_owner = failing_owner
+    proto = createFetchSetRecord([(url, True)])
+    try:
+      #The record is retried by mapreduce, not marked as failed fetch.
+      self.assertRaises(RuntimeError, list, pipelines._fetchMap(proto.Encode()))
+    finally:
+      pipelines._get_content_owner = get_content_owner
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+    self.assertEquals(0, crawl_db_datum.fetch_attempts)
+
+  def testCrawlDeadline(self):
+    url = "http://hoge_0.com/content_0"
+    createMockCrawlDbDatum(1, 1, True)
+    file_name = self.createMockData((url, True))
+    #The deadline has been passed.
+    p = pipelines._FetchPagePipeline("FetchPipeline", [file_name], 1,
+                                     time.time())
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    #The url is left for next run, that is not deleted by CleanDatumPipeline.
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==url).fetch()[0]
+    self.assertEquals(pipelines.UNFETCHED, crawl_db_datum.last_status)
+    self.assertEquals(0, len(FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()))
+
 def _htmlOutlinkParser(url, content):
   """htmlOutlinkParser for testing"""
   return re.findall(r'href=[\'"]?([^\'" >]+)', "".join(content))
@@ -309,6 +688,7 @@ class ExtractOutlinksPipelineTest(testutil.HandlerTestBase):
     testutil.HandlerTestBase.setUp(self)
     pipeline.Pipeline._send_mail = self._send_mail
     self.emails = []
+    pipelines.canonical_cache = canonicals.CanonicalCache()
 
   def getResource(self, file_name):
     """ to get contents from resource"""
@@ -351,12 +731,71 @@ class ExtractOutlinksPipelineTest(testutil.HandlerTestBase):
     crawl_db_datums = qry.fetch()
     self.assertTrue(len(crawl_db_datums)==0)
 
+  def testCanonicalUrl(self):
+    """Test the page that declares canonical url is recorded as alias."""
+    static_content = ("<html><head>"
+                      "<link rel=\"canonical\" href=\"/article?id=1\">"
+                      "</head><body>TestContent</body></html>")
+    createMockFetchedDatum("http://foo.com/article?id=1&ref=top",
+                           static_content, pipelines.FETCHED)
+    file_name = self.createMockDataLine("http://foo.com/article?id=1&ref=top\n")
+    p = pipelines._ExtractOutlinksPipeline("ExtractOutlinksPipeline",
+        file_names=[file_name],
+        parser_params={
+          "text/html": __name__+"._htmlOutlinkParser"
+        })
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    self.assertEquals("http://foo.com/article?id=1",
+        pipelines.canonical_cache.resolve("http://foo.com/article?id=1&ref=top"))
+    qry = CrawlDbDatum.query(CrawlDbDatum.last_status == pipelines.UNFETCHED)
+    crawl_db_datums = qry.fetch()
+    self.assertEquals(1, len(crawl_db_datums))
+    self.assertEquals("http://foo.com/article?id=1", crawl_db_datums[0].url)
+    #The content of alias is not kept.
+    crawl_db_datum = CrawlDbDatum.query(
+        CrawlDbDatum.url=="http://foo.com/article?id=1&ref=top").fetch()[0]
+    fetched_datum = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()[0]
+    self.assertEquals(None, fetched_datum.fetched_content)
+
+  def testOutlinksOfPage(self):
+    """Test the targets of a page are output by a record."""
+    static_content = ("<html><body><a href=\"/a.png\">a</a>"
+                      "<a href=\"b.png\">b</a><a href=\"/a.png\">a</a>"
+                      "</body></html>")
+    createMockFetchedDatum("http://foo.com/index.html", static_content,
+                           pipelines.FETCHED)
+    pipelines._set_parser_param(pipelines._PARSER_PARAM_KEY,
+                                {"text/html": __name__+"._htmlOutlinkParser"})
+    records = list(pipelines._extract_content_urls_map(
+        (0, "http://foo.com/index.html")))
+    self.assertEquals([("http://foo.com/index.html",
+                        "http://foo.com/a.png\nhttp://foo.com/b.png")], records)
+
+  def testOutlinksOfAliasAreNotExtracted(self):
+    static_content = ("<html><head>"
+                      "<link rel=\"canonical\" href=\"/article?id=1\">"
+                      "</head><body><a href=\"/a.png\">a</a></body></html>")
+    createMockFetchedDatum("http://foo.com/article?id=1&ref=top",
+                           static_content, pipelines.FETCHED)
+    pipelines._set_parser_param(pipelines._PARSER_PARAM_KEY,
+                                {"text/html": __name__+"._htmlOutlinkParser"})
+    records = list(pipelines._extract_content_urls_map(
+        (0, "http://foo.com/article?id=1&ref=top")))
+    #The outlinks are extracted from the canonical url by next run.
+    self.assertEquals([], records)
+    self.assertEquals("http://foo.com/article?id=1",
+        pipelines.canonical_cache.resolve("http://foo.com/article?id=1&ref=top"))
+
 class FetchContentPipelineTest(testutil.HandlerTestBase):
   """Tests for FetchContentPipeline."""
   def setUp(self):
     testutil.HandlerTestBase.setUp(self)
     pipeline.Pipeline._send_mail = self._send_mail
     self.emails = []
+    pipelines.asset_robots_rules = cache.LRUCache(
+        pipelines.MAX_ASSET_ROBOTS_RULES)
 
   def getResource(self, file_name):
     """ to get contents from resource"""
@@ -425,6 +864,167 @@ class FetchContentPipelineTest(testutil.HandlerTestBase):
     content_datums = ContentDbDatum.query(ancestor=key).fetch()
     self.assertEqual(2, len(content_datums))
 
+  def testTargetsOfPage(self):
+    #The targets of a page are fetched by a call.
+    file_name = self.createMockData(("https://developers.google.com/appengine/",
+                                     "http://k.yimg.jp/images/top/sp/logo.gif\n"
+                                     "/appengine/images/slide1.png"))
+    datum = CrawlDbDatum(
+        parent =ndb.Key(CrawlDbDatum, "https://developers.google.com/appengine/"),
+        url="https://developers.google.com/appengine/",
+        extract_domain_url="https://developers.google.com",
+        last_status=pipelines.FETCHED)
+    datum.put()
+    pipelines.robots_cache.put("http://k.yimg.jp", "")
+    pipelines.robots_cache.put("https://developers.google.com", "")
+    static_content = self.getResource("slide1.png").read()
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "image/png"})
+    p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name])
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    content_datums = ContentDbDatum.query(ancestor=datum.key).fetch()
+    self.assertEqual(2, len(content_datums))
+    for content_datum in content_datums:
+      self.assertNotEqual(None, content_datum.stored_url)
+
+  def testRobotsDisallowed(self):
+    file_name1 = self.createMockData(("https://developers.google.com/appengine/", "http://k.yimg.jp/images/top/sp/logo.gif"))
+    file_name2 = self.createMockData(("https://developers.google.com/appengine/", "http://k.yimg.jp/public/slide1.png"))
+    datum = CrawlDbDatum(
+        parent =ndb.Key(CrawlDbDatum, "https://developers.google.com/appengine/"),
+        url="https://developers.google.com/appengine/",
+        extract_domain_url="https://developers.google.com",
+        last_status=pipelines.UNFETCHED)
+    datum.put()
+    pipelines.robots_cache.put("http://k.yimg.jp", "User-agent: *\nDisallow: /images/")
+    static_content = self.getResource("slide1.png").read()
+    self.setReturnValue(content=static_content,
+                        headers={"Content-Length": len(static_content),
+                                 "Content-Type": "image/png"})
+    p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name1, file_name2])
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    #The asset disallowed by robots.txt is not fetched.
+    content_datums = ContentDbDatum.query(ancestor=datum.key).fetch()
+    self.assertEqual(1, len(content_datums))
+    self.assertEqual("http://k.yimg.jp/public/slide1.png",
+                     content_datums[0].fetched_url)
+
+  def testRetryTransientError(self):
+    target_url = "http://k.yimg.jp/images/top/sp/logo.gif"
+    file_name = self.createMockData(("https://developers.google.com/appengine/", target_url))
+    datum = CrawlDbDatum(
+        parent =ndb.Key(CrawlDbDatum, "https://developers.google.com/appengine/"),
+        url="https://developers.google.com/appengine/",
+        extract_domain_url="https://developers.google.com",
+        last_status=pipelines.FETCHED)
+    datum.put()
+    pipelines.robots_cache.put("http://k.yimg.jp", "")
+    self.setReturnValue(status_code=503,
+                        headers={"Content-Type": "image/gif",
+                                 "Retry-After": "120"})
+    p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name])
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+
+    content_datum = ContentDbDatum.get_by_id(target_url, parent=datum.key)
+    self.assertEquals(None, content_datum.stored_url)
+    self.assertEquals(1, content_datum.fetch_attempts)
+    self.assertTrue(content_datum.next_fetch_time >
+                    datetime.datetime.now() + datetime.timedelta(seconds=100))
+    self.assertTrue(pipelines._has_content_retry(datum.key))
+
+    #The content is not fetched in backoff.
+    self._urlfetch_mock.request = None
+    file_name = self.createMockData(("https://developers.google.com/appengine/", target_url))
+    p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name])
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+    self.assertEquals(None, self._urlfetch_mock.request)
+    content_datum = ContentDbDatum.get_by_id(target_url, parent=datum.key)
+    self.assertEquals(1, content_datum.fetch_attempts)
+
+  def testDeferredByCrawlDelay(self):
+    target_url = "http://k.yimg.jp/images/top/sp/logo.gif"
+    file_name = self.createMockData(("https://developers.google.com/appengine/", target_url))
+    datum = CrawlDbDatum(
+        parent =ndb.Key(CrawlDbDatum, "https://developers.google.com/appengine/"),
+        url="https://developers.google.com/appengine/",
+        extract_domain_url="https://developers.google.com",
+        last_status=pipelines.FETCHED)
+    datum.put()
+    pipelines.robots_cache.put("http://k.yimg.jp", "")
+    politeness_scheduler = pipelines.content_fetcher._politeness_scheduler
+    pipelines.content_fetcher._politeness_scheduler = BusyPolitenessScheduler()
+    self._urlfetch_mock.request = None
+    try:
+      p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name])
+      p.start()
+      test_support.execute_until_empty(self.taskqueue)
+    finally:
+      pipelines.content_fetcher._politeness_scheduler = politeness_scheduler
+
+    #The target is kept for next run, without counting an attempt.
+    self.assertEquals(None, self._urlfetch_mock.request)
+    content_datum = ContentDbDatum.get_by_id(target_url, parent=datum.key)
+    self.assertEquals(None, content_datum.stored_url)
+    self.assertEquals(0, content_datum.fetch_attempts)
+    self.assertTrue(content_datum.next_fetch_time is not None)
+    self.assertTrue(pipelines._has_content_retry(datum.key))
+
+  def testNotModifiedPageWithDeferredContent(self):
+    page_url = "http://hoge_0.com/content_0"
+    target_url = "http://k.yimg.jp/images/top/sp/logo.gif"
+    createMockFetchedDatum(page_url, "<html><body>Stored</body></html>",
+                           pipelines.FETCHED)
+    crawl_db_datum = CrawlDbDatum.query(CrawlDbDatum.url==page_url).fetch()[0]
+    fetched_datum = FetchedDbDatum.query(ancestor=crawl_db_datum.key).fetch()[0]
+    fetched_datum.http_headers = str({"ETag": "\"abc\""})
+    fetched_datum.put()
+    #The deadline has been passed, the target is deferred.
+    file_name = self.createMockData((page_url, target_url))
+    self._urlfetch_mock.request = None
+    p = pipelines._FetchContentPipeline("FetchContentPipeline", [file_name],
+                                        crawl_deadline=time.time())
+    p.start()
+    test_support.execute_until_empty(self.taskqueue)
+    self.assertEquals(None, self._urlfetch_mock.request)
+    content_datum = ContentDbDatum.get_by_id(target_url, parent=crawl_db_datum.key)
+    self.assertEquals(0, content_datum.fetch_attempts)
+    self.assertTrue(content_datum.next_fetch_time is not None)
+
+    #The page is not modified, but output again for the deferred target.
+    self.setReturnValue(status_code=304)
+    proto = createFetchSetRecord([(page_url, True)])
+    self.assertEquals(["%s\n" % page_url],
+                      list(pipelines._fetchMap(proto.Encode())))
+
+  def testAssetRobotsCrawlDelay(self):
+    pipelines.robots_cache.put("http://k.yimg.jp",
+                               "User-agent: *\nCrawl-delay: 5")
+    rules = pipelines._get_asset_robots_rules("http://k.yimg.jp")
+    self.assertEquals(5, rules.crawl_delay)
+    #The content of asset host is fetched by the Crawl-delay.
+    self.assertEquals(5, pipelines.politeness_scheduler.get_crawl_delay(
+        "http://k.yimg.jp"))
+
+  def testAssetRobotsDeferredByCrawlDelay(self):
+    politeness_scheduler = pipelines.shard_fetcher._politeness_scheduler
+    pipelines.shard_fetcher._politeness_scheduler = BusyPolitenessScheduler()
+    self._urlfetch_mock.request = None
+    try:
+      rules = pipelines._get_asset_robots_rules("http://k.yimg.jp")
+    finally:
+      pipelines.shard_fetcher._politeness_scheduler = politeness_scheduler
+    #robots.txt is not fetched, and nothing is cached.
+    self.assertEquals(None, rules)
+    self.assertEquals(None, self._urlfetch_mock.request)
+    self.assertEquals(None, pipelines.asset_robots_rules.get("http://k.yimg.jp"))
+
 class CleanPipelineTest(testutil.HandlerTestBase):
   """Test for CleanPipelineTest. """
   def setUp(self):
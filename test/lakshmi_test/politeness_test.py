@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from testlib import testutil
+from lakshmi import configuration
+from lakshmi import politeness
+from lakshmi.datum import HostDbDatum
+
+class PolitenessSchedulerTest(testutil.HandlerTestBase):
+  """Tests for PolitenessScheduler."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+    fetcher_policy_yaml.fetcher_policy.crawl_delay = "2000"
+    self.scheduler = politeness.PolitenessScheduler(
+        fetcher_policy_yaml.fetcher_policy, max_wait=5)
+    self.now = 1000.0
+    self.scheduler._time = lambda: self.now
+    self.slept = []
+    self.scheduler._sleep = self.slept.append
+
+  def testReserveSpacesSlots(self):
+    host = "http://foo.com"
+    self.assertEquals(0, self.scheduler.reserve(host))
+    self.assertEquals(2.0, self.scheduler.reserve(host))
+    self.assertEquals(4.0, self.scheduler.reserve(host))
+    self.assertEquals(0, self.scheduler.reserve("http://bar.com"))
+
+  def testRobotsCrawlDelay(self):
+    host = "http://foo.com"
+    self.scheduler.set_robots_crawl_delay(host, 3)
+    self.assertEquals(3, self.scheduler.get_crawl_delay(host))
+    self.assertEquals(3, HostDbDatum.get_by_id(host).crawl_delay)
+    self.assertEquals(0, self.scheduler.reserve(host))
+    self.assertEquals(3, self.scheduler.reserve(host))
+
+  def testWaitDefersBusyHost(self):
+    host = "http://foo.com"
+    self.assertTrue(self.scheduler.wait(host))
+    self.assertTrue(self.scheduler.wait(host))
+    self.assertTrue(self.scheduler.wait(host))
+    self.assertFalse(self.scheduler.wait(host))
+    self.assertEquals([2.0, 4.0], self.slept)
+
+  def testMaxWaitLimit(self):
+    fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+    fetcher_policy_yaml.fetcher_policy.crawl_delay = "600000"
+    scheduler = politeness.PolitenessScheduler(
+        fetcher_policy_yaml.fetcher_policy, max_wait=3600)
+    scheduler._time = lambda: self.now
+    scheduler._sleep = self.slept.append
+    host = "http://foo.com"
+    self.assertTrue(scheduler.wait(host))
+    #The next slot is later than MAX_WAIT_LIMIT, that is deferred.
+    self.assertFalse(scheduler.wait(host))
+    self.assertEquals([], self.slept)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from testlib import testutil
+from lakshmi import redirects
+from lakshmi.datum import RedirectDbDatum
+
+class PersistentRedirectCacheTest(testutil.HandlerTestBase):
+  """Tests for PersistentRedirectCache."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    self.cache = redirects.PersistentRedirectCache()
+
+  def testPutAndGet(self):
+    self.cache.put("http://foo.com/a", "http://foo.com/b")
+    self.assertEquals("http://foo.com/b",
+        RedirectDbDatum.get_by_id("http://foo.com/a").location)
+    #Other run reads it from datastore.
+    redirects.memcache.flush_all()
+    other_cache = redirects.PersistentRedirectCache()
+    self.assertEquals("http://foo.com/b", other_cache.get("http://foo.com/a"))
+
+  def testNotRedirectIsCached(self):
+    self.assertEquals(None, self.cache.get("http://foo.com/a"))
+    #Other shards read the url that is not redirected from memcache.
+    self.assertEquals("", redirects.memcache.get(
+        "http://foo.com/a", namespace=redirects.MEMCACHE_NAMESPACE))
+    other_cache = redirects.PersistentRedirectCache()
+    self.assertEquals(None, other_cache.get("http://foo.com/a"))
+    self.assertEquals([], other_cache.resolve("http://foo.com/a", 5))
+
+  def testPrefetch(self):
+    self.cache.put("http://foo.com/a", "http://foo.com/b")
+    redirects.memcache.flush_all()
+    other_cache = redirects.PersistentRedirectCache()
+    max_batch_size = redirects.MAX_BATCH_SIZE
+    redirects.MAX_BATCH_SIZE = 1
+    try:
+      other_cache.prefetch(["http://foo.com/a", "http://foo.com/c"])
+    finally:
+      redirects.MAX_BATCH_SIZE = max_batch_size
+    #The urls are cached in memcache, also the url that is not redirected.
+    self.assertEquals("http://foo.com/b", redirects.memcache.get(
+        "http://foo.com/a", namespace=redirects.MEMCACHE_NAMESPACE))
+    self.assertEquals("", redirects.memcache.get(
+        "http://foo.com/c", namespace=redirects.MEMCACHE_NAMESPACE))
+    self.assertEquals(["http://foo.com/b"],
+                      other_cache.resolve("http://foo.com/a", 5))
+    self.assertEquals(None, other_cache.get("http://foo.com/c"))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import unittest
+
+from testlib import testutil
+from lakshmi import configuration
+from lakshmi import fetchers
+from lakshmi import robots
+from lakshmi.datum import RobotsDbDatum
+
+def createFetchResult(headers):
+  """Create FetchResult of robots.txt with headers."""
+  return fetchers.FetchResult("http://foo.com/robots.txt",
+                              "http://foo.com/robots.txt", 200, headers)
+
+class GetCacheTtlTest(unittest.TestCase):
+  """Tests for get_cache_ttl."""
+
+  def testMaxAge(self):
+    result = createFetchResult({"Cache-Control": "public, max-age=3600"})
+    self.assertEquals(3600.0, robots.get_cache_ttl(result, 86400))
+    result = createFetchResult({"Cache-Control": "max-age=864000"})
+    self.assertEquals(86400, robots.get_cache_ttl(result, 86400))
+
+  def testNoCache(self):
+    result = createFetchResult({"Cache-Control": "no-cache"})
+    self.assertEquals(0, robots.get_cache_ttl(result, 86400))
+    result = createFetchResult({"Cache-Control": "private, no-store"})
+    self.assertEquals(0, robots.get_cache_ttl(result, 86400))
+
+  def testExpires(self):
+    result = createFetchResult({"Expires": "Thu, 01 Jan 1970 01:00:00 GMT"})
+    self.assertEquals(1800.0, robots.get_cache_ttl(result, 86400, now=1800))
+    result = createFetchResult({"Expires": "0"})
+    self.assertEquals(0, robots.get_cache_ttl(result, 86400))
+
+  def testNoCacheHeaders(self):
+    result = createFetchResult({"Content-Type": "text/plain"})
+    self.assertEquals(86400, robots.get_cache_ttl(result, 86400))
+
+class RobotsRulesTest(unittest.TestCase):
+  """Tests for RobotsRules."""
+
+  def testAgentGroup(self):
+    content = ("User-agent: *\nDisallow: /\n\n"
+               "User-agent: test\nDisallow: /search\n\n"
+               "User-agent: other\nUser-agent: test\nDisallow: /private")
+    rules = robots.RobotsRules(content, "test")
+    self.assertTrue(rules.can_fetch("http://foo.com/index.html"))
+    self.assertFalse(rules.can_fetch("http://foo.com/search?q=a"))
+    self.assertFalse(rules.can_fetch("http://foo.com/private/a.html"))
+    rules = robots.RobotsRules(content, "unknown/1.0")
+    self.assertFalse(rules.can_fetch("http://foo.com/index.html"))
+
+  def testEmptyAgentGroup(self):
+    #The group of the agent is used, even if it has no rule.
+    content = "User-agent: lakshmi\nDisallow:\n\nUser-agent: *\nDisallow: /"
+    rules = robots.RobotsRules(content, "lakshmi")
+    self.assertTrue(rules.can_fetch("http://foo.com/a"))
+    rules = robots.RobotsRules(content, "other")
+    self.assertFalse(rules.can_fetch("http://foo.com/a"))
+
+  def testProductToken(self):
+    #The agent is matched by the whole product token, not by substring.
+    content = ("User-agent: Lakshmi/2.0\nDisallow: /private\n\n"
+               "User-agent: shmi\nDisallow: /\n\n"
+               "User-agent: *\nDisallow: /search")
+    rules = robots.RobotsRules(content, "lakshmi/1.0")
+    self.assertTrue(rules.can_fetch("http://foo.com/search"))
+    self.assertFalse(rules.can_fetch("http://foo.com/private/a.html"))
+    rules = robots.RobotsRules(content, "lakshmibot")
+    self.assertFalse(rules.can_fetch("http://foo.com/search"))
+    self.assertTrue(rules.can_fetch("http://foo.com/private/a.html"))
+
+  def testLongestMatch(self):
+    content = ("User-agent: *\nDisallow: /a\nAllow: /a/b\n"
+               "Disallow: /a/b/c\nAllow: /x\nDisallow: /x")
+    rules = robots.RobotsRules(content, "test")
+    self.assertEquals([False, True, False, True, True],
+        rules.can_fetch_many(["http://foo.com/a", "http://foo.com/a/b.html",
+                              "http://foo.com/a/b/c", "http://foo.com/x",
+                              "http://foo.com/b"]))
+
+  def testWildcard(self):
+    content = ("User-agent: *\nDisallow: /*.gif$\nDisallow: /*/private/\n"
+               "Allow: /public/*/private/\nDisallow: /*?sessionid=")
+    rules = robots.RobotsRules(content, "test")
+    self.assertFalse(rules.can_fetch("http://foo.com/images/a.gif"))
+    self.assertTrue(rules.can_fetch("http://foo.com/images/a.gif?size=1"))
+    self.assertFalse(rules.can_fetch("http://foo.com/user/private/a.html"))
+    self.assertTrue(rules.can_fetch("http://foo.com/public/user/private/a.html"))
+    self.assertFalse(rules.can_fetch("http://foo.com/page?sessionid=1"))
+    self.assertTrue(rules.can_fetch("http://foo.com/page?id=1"))
+
+  def testPercentEncoding(self):
+    content = "User-agent: *\nDisallow: /%7Euser/\nDisallow: /a%2fb"
+    rules = robots.RobotsRules(content, "test")
+    self.assertFalse(rules.can_fetch("http://foo.com/~user/index.html"))
+    self.assertFalse(rules.can_fetch("http://foo.com/a/b"))
+    #The escapes of url are normalized as same as the rules.
+    self.assertFalse(rules.can_fetch("http://foo.com/%7euser/index.html"))
+    self.assertFalse(rules.can_fetch("http://foo.com/a%2Fb"))
+    self.assertTrue(rules.can_fetch("http://foo.com/a%2Fc"))
+
+  def testDisallowAll(self):
+    rules = robots.RobotsRules(robots.DISALLOW_ALL, "test")
+    self.assertFalse(rules.can_fetch("http://foo.com/"))
+    self.assertTrue(rules.can_fetch("http://foo.com/robots.txt"))
+    rules = robots.RobotsRules("User-agent: *\nDisallow:", "test")
+    self.assertTrue(rules.can_fetch("http://foo.com/"))
+    rules = robots.RobotsRules("", "test")
+    self.assertTrue(rules.can_fetch("http://foo.com/"))
+
+  def testCrawlDelayAndSitemaps(self):
+    content = ("Sitemap: http://foo.com/sitemap.xml\n"
+               "User-agent: *\nCrawl-delay: 10\n\n"
+               "User-agent: test\nCrawl-delay: 2\nDisallow: /search\n"
+               "Sitemap: http://foo.com/news.xml")
+    rules = robots.RobotsRules(content, "test")
+    self.assertEquals(2.0, rules.crawl_delay)
+    self.assertEquals(["http://foo.com/sitemap.xml", "http://foo.com/news.xml"],
+                      rules.sitemaps)
+    rules = robots.RobotsRules(content, "other")
+    self.assertEquals(10.0, rules.crawl_delay)
+    rules = robots.RobotsRules("User-agent: *\nDisallow: /", "test")
+    self.assertEquals(None, rules.crawl_delay)
+
+class RobotsCacheTest(testutil.HandlerTestBase):
+  """Tests for RobotsCache."""
+
+  def setUp(self):
+    testutil.HandlerTestBase.setUp(self)
+    fetcher_policy_yaml = configuration.FetcherPolicyYaml.create_default_policy()
+    self.cache = robots.RobotsCache(fetcher_policy_yaml.fetcher_policy)
+    self.now = time.time()
+    self.cache._time = lambda: self.now
+
+  def testPutAndGet(self):
+    host = "http://foo.com"
+    self.assertEquals(None, self.cache.get(host))
+    content = "User-agent: *\nDisallow: /private"
+    self.cache.put(host, content,
+                   createFetchResult({"Cache-Control": "max-age=3600"}))
+    self.assertEquals(content, self.cache.get(host))
+    self.assertEquals(None, self.cache.get("http://bar.com"))
+    #Other run reads it from datastore.
+    other_cache = robots.RobotsCache(configuration.FetcherPolicyYaml
+        .create_default_policy().fetcher_policy)
+    other_cache._time = lambda: self.now
+    robots.memcache.flush_all()
+    self.assertEquals(content, other_cache.get(host))
+    #Expired.
+    self.now += 3601
+    self.assertEquals(None, self.cache.get(host))
+
+  def testFailure(self):
+    host = "http://foo.com"
+    self.cache.put(host, robots.DISALLOW_ALL, failed=True)
+    self.assertEquals(robots.DISALLOW_ALL, self.cache.get(host))
+    self.assertTrue(RobotsDbDatum.get_by_id(host).failed)
+    self.now += 60 * 60 + 1
+    self.assertEquals(None, self.cache.get(host))
+
+  def testNotCacheable(self):
+    host = "http://foo.com"
+    self.cache.put(host, "", createFetchResult({"Cache-Control": "no-store"}))
+    self.assertEquals(None, self.cache.get(host))
+    self.assertEquals(None, RobotsDbDatum.get_by_id(host))
+
+  def testGetRules(self):
+    host = "http://foo.com"
+    content = "User-agent: *\nDisallow: /private"
+    self.cache.put(host, content)
+    rules = self.cache.get_rules(host, content)
+    self.assertFalse(rules.can_fetch("http://foo.com/private/a.html"))
+    self.assertTrue(rules.can_fetch("http://foo.com/public/a.html"))
+    #The compiled rules are cached with the content.
+    self.assertTrue(robots.memcache.get(
+        host, namespace=robots.MEMCACHE_NAMESPACE)["rules"] is not None)
+    rules = self.cache.get_rules(host, content)
+    self.assertFalse(rules.can_fetch("http://foo.com/private/a.html"))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 cloudysunny14.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from lakshmi import urls
+
+class CanonicalizeTest(unittest.TestCase):
+  """Tests for canonicalize."""
+
+  def testSchemeAndHost(self):
+    self.assertEquals("http://example.com/",
+                      urls.canonicalize("HTTP://Example.COM"))
+    self.assertEquals("http://example.com/a",
+                      urls.canonicalize("http://example.com:80/a"))
+    self.assertEquals("https://example.com/a",
+                      urls.canonicalize("https://example.com:443/a"))
+    self.assertEquals("http://example.com:8080/a",
+                      urls.canonicalize("http://example.com:8080/a"))
+    self.assertEquals("http://[::1]:8080/a",
+                      urls.canonicalize("http://[::1]:8080/a"))
+    self.assertEquals("http://[2001:db8::1]/",
+                      urls.canonicalize("http://[2001:DB8::1]:80"))
+    self.assertEquals("http://xn--bcher-kva.de/",
+                      urls.canonicalize(u"http://B\u00fccher.de/"))
+
+  def testPath(self):
+    self.assertEquals("http://example.com/a/c/d",
+                      urls.canonicalize("http://example.com/a/./b/../c//d"))
+    self.assertEquals("http://example.com/a/b/",
+                      urls.canonicalize("http://example.com/a/b/."))
+    self.assertEquals("http://example.com/~user/a%2Fb%20c",
+                      urls.canonicalize("http://example.com/%7euser/a%2fb c"))
+
+  def testQueryAndFragment(self):
+    self.assertEquals("http://example.com/?a=1&b=2&b=1",
+                      urls.canonicalize("http://example.com/?b=2&a=1&b=1#top"))
+    self.assertEquals("http://example.com/",
+                      urls.canonicalize("http://example.com/?#top"))
+
+  def testRelativeUrl(self):
+    base_url = "http://example.com/dir/page.html"
+    self.assertEquals("http://example.com/dir/img.png",
+                      urls.canonicalize("img.png", base_url))
+    self.assertEquals("http://example.com/img.png",
+                      urls.canonicalize("../img.png", base_url))
+    self.assertEquals("http://example.com/images/img.png",
+                      urls.canonicalize("/images/img.png", base_url))
+    self.assertEquals("http://cdn.example.com/img.png",
+                      urls.canonicalize("//cdn.example.com/img.png", base_url))
+
+  def testUnsupportedUrl(self):
+    self.assertEquals(None, urls.canonicalize("javascript:void(0)",
+                                              "http://example.com/"))
+    self.assertEquals(None, urls.canonicalize("mailto:a@example.com"))
+    self.assertEquals(None, urls.canonicalize("http://example.com:port/"))
+
+  def testGetDomain(self):
+    self.assertEquals("http://example.com",
+                      urls.get_domain("HTTP://Example.com/a/b"))
+    self.assertEquals(("https", "example.com:8443"),
+                      urls.split_host("https://example.com:8443/a"))
+    #The urls of the same host share the cached result.
+    self.assertEquals(("http", "example.com"),
+                      urls.split_host("HTTP://Example.com?a=1"))
+    self.assertEquals(("http", "[::1]:8080"),
+                      urls.split_host("http://[::1]:8080/a#b"))
+    self.assertEquals(("", ""), urls.split_host("/a/b"))
+
+if __name__ == "__main__":
+  unittest.main()